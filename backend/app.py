@@ -7,35 +7,77 @@ This backend has three main responsibilities:
 3. WebSocket endpoint for controller connections (at /ws/{candlestick_id})
 
 Architecture:
-- Controllers connect via WebSocket to /ws/{candlestick_id}
+- Controllers connect via WebSocket to /ws/{candlestick_id}, or with several
+  candlesticks over one connection to /ws/gateway/{gateway_id}
 - Web users access the frontend at / (served as static files)
 - Frontend communicates with backend via REST API at /api/*
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 from datetime import datetime
+from typing import List, Optional
 import logging
 import json
 import asyncio
 import os
+import time
+import uuid
 
 from models import (
     CandlestickState,
     CandlestickCommand,
     CandlestickListResponse,
+    CommandResponse,
     MessageType,
-    StatusMessage
+    StatusMessage,
+    AckMessage,
+    ControllerMetricsMessage,
+    ProfileResultMessage,
+    ProfileInfo,
+    ProfileRequestResponse,
+    AttachMessage,
+    BatchMessage,
+    ResyncMessage,
+    OfflineSchedule,
+    GatewayInfo,
+    EventPage,
+    Show,
+    ShowInfo,
+    DesiredState,
+    DesiredStateInfo,
+    ResetPolicy
 )
-from connection_manager import ConnectionManager
+from desired_state import validate_desired_state
+from connection_manager import ConnectionManager, DEFAULT_COMMAND_RATE, DEFAULT_QUEUE_SIZE, DEFAULT_WRITE_TIMEOUT
+from outbound import QueueFull, DROP_OLDEST
+from events import EventStore, DEFAULT_CAPACITY, DEFAULT_MAX_SEGMENTS, DEFAULT_RETENTION_SECONDS
+from shows import validate_show
+from static_files import FrontendFiles
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
 # Connection manager for WebSocket connections (initialized before lifespan)
-manager = ConnectionManager()
+# COMMAND_RATE limits the commands sent per second to each candlestick, faster commands are merged.
+# Other messages wait in a queue of CONTROLLER_QUEUE_SIZE per connection, handled by CONTROLLER_DROP_POLICY
+# when full, and a connection is closed when a write takes longer than CONTROLLER_WRITE_TIMEOUT seconds.
+# The latest EVENT_LOG_SIZE events of each candlestick are kept in memory, and with EVENT_LOG_DIR set all
+# events are written to segment files there, kept for EVENT_LOG_RETENTION_DAYS (at most EVENT_LOG_MAX_SEGMENTS).
+manager = ConnectionManager(
+    command_rate=float(os.getenv("COMMAND_RATE", DEFAULT_COMMAND_RATE)),
+    queue_size=int(os.getenv("CONTROLLER_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+    drop_policy=os.getenv("CONTROLLER_DROP_POLICY", DROP_OLDEST),
+    write_timeout=float(os.getenv("CONTROLLER_WRITE_TIMEOUT", DEFAULT_WRITE_TIMEOUT)),
+    events=EventStore(
+        capacity=int(os.getenv("EVENT_LOG_SIZE", DEFAULT_CAPACITY)),
+        directory=os.getenv("EVENT_LOG_DIR") or None,
+        max_segments=int(os.getenv("EVENT_LOG_MAX_SEGMENTS", DEFAULT_MAX_SEGMENTS)),
+        retention_seconds=float(os.getenv("EVENT_LOG_RETENTION_DAYS", DEFAULT_RETENTION_SECONDS / 86400)) * 86400
+    )
+)
 
 
 @asynccontextmanager
@@ -43,18 +85,24 @@ async def lifespan(app: FastAPI):
     """Lifespan context manager for startup and shutdown events"""
     # Startup
     logger.info("Backend server starting up")
-    cleanup_task = asyncio.create_task(manager.cleanup_stale_connections())
+    # Settings (desired state, offline schedule, reset policy) of candlesticks gone for SETTINGS_RETENTION_DAYS are dropped
+    cleanup_task = asyncio.create_task(manager.cleanup_stale_connections(
+        settings_retention_days=float(os.getenv("SETTINGS_RETENTION_DAYS", "7"))
+    ))
+    lag_task = asyncio.create_task(manager.monitor_event_loop_lag())
     
     yield
     
     # Shutdown
     logger.info("Backend server shutting down")
-    cleanup_task.cancel()
-    try:
-        await cleanup_task
-    except asyncio.CancelledError:
-        pass
+    for task in (cleanup_task, lag_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
     await manager.disconnect_all()
+    manager.events.close()
 
 
 # Initialize FastAPI app
@@ -77,12 +125,31 @@ else:
 
 logger.info(f"CORS allowed origins: {cors_origins}")
 
+
+class ApiOnlyMiddleware:
+    """Run a middleware only for HTTP requests to the API, other requests (static files) skip it"""
+    
+    def __init__(self, app, middleware, **options):
+        self.app = app
+        self.api = middleware(app, **options)
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/api/"):
+            await self.api(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+# Only the API is called cross-origin, the frontend is served from the same origin
 app.add_middleware(
-    CORSMiddleware,
+    ApiOnlyMiddleware,
+    middleware=CORSMiddleware,
     allow_origins=cors_origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PUT", "DELETE"],
+    allow_headers=["Content-Type", "If-Match"],
+    expose_headers=["ETag"],
+    max_age=3600,
 )
 
 
@@ -92,10 +159,19 @@ async def health_check():
     return {
         "status": "running",
         "service": "RGB Candlestick Backend",
-        "connected_candlesticks": len(manager.get_all_states())
+        "connected_candlesticks": len(manager.get_all_states()),
+        "event_loop_lag": manager.event_loop_lag.snapshot()
     }
 
 
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Backend and controller metrics in the Prometheus text exposition format.
+    """
+    return PlainTextResponse(manager.render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/candlesticks", response_model=CandlestickListResponse)
 async def list_candlesticks():
     """
@@ -106,22 +182,54 @@ async def list_candlesticks():
     return CandlestickListResponse(candlesticks=list(states.values()))
 
 
+@app.get("/api/gateways", response_model=List[GatewayInfo])
+async def list_gateways():
+    """
+    List connected gateways (controllers multiplexing several candlesticks over one connection).
+    """
+    return [
+        GatewayInfo(id=gateway_id, candlesticks=manager.gateway_candlesticks(gateway_id))
+        for gateway_id in manager.gateway_connections
+    ]
+
+
 @app.get("/api/candlesticks/{candlestick_id}", response_model=CandlestickState)
-async def get_candlestick(candlestick_id: str):
+async def get_candlestick(candlestick_id: str, response: Response):
     """
     Get the current state of a specific candlestick.
+    The ETag header holds the state version, to send as If-Match with a command.
     """
     state = manager.get_state(candlestick_id)
     if not state:
         raise HTTPException(status_code=404, detail="Candlestick not found")
+    response.headers["ETag"] = f'"{state.version}"'
     return state
 
 
-@app.post("/api/candlesticks/{candlestick_id}/command")
-async def send_command(candlestick_id: str, command: CandlestickCommand):
+@app.post("/api/candlesticks/{candlestick_id}/command", response_model=CommandResponse)
+async def send_command(
+    candlestick_id: str,
+    command: CandlestickCommand,
+    wait: bool = Query(False, description="Wait until the controller acknowledges the command"),
+    sent: bool = Query(False, description="Wait until the command is written to the controller connection"),
+    timeout: float = Query(5.0, gt=0, le=30, description="Seconds to wait for the write or acknowledgement"),
+    skip_unchanged: bool = Query(False, description="Don't send the command if the candlestick already shows what it asks for"),
+    if_match: Optional[str] = Header(None, description="State version (ETag) the command is based on"),
+):
     """
     Send a command to a specific candlestick.
     The candlestick must be connected via WebSocket.
+    
+    With an If-Match header holding the state version (the `version` field or ETag of the
+    candlestick's state), the command is rejected with 412 when the state has changed since.
+    With `skip_unchanged=true` a command that wouldn't change the state isn't sent.
+    
+    By default the call returns as soon as the command is queued. With `sent=true` it
+    returns once the command is written to the controller connection, with `wait=true`
+    once the controller has applied the command, including latency measurements.
+    
+    Each candlestick gets at most COMMAND_RATE commands per second. A command arriving
+    while the previous one is still queued is merged into it (later fields win).
     """
     if not manager.is_connected(candlestick_id):
         raise HTTPException(
@@ -129,13 +237,368 @@ async def send_command(candlestick_id: str, command: CandlestickCommand):
             detail=f"Candlestick '{candlestick_id}' is not connected"
         )
     
+    version = manager.get_state(candlestick_id).version
+    if if_match is not None and if_match.strip() != "*" and if_match.strip().removeprefix("W/").strip('"') != str(version):
+        raise HTTPException(status_code=412, detail=f"State of '{candlestick_id}' changed, its version is now {version}")
+    if skip_unchanged and manager.is_applied(candlestick_id, command):
+        return CommandResponse(status="unchanged", message="Candlestick already shows this", version=version)
+    
     try:
-        await manager.send_command(candlestick_id, command)
+        pending = await manager.send_command(candlestick_id, command, wait=wait, timeout=timeout, wait_written=sent)
         logger.info(f"Command sent to {candlestick_id}: {command.model_dump(exclude_none=True)}")
-        return {"status": "success", "message": "Command sent to candlestick"}
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail=f"Candlestick '{candlestick_id}' did not {'acknowledge' if wait else 'receive'} the command within {timeout}s"
+        )
+    except ConnectionError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         logger.error(f"Failed to send command to {candlestick_id}: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    
+    if not wait:
+        message = "Command sent to candlestick" if sent else "Command queued for candlestick"
+        return CommandResponse(status="success", message=message, seq=pending.seq, version=manager.get_state(candlestick_id).version)
+    
+    ack = pending.future.result()
+    if ack.error:
+        raise HTTPException(status_code=502, detail=f"Candlestick failed to apply command: {ack.error}")
+    
+    def elapsed_ms(start, end):
+        return (end - start) * 1000 if start is not None and end is not None else None
+    
+    return CommandResponse(
+        status="success",
+        message="Command applied by candlestick",
+        seq=pending.seq,
+        version=manager.get_state(candlestick_id).version,
+        latency_ms=(pending.acked_at - pending.sent_at) * 1000,
+        apply_ms=elapsed_ms(ack.received_at, ack.applied_at),
+        first_frame_ms=elapsed_ms(ack.received_at, ack.first_frame_at)
+    )
+
+
+@app.post("/api/candlesticks/{candlestick_id}/profile", response_model=ProfileRequestResponse)
+async def request_profile(
+    candlestick_id: str,
+    duration: float = Query(10.0, gt=0, le=120, description="Seconds to profile"),
+):
+    """
+    Ask a controller to profile its animation process and event loop.
+    The result is uploaded by the controller when done and can be downloaded from
+    `/api/candlesticks/{candlestick_id}/profiles/{profile_id}`.
+    """
+    if not manager.is_connected(candlestick_id):
+        raise HTTPException(
+            status_code=404,
+            detail=f"Candlestick '{candlestick_id}' is not connected"
+        )
+    
+    profile_id = uuid.uuid4().hex[:12]
+    try:
+        await manager.request_profile(candlestick_id, profile_id, duration)
+    except (QueueFull, ConnectionError) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        logger.error(f"Failed to request profile from {candlestick_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return ProfileRequestResponse(
+        profile_id=profile_id,
+        duration=duration,
+        message=f"Profiling started, results are available in about {duration + 2:.0f}s"
+    )
+
+
+@app.get("/api/candlesticks/{candlestick_id}/profiles", response_model=List[ProfileInfo])
+async def list_profiles(candlestick_id: str):
+    """
+    List profiles uploaded by a controller, newest first.
+    """
+    return manager.list_profiles(candlestick_id)
+
+
+@app.get("/api/candlesticks/{candlestick_id}/profiles/{profile_id}", response_class=PlainTextResponse)
+async def download_profile(
+    candlestick_id: str,
+    profile_id: str,
+    target: str = Query("animation", description="'animation' or 'event_loop'"),
+):
+    """
+    Download a profile in collapsed stack format (for flamegraph.pl or speedscope).
+    """
+    collapsed = manager.get_profile(candlestick_id, profile_id, target)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(
+        collapsed,
+        headers={"Content-Disposition": f'attachment; filename="{candlestick_id}-{profile_id}-{target}.folded"'}
+    )
+
+
+@app.put("/api/candlesticks/{candlestick_id}/offline-schedule", response_model=OfflineSchedule)
+async def set_offline_schedule(candlestick_id: str, schedule: OfflineSchedule):
+    """
+    Set the commands a candlestick applies by time of day while it can't reach the backend.
+    
+    The controller stores the schedule locally, next to its last state, and keeps running
+    from them while offline, also across restarts. The schedule is sent now if the
+    candlestick is connected, and again on every connect.
+    """
+    await manager.set_offline_schedule(candlestick_id, schedule)
+    return schedule
+
+
+@app.get("/api/candlesticks/{candlestick_id}/offline-schedule", response_model=OfflineSchedule)
+async def get_offline_schedule(candlestick_id: str):
+    """
+    Get the offline schedule of a candlestick.
+    """
+    schedule = manager.offline_schedules.get(candlestick_id)
+    if schedule is None:
+        raise HTTPException(status_code=404, detail="No offline schedule set")
+    return schedule
+
+
+@app.put("/api/candlesticks/{candlestick_id}/reset-policy", response_model=ResetPolicy)
+async def set_reset_policy(candlestick_id: str, policy: ResetPolicy):
+    """
+    Set what a candlestick resets to after a period without commands.
+    
+    The default state can change by time of day: each schedule entry is the default from
+    its time on, and an idle candlestick switches to it at that time. Fields left out use
+    the controller's settings (`--inactivity-timeout` and the default program). The controller
+    stores the policy locally and doesn't restart an animation already showing the default.
+    The policy is sent now if the candlestick is connected, and again on every connect.
+    """
+    try:
+        for state in ([policy.defaults] if policy.defaults else []) + policy.schedule:
+            validate_desired_state(state)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await manager.set_reset_policy(candlestick_id, policy)
+    return policy
+
+
+@app.get("/api/candlesticks/{candlestick_id}/reset-policy", response_model=ResetPolicy)
+async def get_reset_policy(candlestick_id: str):
+    """
+    Get the reset policy of a candlestick.
+    """
+    policy = manager.reset_policies.get(candlestick_id)
+    if policy is None:
+        raise HTTPException(status_code=404, detail="No reset policy set")
+    return policy
+
+
+@app.put("/api/candlesticks/{candlestick_id}/desired-state", response_model=DesiredStateInfo)
+async def set_desired_state(
+    candlestick_id: str,
+    desired: DesiredState,
+    wait: bool = Query(False, description="Wait until the controller has converged to the desired state"),
+    timeout: float = Query(5.0, gt=0, le=30, description="Seconds to wait for the acknowledgement"),
+):
+    """
+    Set the state a candlestick should be in: a program or a color, with speed and direction.
+    
+    The backend keeps it and sends it now if the candlestick is connected. After every
+    reconnect, the fields the reported state differs in are sent again. The controller
+    converges without restarting an animation that already shows what is desired, so
+    repeating a PUT doesn't disturb it. Commands sent in between change the state until
+    the next reconnect.
+    """
+    try:
+        validate_desired_state(desired)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    try:
+        pending = await manager.set_desired_state(candlestick_id, desired, wait=wait, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail=f"Candlestick '{candlestick_id}' did not acknowledge the desired state within {timeout}s"
+        )
+    except ConnectionError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    
+    if wait and pending is not None and pending.future.result().error:
+        raise HTTPException(status_code=502, detail=f"Candlestick failed to apply the desired state: {pending.future.result().error}")
+    logger.info(f"Desired state of {candlestick_id} set: {desired.model_dump(exclude_none=True)}")
+    return manager.desired_state_info(candlestick_id, seq=pending.seq if pending else None)
+
+
+@app.get("/api/candlesticks/{candlestick_id}/desired-state", response_model=DesiredStateInfo)
+async def get_desired_state(candlestick_id: str):
+    """
+    Get the desired state of a candlestick and the fields its reported state differs in.
+    """
+    info = manager.desired_state_info(candlestick_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="No desired state set")
+    return info
+
+
+@app.delete("/api/candlesticks/{candlestick_id}/desired-state", response_model=DesiredState)
+async def delete_desired_state(candlestick_id: str):
+    """
+    Stop converging a candlestick to a desired state. Its current state is kept.
+    """
+    desired = manager.desired_states.pop(candlestick_id, None)
+    if desired is None:
+        raise HTTPException(status_code=404, detail="No desired state set")
+    return desired
+
+
+@app.get("/api/candlesticks/{candlestick_id}/events", response_model=EventPage)
+async def get_events(
+    candlestick_id: str,
+    since: Optional[int] = Query(None, ge=0, description="Return events after this sequence number"),
+    since_time: Optional[float] = Query(None, description="Return events at or after this Unix timestamp (instead of since)"),
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of events"),
+):
+    """
+    Get the event log of a candlestick: commands, acks, status changes, connects and disconnects.
+    
+    Events are returned oldest first, starting at the oldest event kept when neither since
+    nor since_time is given. Pass next_since of a page as since to get the next one.
+    """
+    log = manager.events.get(candlestick_id)
+    if log is None:
+        raise HTTPException(status_code=404, detail="No events for this candlestick")
+    events = log.query(since=since, since_time=since_time, limit=limit)
+    return EventPage(
+        events=events,
+        next_since=events[-1]["seq"] if events and events[-1]["seq"] < log.last_seq else None,
+        first_seq=log.first_seq,
+        last_seq=log.last_seq
+    )
+
+
+@app.post("/api/shows", response_model=ShowInfo)
+async def start_show(show: Show):
+    """
+    Schedule a show: a timeline of commands for several candlesticks.
+    
+    Each candlestick receives its part of the show ahead of time and applies the commands
+    at the scheduled times using its estimate of the backend clock, so the candlesticks
+    stay in sync without sending commands while the show runs.
+    """
+    try:
+        validate_show(show)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not any(manager.is_connected(candlestick_id) for candlestick_id in show.candlesticks):
+        raise HTTPException(status_code=404, detail="None of the candlesticks in the show are connected")
+    
+    return await manager.start_show(uuid.uuid4().hex[:12], show)
+
+
+@app.get("/api/shows", response_model=List[ShowInfo])
+async def list_shows():
+    """
+    List scheduled shows, oldest first.
+    """
+    return list(manager.shows.values())
+
+
+@app.delete("/api/shows/{show_id}", response_model=ShowInfo)
+async def cancel_show(show_id: str):
+    """
+    Cancel a show. Commands already applied are not undone.
+    """
+    info = await manager.cancel_show(show_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Show not found")
+    return info
+
+
+@app.get("/api/commands/latency")
+async def command_latency():
+    """
+    Command latency histograms (seconds), measured from command acknowledgements.
+    """
+    return manager.get_latency_stats()
+
+
+async def handle_controller_message(candlestick_id: str, message: dict, decode_started: float):
+    """
+    Handle a decoded message from a controller, received directly or through a gateway.
+    
+    Args:
+        candlestick_id: Candlestick the message belongs to
+        message: The decoded JSON message
+        decode_started: perf_counter() when decoding started, for the decode time histogram
+    """
+    # Validate message has required 'type' field, before it is used as a metric label
+    msg_type = message.get("type") if isinstance(message, dict) else None
+    if not msg_type or not isinstance(msg_type, str):
+        logger.warning(f"Missing or invalid 'type' in message from {candlestick_id}")
+        return
+    manager.messages_in.inc(msg_type)
+    
+    if msg_type == MessageType.CLOCK_PING:
+        # Answered first and not logged, the reply time is part of the measured round trip
+        await manager.send_clock_pong(message, decode_started, candlestick_id=candlestick_id)
+        return
+    
+    if msg_type == MessageType.PROFILE_RESULT:
+        # Don't log the stacks
+        logger.info(f"Received profile from {candlestick_id}: {message.get('profile_id')} ({message.get('target')})")
+    else:
+        logger.info(f"Received from {candlestick_id}: {message}")
+    
+    # Handle different message types
+    if msg_type == MessageType.STATUS:
+        # Validate status message with Pydantic
+        try:
+            status = StatusMessage(**message)
+            manager.decode_time.observe(time.perf_counter() - decode_started)
+            if manager.handle_status(candlestick_id, status):
+                logger.info(f"Updated state for {candlestick_id}: program={status.program}, random={status.random}, speed={status.speed}, direction={status.direction}, color={status.color}")
+        except Exception as e:
+            logger.warning(f"Invalid status message from {candlestick_id}: {e}")
+        
+    elif msg_type == MessageType.RESYNC:
+        try:
+            resync = ResyncMessage(**message)
+            manager.decode_time.observe(time.perf_counter() - decode_started)
+            await manager.handle_resync(candlestick_id, resync)
+        except Exception as e:
+            logger.warning(f"Invalid resync message from {candlestick_id}: {e}")
+        
+    elif msg_type == MessageType.ACK:
+        try:
+            ack = AckMessage(**message)
+            manager.decode_time.observe(time.perf_counter() - decode_started)
+            manager.handle_ack(candlestick_id, ack)
+        except Exception as e:
+            logger.warning(f"Invalid ack message from {candlestick_id}: {e}")
+        
+    elif msg_type == MessageType.METRICS:
+        try:
+            controller_metrics = ControllerMetricsMessage(**message)
+            manager.decode_time.observe(time.perf_counter() - decode_started)
+            manager.update_controller_metrics(candlestick_id, controller_metrics)
+        except Exception as e:
+            logger.warning(f"Invalid metrics message from {candlestick_id}: {e}")
+        
+    elif msg_type == MessageType.PROFILE_RESULT:
+        try:
+            profile = ProfileResultMessage(**message)
+            manager.decode_time.observe(time.perf_counter() - decode_started)
+            manager.store_profile(candlestick_id, profile)
+        except Exception as e:
+            logger.warning(f"Invalid profile message from {candlestick_id}: {e}")
+        
+    elif msg_type == MessageType.HEARTBEAT:
+        # Just update last_seen timestamp
+        manager.decode_time.observe(time.perf_counter() - decode_started)
+        manager.update_heartbeat(candlestick_id)
+        
+    else:
+        logger.warning(f"Unknown message type from {candlestick_id}: {msg_type}")
 
 
 @app.websocket("/ws/{candlestick_id}")
@@ -146,11 +609,14 @@ async def websocket_endpoint(websocket: WebSocket, candlestick_id: str):
     """
     await manager.connect_controller(websocket, candlestick_id)
     logger.info(f"Candlestick '{candlestick_id}' connected")
+    await manager.send_offline_schedule(candlestick_id)
+    await manager.send_reset_policy(candlestick_id)
     
     try:
         while True:
             # Receive messages from the controller
             data = await websocket.receive_text()
+            decode_started = time.perf_counter()
             
             try:
                 message = json.loads(data)
@@ -158,52 +624,117 @@ async def websocket_endpoint(websocket: WebSocket, candlestick_id: str):
                 logger.warning(f"Invalid JSON from {candlestick_id}: {e}")
                 continue
             
-            # Validate message has required 'type' field
-            msg_type = message.get("type")
-            if not msg_type:
-                logger.warning(f"Missing 'type' in message from {candlestick_id}")
-                continue
-            
-            logger.info(f"Received from {candlestick_id}: {message}")
-            
-            # Handle different message types
-            if msg_type == MessageType.STATUS:
-                # Validate status message with Pydantic
-                try:
-                    status = StatusMessage(**message)
-                    manager.update_state(
-                        candlestick_id,
-                        program=status.program,
-                        random=status.random,
-                        speed=status.speed,
-                        direction=status.direction,
-                        color=status.color
-                    )
-                    logger.info(f"Updated state for {candlestick_id}: program={status.program}, random={status.random}, speed={status.speed}, direction={status.direction}, color={status.color}")
-                except Exception as e:
-                    logger.warning(f"Invalid status message from {candlestick_id}: {e}")
-                
-            elif msg_type == MessageType.HEARTBEAT:
-                # Just update last_seen timestamp
-                manager.update_heartbeat(candlestick_id)
-                
-            else:
-                logger.warning(f"Unknown message type from {candlestick_id}: {msg_type}")
+            await handle_controller_message(candlestick_id, message, decode_started)
                 
     except WebSocketDisconnect:
         logger.info(f"Candlestick '{candlestick_id}' disconnected")
-        manager.disconnect_controller(candlestick_id)
+        manager.disconnect_controller(candlestick_id, websocket)
     except Exception as e:
         logger.error(f"Error in WebSocket connection for {candlestick_id}: {e}")
-        manager.disconnect_controller(candlestick_id)
+        manager.disconnect_controller(candlestick_id, websocket)
+
+
+async def handle_gateway_message(gateway_id: str, message: dict, decode_started: float):
+    """Handle a decoded message from a gateway (one of possibly several in a batch)"""
+    msg_type = message.get("type") if isinstance(message, dict) else None
+    if not msg_type or not isinstance(msg_type, str):
+        logger.warning(f"Missing or invalid 'type' in message from gateway {gateway_id}")
+        return
+    
+    if msg_type in (MessageType.ATTACH, MessageType.DETACH):
+        manager.messages_in.inc(msg_type)
+        try:
+            attach = AttachMessage(**message)
+        except Exception as e:
+            logger.warning(f"Invalid {msg_type} message from gateway {gateway_id}: {e}")
+            return
+        if msg_type == MessageType.ATTACH:
+            manager.attach_candlesticks(gateway_id, attach.candlestick_ids)
+            for candlestick_id in attach.candlestick_ids:
+                await manager.send_offline_schedule(candlestick_id)
+                await manager.send_reset_policy(candlestick_id)
+        else:
+            manager.detach_candlesticks(gateway_id, attach.candlestick_ids)
+        return
+    
+    if msg_type == MessageType.BATCH:
+        manager.messages_in.inc(msg_type)
+        try:
+            batch = BatchMessage(**message)
+        except Exception as e:
+            logger.warning(f"Invalid batch message from gateway {gateway_id}: {e}")
+            return
+        for batched in batch.messages:
+            if batched.get("type") == MessageType.BATCH:
+                logger.warning(f"Nested batch from gateway {gateway_id} ignored")
+                continue
+            await handle_gateway_message(gateway_id, batched, decode_started)
+        return
+    
+    candlestick_id = message.pop("candlestick_id", None)
+    if candlestick_id is not None and not isinstance(candlestick_id, str):
+        logger.warning(f"Invalid 'candlestick_id' in {msg_type} message from gateway {gateway_id}")
+        return
+    if candlestick_id is None:
+        if msg_type == MessageType.CLOCK_PING:
+            # One clock for the whole gateway
+            manager.messages_in.inc(msg_type)
+            await manager.send_clock_pong(message, decode_started, gateway_id=gateway_id)
+        elif msg_type == MessageType.HEARTBEAT:
+            # One heartbeat covers every candlestick behind the gateway
+            manager.messages_in.inc(msg_type)
+            for attached_id in manager.gateway_candlesticks(gateway_id):
+                manager.update_heartbeat(attached_id)
+        else:
+            logger.warning(f"Missing 'candlestick_id' in {msg_type} message from gateway {gateway_id}")
+        return
+    
+    if not manager.is_attached(gateway_id, candlestick_id):
+        logger.warning(f"Message for candlestick '{candlestick_id}' not attached to gateway {gateway_id}")
+        return
+    
+    await handle_controller_message(candlestick_id, message, decode_started)
+
+
+@app.websocket("/ws/gateway/{gateway_id}")
+async def gateway_endpoint(websocket: WebSocket, gateway_id: str):
+    """
+    Multiplexed WebSocket endpoint for controllers (gateways) driving several candlesticks.
+    
+    One connection carries the messages of every candlestick attached to it. Messages in
+    both directions carry a `candlestick_id`, except heartbeats from the gateway which
+    cover all of its candlesticks.
+    """
+    await manager.connect_gateway(websocket, gateway_id)
+    
+    try:
+        while True:
+            data = await websocket.receive_text()
+            decode_started = time.perf_counter()
+            
+            try:
+                message = json.loads(data)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Invalid JSON from gateway {gateway_id}: {e}")
+                continue
+            
+            await handle_gateway_message(gateway_id, message, decode_started)
+            
+    except WebSocketDisconnect:
+        logger.info(f"Gateway '{gateway_id}' disconnected")
+    except Exception as e:
+        logger.error(f"Error in WebSocket connection for gateway {gateway_id}: {e}")
+    finally:
+        manager.disconnect_gateway(gateway_id, websocket)
 
 
 # Serve static files for the web frontend (MUST be last!)
 # This serves the user-facing web interface
 # All API routes are at /api/* and WebSocket at /ws/* so they won't be affected
-static_dir = os.path.join(os.path.dirname(__file__), "static")
+# Hashed bundle files are cached forever, see static_files.py
+static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
 if os.path.isdir(static_dir):
-    app.mount("/", StaticFiles(directory="static", html=True), name="static")
+    app.mount("/", FrontendFiles(directory=static_dir, html=True), name="static")
     logger.info(f"Serving web frontend from '{static_dir}'")
 else:
     logger.warning(f"Static directory not found at '{static_dir}' - web frontend not available")
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Throughput of the backend under each server tuning profile of serve.py.
+
+Each profile runs the backend in a fresh process on a free port. For the given time,
+HTTP_CLIENTS keep-alive connections request API and static paths one after the other,
+and CONTROLLERS WebSocket connections exchange clock pings with the backend. Requests
+per second depend on the machine running the clients as well, so requests per CPU-second
+of the backend process (user + system time) are reported too: that is what a core of
+the box can serve.
+
+Run from backend/: `python benchmark_server.py [seconds] [profiles...]`,
+e.g. `python benchmark_server.py 10 development production`
+"""
+
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import websockets
+
+from serve import SERVER_PROFILES
+
+HTTP_CLIENTS = 32
+CONTROLLERS = 8
+# Requested in turn by every HTTP client, "/" is the frontend when the static directory exists
+PATHS = ("/api/health", "/api/candlesticks", "/")
+STARTUP_TIMEOUT_SECONDS = 20
+CONTENT_LENGTH = re.compile(rb"\r\ncontent-length: *(\d+)", re.IGNORECASE)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system time of a process"""
+    with open(f"/proc/{pid}/stat") as f:
+        # Fields after the command name, which may contain spaces: utime and stime are the 12th and 13th
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def wait_until_up(port: int):
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"Backend didn't start listening on port {port}")
+
+
+async def http_client(port: int, deadline: float, counts: dict):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    index = 0
+    try:
+        while time.monotonic() < deadline:
+            path = PATHS[index % len(PATHS)]
+            index += 1
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: gzip, br\r\n\r\n".encode())
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = CONTENT_LENGTH.search(head)
+            await reader.readexactly(int(length.group(1)) if length else 0)
+            counts["requests"] += 1
+    finally:
+        writer.close()
+
+
+async def controller(port: int, index: int, deadline: float, counts: dict):
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws/benchmark{index}") as websocket:
+        seq = 0
+        while time.monotonic() < deadline:
+            seq += 1
+            await websocket.send(json.dumps({"type": "clock_ping", "seq": seq, "t0": time.time()}))
+            # Skip anything other than the pong, e.g. an offline schedule
+            while json.loads(await websocket.recv()).get("type") != "clock_pong":
+                pass
+            counts["pings"] += 1
+
+
+async def load(port: int, seconds: float, pid: int):
+    await wait_until_up(port)
+    counts = {"requests": 0, "pings": 0}
+    cpu_before = cpu_seconds(pid)
+    deadline = time.monotonic() + seconds
+    await asyncio.gather(
+        *(http_client(port, deadline, counts) for _ in range(HTTP_CLIENTS)),
+        *(controller(port, index, deadline, counts) for index in range(CONTROLLERS))
+    )
+    return counts, cpu_seconds(pid) - cpu_before
+
+
+def benchmark(profile: str, seconds: float):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "serve.py"],
+        env={**os.environ, "SERVER_PROFILE": profile, "HOST": "127.0.0.1", "PORT": str(port)},
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    try:
+        # The first line names the loop and HTTP parser in use
+        print(f"  {profile:<12} {process.stdout.readline().split('profile: ')[-1].strip()}")
+        # Keep reading the output (e.g. the access log) so the backend never blocks writing it
+        threading.Thread(target=process.stdout.read, daemon=True).start()
+        counts, cpu = asyncio.run(load(port, seconds, process.pid))
+    finally:
+        process.terminate()
+        process.wait()
+    total = counts["requests"] + counts["pings"]
+    print(f"  {'':<12} {counts['requests'] / seconds:8.0f} HTTP requests/s  {counts['pings'] / seconds:8.0f} pings/s  "
+          f"backend CPU {cpu / seconds * 100:5.1f}%  {total / cpu if cpu else 0:8.0f} requests + pings per CPU-second")
+
+
+if __name__ == "__main__":
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    profiles = sys.argv[2:] or list(SERVER_PROFILES)
+    print(f"{HTTP_CLIENTS} HTTP clients and {CONTROLLERS} controllers for {seconds}s")
+    for profile in profiles:
+        benchmark(profile, seconds)
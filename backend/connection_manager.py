@@ -4,23 +4,181 @@ Manages active WebSocket connections and candlestick states.
 """
 
 from fastapi import WebSocket
-from typing import Dict, Optional
+from typing import Deque, Dict, List, Optional, Tuple
+from collections import deque
 from datetime import datetime, timedelta
 import logging
 import asyncio
 import json
+import time
 
-from models import CandlestickState, CandlestickCommand, MessageType
+from models import (
+    CandlestickState,
+    CandlestickCommand,
+    MessageType,
+    AckMessage,
+    StatusMessage,
+    ControllerMetricsMessage,
+    ProfileResultMessage,
+    ProfileInfo,
+    ResyncMessage,
+    OfflineSchedule,
+    Show,
+    ShowInfo,
+    DesiredState,
+    DesiredStateInfo,
+    ResetPolicy
+)
+from shows import compile_show
+from desired_state import desired_changes
+from metrics import MetricsRegistry, FAST_BUCKETS, LATENCY_BUCKETS, render_per_candlestick
+from outbound import ConnectionWriter, OutboundMessage, QueueFull, DROP_OLDEST, DROP_POLICIES, DROP_REASONS
+from events import EventStore
+
+# Maximum number of commands waiting for an ack before the oldest are forgotten
+MAX_PENDING_ACKS = 1000
+# Number of profiles kept per candlestick (each profile has one entry per target)
+MAX_PROFILES_PER_CANDLESTICK = 10
+# Number of shows kept (oldest are forgotten first)
+MAX_SHOWS = 50
+# State fields a controller may change with a resync
+RESYNC_FIELDS = ("program", "random", "speed", "direction", "color")
+# Commands sent per second to a candlestick, commands arriving faster are merged
+DEFAULT_COMMAND_RATE = 10.0
+# Messages other than commands that may wait for a controller connection
+DEFAULT_QUEUE_SIZE = 100
+# Seconds a write to a controller may take before the connection is considered dead
+DEFAULT_WRITE_TIMEOUT = 5.0
+# Command fields selecting what the candlestick shows, setting one replaces the others
+MODE_FIELDS = ("program", "color")
+# State fields whose changes are recorded in the event log
+EVENT_STATE_FIELDS = ("program", "random", "speed", "direction", "color")
 
 logger = logging.getLogger(__name__)
 
 
+def merge_commands(earlier: CandlestickCommand, later: CandlestickCommand) -> CandlestickCommand:
+    """One command with the effect of applying both, fields of the later command win"""
+    fields = earlier.model_dump(exclude_none=True, exclude={"start_at"})
+    update = later.model_dump(exclude_none=True)
+    if any(field in update for field in MODE_FIELDS):
+        for field in MODE_FIELDS:
+            fields.pop(field, None)
+    fields.update(update)
+    return CandlestickCommand(**fields)
+
+
+def command_state(state: CandlestickState, command: CandlestickCommand) -> Dict:
+    """
+    The state after a controller applies a command (as in the controller's handle_backend_command),
+    as update_state arguments. In random mode the program is reported by the controller later.
+    """
+    fields = {field: getattr(state, field) for field in ("program", "random", "speed", "direction", "color")}
+    if command.direction is not None:
+        fields["direction"] = command.direction
+    if command.program is not None:
+        fields["random"] = command.program == "random"
+        fields["color"] = None
+        if not fields["random"]:
+            fields["program"] = command.program
+    if command.speed is not None:
+        fields["speed"] = command.speed
+    if command.color is not None:
+        fields.update(program="static_color", direction=None, random=False, color=command.color)
+    return fields
+
+
+class PendingCommand(OutboundMessage):
+    """A command that has been sent to a controller but not yet acknowledged"""
+
+    def __init__(
+        self,
+        seq: int,
+        candlestick_id: str,
+        command: CandlestickCommand,
+        wait: bool = False,
+        message_type: MessageType = MessageType.COMMAND
+    ):
+        super().__init__()
+        self.seq = seq
+        self.candlestick_id = candlestick_id
+        self.command = command
+        # COMMAND restarts the program even if unchanged, DESIRED_STATE only converges to the fields
+        self.message_type = message_type
+        self.sent_at = time.monotonic()
+        self.acked_at: Optional[float] = None
+        # Only created when someone waits for the ack, resolves to the AckMessage
+        self.future: Optional[asyncio.Future] = asyncio.get_running_loop().create_future() if wait else None
+        # Earlier commands merged into this one before they were sent, written and acknowledged with it
+        self.merged: List["PendingCommand"] = []
+
+    def absorb(self, earlier: "PendingCommand"):
+        """Merge an earlier command that wasn't sent yet into this one"""
+        self.command = merge_commands(earlier.command, self.command)
+        if earlier.message_type == MessageType.COMMAND:
+            self.message_type = MessageType.COMMAND
+        self.merged = earlier.merged + [earlier]
+        earlier.merged = []
+
+    def done(self, written: bool):
+        """Resolve the written future of this command and of the commands merged into it"""
+        for pending in [self] + self.merged:
+            OutboundMessage.done(pending, written)
+
+    def resolve(self, ack: AckMessage):
+        """Record the ack of this command and of the commands merged into it"""
+        self.acked_at = time.monotonic()
+        for pending in [self] + self.merged:
+            pending.acked_at = self.acked_at
+            if pending.future is not None and not pending.future.done():
+                pending.future.set_result(ack)
+
+    def fail(self, error: Exception):
+        """Fail this command and the commands merged into it for whoever waits for the ack"""
+        for pending in [self] + self.merged:
+            if pending.future is not None and not pending.future.done():
+                pending.future.set_exception(error)
+
+
 class ConnectionManager:
-    """Manages WebSocket connections and candlestick states"""
+    """
+    Manages WebSocket connections and candlestick states
     
-    def __init__(self):
+    Args:
+        command_rate: Commands sent per second to a candlestick, 0 for no limit
+        queue_size: Messages other than commands that may wait for a controller connection
+        drop_policy: What to do when a controller's queue is full, see outbound.DROP_POLICIES
+        write_timeout: Seconds a write to a controller may take before the connection is closed, 0 for no limit
+        events: Event log of the candlesticks, kept in memory only if None
+    """
+    
+    def __init__(
+        self,
+        command_rate: float = DEFAULT_COMMAND_RATE,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        drop_policy: str = DROP_OLDEST,
+        write_timeout: float = DEFAULT_WRITE_TIMEOUT,
+        events: Optional[EventStore] = None
+    ):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy '{drop_policy}', expected one of {', '.join(DROP_POLICIES)}")
+        self.writer_options = {
+            "rate": command_rate,
+            "queue_size": queue_size,
+            "drop_policy": drop_policy,
+            "write_timeout": write_timeout,
+        }
         # Active controller WebSocket connections: candlestick_id -> WebSocket
+        # (candlesticks behind a gateway share the gateway's WebSocket)
         self.controller_connections: Dict[str, WebSocket] = {}
+        # Writer of each controller connection: candlestick_id -> ConnectionWriter
+        # (candlesticks behind a gateway share the gateway's writer)
+        self.writers: Dict[str, ConnectionWriter] = {}
+        # Active gateway WebSocket connections: gateway_id -> WebSocket
+        self.gateway_connections: Dict[str, WebSocket] = {}
+        self.gateway_writers: Dict[str, ConnectionWriter] = {}
+        # Candlesticks connected through a gateway: candlestick_id -> gateway_id
+        self.gateway_routes: Dict[str, str] = {}
         # Active web client WebSocket connections: client_id -> WebSocket
         self.web_client_connections: Dict[str, WebSocket] = {}
         # Candlestick states: candlestick_id -> CandlestickState
@@ -29,40 +187,281 @@ class ConnectionManager:
         self._lock = asyncio.Lock()
         # Counter for web client IDs
         self._client_id_counter = 0
+        # Sequence counter for commands sent to controllers
+        self._command_seq = 0
+        # Commands waiting for an ack: seq -> PendingCommand (insertion ordered, oldest first)
+        self.pending_acks: Dict[int, PendingCommand] = {}
+        # Latest metrics pushed by each controller: candlestick_id -> {name: value}
+        self.controller_metrics: Dict[str, Dict[str, float]] = {}
+        # Profiles uploaded by controllers: candlestick_id -> (info, collapsed stacks), oldest first
+        self.profiles: Dict[str, Deque[Tuple[ProfileInfo, Optional[str]]]] = {}
+        # Scheduled shows: show_id -> ShowInfo (insertion ordered, oldest first)
+        self.shows: Dict[str, ShowInfo] = {}
+        # Revision of the controller's state cache the state corresponds to: candlestick_id -> (epoch, revision)
+        self.reported_revisions: Dict[str, Tuple[str, int]] = {}
+        # Sequence ID of the latest command acknowledged by each candlestick
+        self.acked_seqs: Dict[str, int] = {}
+        # Commands applied by time of day while a controller is offline: candlestick_id -> OfflineSchedule
+        self.offline_schedules: Dict[str, OfflineSchedule] = {}
+        # What each candlestick resets to after inactivity, sent on every connect: candlestick_id -> ResetPolicy
+        self.reset_policies: Dict[str, ResetPolicy] = {}
+        # When candlesticks removed as stale were last seen, their settings above are dropped after a while
+        self.gone_since: Dict[str, datetime] = {}
+        # State each candlestick should be in, converged to when set and after every reconnect: candlestick_id -> DesiredState
+        self.desired_states: Dict[str, DesiredState] = {}
+        # Commands, acks, status changes, connects and disconnects of each candlestick
+        self.events = events if events is not None else EventStore()
+        self._init_metrics()
+    
+    def _init_metrics(self):
+        """Preallocate all backend metrics"""
+        self.metrics = MetricsRegistry()
+        message_types = [message_type.value for message_type in MessageType]
+        self.metrics.gauge(
+            "candlestick_controllers_connected", "Connected controllers",
+            callback=lambda: len(self.controller_connections)
+        )
+        self.metrics.gauge(
+            "candlestick_gateways_connected", "Connected gateways (multiplexed controller connections)",
+            callback=lambda: len(self.gateway_connections)
+        )
+        self.metrics.gauge(
+            "candlestick_web_clients_connected", "Connected web clients",
+            callback=lambda: len(self.web_client_connections)
+        )
+        self.messages_in = self.metrics.counter(
+            "candlestick_messages_in_total", "Messages received from controllers",
+            label="type", label_values=message_types
+        )
+        self.messages_out = self.metrics.counter(
+            "candlestick_messages_out_total", "Messages sent to controllers and web clients",
+            label="type", label_values=message_types
+        )
+        self.decode_time = self.metrics.histogram(
+            "candlestick_message_decode_seconds", "Time to decode and validate a controller message",
+            buckets=FAST_BUCKETS
+        )
+        # Command latency histograms (seconds)
+        self.command_latency = self.metrics.histogram(
+            "candlestick_command_latency_seconds", "Backend send to ack received"
+        )
+        self.apply_latency = self.metrics.histogram(
+            "candlestick_command_apply_seconds", "Controller receive to command applied"
+        )
+        self.first_frame_latency = self.metrics.histogram(
+            "candlestick_command_first_frame_seconds", "Controller receive to first frame written"
+        )
+        self.stale_updates = self.metrics.counter(
+            "candlestick_stale_updates_dropped_total", "Status updates and acks older than the state already known",
+            label="type", label_values=[MessageType.STATUS.value, MessageType.ACK.value]
+        )
+        self.commands_coalesced = self.metrics.counter(
+            "candlestick_commands_coalesced_total", "Commands merged into a later command for the same candlestick before being sent"
+        )
+        self.messages_dropped = self.metrics.counter(
+            "candlestick_outbound_messages_dropped_total", "Messages for controllers that were never written",
+            label="reason", label_values=DROP_REASONS
+        )
+        self.metrics.gauge(
+            "candlestick_outbound_queue_depth", "Messages and commands waiting to be written to controllers",
+            callback=lambda: sum(len(writer.messages) + len(writer.commands) for writer in self._all_writers())
+        )
+        self.broadcast_queue_depth = self.metrics.gauge(
+            "candlestick_broadcast_queue_depth", "Web client sends in progress"
+        )
+        self.event_loop_lag = self.metrics.histogram(
+            "candlestick_event_loop_lag_seconds", "How late the backend event loop wakes up from a timed sleep",
+            buckets=FAST_BUCKETS + LATENCY_BUCKETS[3:]
+        )
+        self.cleanup_scan_time = self.metrics.histogram(
+            "candlestick_cleanup_scan_seconds", "Time spent scanning for stale candlestick states",
+            buckets=FAST_BUCKETS
+        )
+    
+    def _all_writers(self) -> List[ConnectionWriter]:
+        """Writers of all connections, each once"""
+        return list({id(writer): writer for writer in self.writers.values()}.values())
+    
+    def _create_writer(self, websocket: WebSocket, name: str) -> ConnectionWriter:
+        return ConnectionWriter(
+            websocket, name, **self.writer_options,
+            on_sent=lambda message: self.messages_out.inc(message["type"]),
+            on_drop=self.messages_dropped.inc
+        )
     
     async def connect_controller(self, websocket: WebSocket, candlestick_id: str):
         """Accept a new controller WebSocket connection and initialize state"""
         await websocket.accept()
         
         async with self._lock:
-            self.controller_connections[candlestick_id] = websocket
-            
-            # Initialize or update state
-            if candlestick_id in self.states:
-                # Reconnection - update existing state
-                self.states[candlestick_id].connected = True
-                self.states[candlestick_id].last_seen = datetime.now()
-            else:
-                # New connection - create new state
-                self.states[candlestick_id] = CandlestickState(
-                    id=candlestick_id,
-                    connected=True,
-                    last_seen=datetime.now()
-                )
+            self._register_controller(websocket, self._create_writer(websocket, candlestick_id), candlestick_id)
         
         logger.info(f"Controller '{candlestick_id}' connected. Total controllers: {len(self.controller_connections)}")
     
-    def disconnect_controller(self, candlestick_id: str):
-        """Remove a controller WebSocket connection and mark as disconnected"""
+    def _register_controller(self, websocket: WebSocket, writer: ConnectionWriter, candlestick_id: str, gateway_id: Optional[str] = None):
+        """Route a candlestick to a WebSocket and initialize or update its state"""
+        previous = self.writers.get(candlestick_id)
+        if previous is not None and previous is not writer:
+            # Moved to another connection: commands buffered on the old one are sent on the new one
+            buffered = previous.discard(candlestick_id)
+            if buffered is not None:
+                writer.put(candlestick_id, buffered)
+            if candlestick_id not in self.gateway_routes:
+                # A direct connection the controller has left, its receive loop may not have noticed yet
+                previous.close(websocket=True)
+        self.controller_connections[candlestick_id] = websocket
+        self.writers[candlestick_id] = writer
+        self.gone_since.pop(candlestick_id, None)
+        if gateway_id is None:
+            self.gateway_routes.pop(candlestick_id, None)
+        else:
+            self.gateway_routes[candlestick_id] = gateway_id
+        
+        # Initialize or update state
+        if candlestick_id in self.states:
+            # Reconnection - update existing state
+            self.states[candlestick_id].connected = True
+            self.states[candlestick_id].gateway = gateway_id
+            self.states[candlestick_id].last_seen = datetime.now()
+        else:
+            # New connection - create new state
+            self.states[candlestick_id] = CandlestickState(
+                id=candlestick_id,
+                connected=True,
+                gateway=gateway_id,
+                last_seen=datetime.now()
+            )
+        self.events.append(candlestick_id, "connected", gateway=gateway_id)
+    
+    def disconnect_controller(self, candlestick_id: str, websocket: Optional[WebSocket] = None):
+        """
+        Remove a controller WebSocket connection and mark as disconnected.
+        With websocket given, nothing happens if the controller has already reconnected on another connection.
+        """
+        if websocket is not None and self.controller_connections.get(candlestick_id) is not websocket:
+            return
         if candlestick_id in self.controller_connections:
             del self.controller_connections[candlestick_id]
+            self.events.append(candlestick_id, "disconnected")
+        writer = self.writers.pop(candlestick_id, None)
+        if writer is not None:
+            if candlestick_id in self.gateway_routes:
+                # The gateway's writer is closed with the gateway
+                writer.discard(candlestick_id)
+            else:
+                writer.close()
+        self.gateway_routes.pop(candlestick_id, None)
         
         if candlestick_id in self.states:
             self.states[candlestick_id].connected = False
             self.states[candlestick_id].last_seen = datetime.now()
         
+        # Commands to this controller will never be acknowledged now
+        for seq in [seq for seq, pending in self.pending_acks.items() if pending.candlestick_id == candlestick_id]:
+            self.pending_acks.pop(seq).fail(ConnectionError(f"Candlestick '{candlestick_id}' disconnected"))
+        
         logger.info(f"Controller '{candlestick_id}' disconnected. Remaining controllers: {len(self.controller_connections)}")
     
+    async def connect_gateway(self, websocket: WebSocket, gateway_id: str):
+        """Accept a new gateway WebSocket connection. Candlesticks are attached with attach_candlesticks()."""
+        await websocket.accept()
+        
+        async with self._lock:
+            if gateway_id in self.gateway_connections:
+                # The gateway reconnected before the old connection was noticed as closed
+                self.detach_candlesticks(gateway_id, self.gateway_candlesticks(gateway_id))
+                self.gateway_writers.pop(gateway_id).close()
+            self.gateway_connections[gateway_id] = websocket
+            self.gateway_writers[gateway_id] = self._create_writer(websocket, gateway_id)
+        
+        logger.info(f"Gateway '{gateway_id}' connected. Total gateways: {len(self.gateway_connections)}")
+    
+    def attach_candlesticks(self, gateway_id: str, candlestick_ids: List[str]):
+        """Route commands for the candlesticks over the gateway's connection"""
+        websocket = self.gateway_connections[gateway_id]
+        writer = self.gateway_writers[gateway_id]
+        for candlestick_id in candlestick_ids:
+            self._register_controller(websocket, writer, candlestick_id, gateway_id)
+        logger.info(f"Gateway '{gateway_id}' attached {len(candlestick_ids)} candlesticks. Total controllers: {len(self.controller_connections)}")
+    
+    def detach_candlesticks(self, gateway_id: str, candlestick_ids: List[str]):
+        """Mark candlesticks behind a gateway as disconnected"""
+        for candlestick_id in candlestick_ids:
+            # A candlestick may have moved to another connection in the meantime
+            if self.gateway_routes.get(candlestick_id) == gateway_id:
+                self.disconnect_controller(candlestick_id)
+    
+    def disconnect_gateway(self, gateway_id: str, websocket: Optional[WebSocket] = None):
+        """
+        Remove a gateway connection and disconnect all candlesticks behind it.
+        With websocket given, nothing happens if the gateway has already reconnected on another connection.
+        """
+        if websocket is not None and self.gateway_connections.get(gateway_id) is not websocket:
+            return
+        self.gateway_connections.pop(gateway_id, None)
+        self.detach_candlesticks(gateway_id, self.gateway_candlesticks(gateway_id))
+        writer = self.gateway_writers.pop(gateway_id, None)
+        if writer is not None:
+            writer.close()
+        logger.info(f"Gateway '{gateway_id}' disconnected. Remaining gateways: {len(self.gateway_connections)}")
+    
+    def gateway_candlesticks(self, gateway_id: str) -> List[str]:
+        """Candlesticks currently connected through a gateway"""
+        return [candlestick_id for candlestick_id, routed_to in self.gateway_routes.items() if routed_to == gateway_id]
+    
+    def is_attached(self, gateway_id: str, candlestick_id: str) -> bool:
+        """Check if a candlestick is connected through the gateway"""
+        return self.gateway_routes.get(candlestick_id) == gateway_id
+    
+    async def send_to_controller(self, candlestick_id: str, message: dict) -> OutboundMessage:
+        """
+        Queue a message for a controller, tagged with the candlestick ID when it goes through a gateway.
+        It is written by the connection's writer task, await the returned message's written future to wait for it.
+        
+        Raises:
+            ValueError: If the candlestick is not connected
+            ConnectionError: If the connection to the candlestick is broken
+            outbound.QueueFull: If the connection's queue is full and the drop policy is 'reject'
+        """
+        if candlestick_id not in self.controller_connections:
+            raise ValueError(f"Candlestick '{candlestick_id}' is not connected")
+        
+        if candlestick_id in self.gateway_routes:
+            message = {**message, "candlestick_id": candlestick_id}
+        return self.writers[candlestick_id].send(message)
+    
+    async def send_clock_pong(
+        self,
+        ping: dict,
+        received_perf: float,
+        candlestick_id: Optional[str] = None,
+        gateway_id: Optional[str] = None
+    ):
+        """
+        Answer a clock_ping from a controller or gateway (NTP style).
+        
+        Args:
+            ping: The clock_ping message, with the controller's send time t0
+            received_perf: perf_counter() when the ping was received
+            candlestick_id: Controller that sent the ping
+            gateway_id: Gateway that sent the ping (answered without a candlestick_id)
+        """
+        # Backend receive time, corrected for the time spent decoding since
+        t1 = time.time() - (time.perf_counter() - received_perf)
+        pong = {
+            "type": MessageType.CLOCK_PONG,
+            "seq": ping.get("seq"),
+            "t0": ping.get("t0"),
+            "t1": t1,
+        }
+        # The send time is taken when the writer sends the pong, not when it is queued
+        writer = self.gateway_writers[gateway_id] if gateway_id is not None else self.writers[candlestick_id]
+        try:
+            writer.send(lambda: {**pong, "t2": time.time()})
+        except (QueueFull, ConnectionError) as e:
+            # The controller pings again, a lost pong is just a lost sample
+            logger.warning(f"Dropped clock pong to {gateway_id or candlestick_id}: {e}")
+    
     async def connect_web_client(self, websocket: WebSocket) -> str:
         """Accept a new web client WebSocket connection"""
         await websocket.accept()
@@ -83,7 +482,16 @@ class ConnectionManager:
         logger.info(f"Web client '{client_id}' disconnected. Remaining web clients: {len(self.web_client_connections)}")
     
     async def disconnect_all(self):
-        """Disconnect all active connections (both controllers and web clients)"""
+        """Disconnect all active connections (controllers, gateways and web clients)"""
+        # Disconnect gateways (and the candlesticks behind them)
+        for gateway_id in list(self.gateway_connections.keys()):
+            try:
+                await self.gateway_connections[gateway_id].close()
+            except Exception as e:
+                logger.error(f"Error closing gateway connection for {gateway_id}: {e}")
+            finally:
+                self.disconnect_gateway(gateway_id)
+        
         # Disconnect controllers
         for candlestick_id in list(self.controller_connections.keys()):
             try:
@@ -123,14 +531,17 @@ class ConnectionManager:
         random: Optional[bool] = None,
         speed: Optional[int] = None,
         direction: Optional[str] = None,
-        color: Optional[str] = None
+        color: Optional[str] = None,
+        timing: Optional[Dict] = None,
+        source: str = "status"
     ):
-        """Update the state of a candlestick"""
+        """Update the state of a candlestick, changes are recorded in the event log with their source"""
         if candlestick_id not in self.states:
             logger.warning(f"Attempted to update state for unknown candlestick: {candlestick_id}")
             return
         
         state = self.states[candlestick_id]
+        before = {field: getattr(state, field) for field in EVENT_STATE_FIELDS}
         
         # Always update these fields (they can be None to clear the value)
         state.program = program if program is not None else state.program
@@ -142,42 +553,431 @@ class ConnectionManager:
             state.random = random
         if speed is not None:
             state.speed = speed
+        if timing is not None:
+            state.timing = timing
+        
+        state.last_seen = datetime.now()
+        self._record_changes(candlestick_id, before, source)
+    
+    def _record_changes(self, candlestick_id: str, before: Dict, source: str):
+        """Record the state fields that differ from before in the event log"""
+        state = self.states[candlestick_id]
+        changes = {field: getattr(state, field) for field in EVENT_STATE_FIELDS if getattr(state, field) != before[field]}
+        if changes:
+            state.version += 1
+            self.events.append(candlestick_id, "status", source=source, changes=changes)
+    
+    def set_reported_revision(self, candlestick_id: str, epoch: Optional[str], revision: Optional[int]):
+        """Remember which revision of the controller's state cache the state corresponds to"""
+        if epoch is not None and revision is not None and candlestick_id in self.states:
+            self.reported_revisions[candlestick_id] = (epoch, revision)
+    
+    def is_stale(self, candlestick_id: str, epoch: Optional[str], revision: Optional[int], inclusive: bool = False) -> bool:
+        """
+        Whether a revision of the controller's state cache is older than the one the state corresponds to
+        (or the same one, when inclusive). Revisions of another epoch (a new cache) and updates without
+        a revision (older controllers) are never stale.
+        """
+        known = self.reported_revisions.get(candlestick_id)
+        if known is None or epoch is None or revision is None or epoch != known[0]:
+            return False
+        return revision <= known[1] if inclusive else revision < known[1]
+    
+    def handle_status(self, candlestick_id: str, status: StatusMessage) -> bool:
+        """
+        Apply a status update from a controller, unless it is older than the state already known
+        (e.g. delivered late after a reconnect). Returns whether it was applied.
+        """
+        if self.is_stale(candlestick_id, status.epoch, status.revision):
+            self.stale_updates.inc(MessageType.STATUS.value)
+            logger.info(f"Dropped stale status of {candlestick_id}: revision {status.revision} is older than {self.reported_revisions[candlestick_id]}")
+            return False
+        self.update_state(
+            candlestick_id,
+            program=status.program,
+            random=status.random,
+            speed=status.speed,
+            direction=status.direction,
+            color=status.color,
+            timing=status.timing
+        )
+        self.set_reported_revision(candlestick_id, status.epoch, status.revision)
+        return True
+    
+    def is_applied(self, candlestick_id: str, command: CandlestickCommand) -> bool:
+        """
+        Whether a command wouldn't change the state: the candlestick shows what it asks for
+        and no other command for it is waiting. Timed commands (start_at) always change it.
+        """
+        state = self.states.get(candlestick_id)
+        if state is None or command.start_at is not None or any(
+            pending.candlestick_id == candlestick_id for pending in self.pending_acks.values()
+        ):
+            return False
+        if command.program is not None:
+            if command.program == "random" and not state.random:
+                return False
+            if command.program != "random" and (state.random or command.program != state.program):
+                return False
+        if command.color is not None and (state.color or "").lower() != command.color.lower():
+            return False
+        if command.speed is not None and command.speed != state.speed:
+            return False
+        return command.direction is None or command.direction == state.direction
+    
+    async def handle_resync(self, candlestick_id: str, resync: ResyncMessage):
+        """
+        Apply the state changes a controller sends after (re)connecting.
+        Changes since a revision that isn't the one known here (e.g. after a backend restart)
+        can't be applied: the controller is asked for the changes since the known revision
+        instead, or for its whole state when none is known.
+        """
+        state = self.states.get(candlestick_id)
+        if state is None:
+            logger.warning(f"Resync for unknown candlestick: {candlestick_id}")
+            return
         
+        known = self.reported_revisions.get(candlestick_id)
+        if resync.base is not None and known != (resync.epoch, resync.base):
+            epoch, revision = known or (None, None)
+            logger.info(f"Resync of {candlestick_id} from revision {resync.base} doesn't apply to {known}, requesting changes since {revision}")
+            try:
+                await self.send_to_controller(candlestick_id, {"type": MessageType.SYNC, "epoch": epoch, "revision": revision})
+            except (QueueFull, ConnectionError) as e:
+                # The controller asks again with its next resync
+                logger.error(f"Failed to send sync request to {candlestick_id}: {e}")
+            return
+        
+        before = {field: getattr(state, field) for field in EVENT_STATE_FIELDS}
+        for field, value in resync.changes.items():
+            if field in RESYNC_FIELDS:
+                setattr(state, field, value)
         state.last_seen = datetime.now()
+        self._record_changes(candlestick_id, before, "resync")
+        self.reported_revisions[candlestick_id] = (resync.epoch, resync.revision)
+        logger.info(f"Resynced {candlestick_id} from revision {resync.base} to {resync.revision}: {resync.changes}")
+        await self.converge_desired_state(candlestick_id)
+    
+    def desired_state_info(self, candlestick_id: str, seq: Optional[int] = None) -> Optional[DesiredStateInfo]:
+        """The desired state of a candlestick and the fields its reported state differs in"""
+        desired = self.desired_states.get(candlestick_id)
+        if desired is None:
+            return None
+        state = self.states.get(candlestick_id)
+        differences = desired_changes(desired, state) if state is not None else desired_changes(desired)
+        return DesiredStateInfo(desired=desired, converged=not differences, differences=differences, seq=seq)
+    
+    async def set_desired_state(
+        self,
+        candlestick_id: str,
+        desired: DesiredState,
+        wait: bool = False,
+        timeout: float = 5.0
+    ) -> Optional[PendingCommand]:
+        """
+        Store the desired state of a candlestick and send it if connected (all fields: commands
+        still in flight may change the reported state). Returns the sent message, None if not connected.
+        Raises like send_command.
+        """
+        self.desired_states[candlestick_id] = desired
+        if not self.is_connected(candlestick_id):
+            return None
+        command = CandlestickCommand(**desired_changes(desired))
+        return await self.send_command(candlestick_id, command, wait=wait, timeout=timeout, message_type=MessageType.DESIRED_STATE)
+    
+    async def converge_desired_state(self, candlestick_id: str):
+        """
+        Send a controller the fields of its desired state its reported state differs in, e.g. after a reconnect.
+        Sent (empty) when converged as well, the controller holds a desired state instead of resetting it.
+        """
+        info = self.desired_state_info(candlestick_id)
+        if info is None:
+            return
+        if not info.converged:
+            logger.info(f"State of {candlestick_id} differs from the desired state in {info.differences}, converging")
+        try:
+            await self.send_command(candlestick_id, CandlestickCommand(**info.differences), message_type=MessageType.DESIRED_STATE)
+        except Exception as e:
+            # Sent again on the next reconnect
+            logger.error(f"Failed to send desired state to {candlestick_id}: {e}")
+    
+    async def set_offline_schedule(self, candlestick_id: str, schedule: OfflineSchedule):
+        """Store the offline schedule of a candlestick, sent now if connected and on every connect"""
+        self.offline_schedules[candlestick_id] = schedule
+        if self.is_connected(candlestick_id):
+            await self.send_offline_schedule(candlestick_id)
+    
+    async def send_offline_schedule(self, candlestick_id: str):
+        """Send a controller its offline schedule, if one is set"""
+        schedule = self.offline_schedules.get(candlestick_id)
+        if schedule is None:
+            return
+        entries = [entry.model_dump(exclude_none=True, exclude={"start_at"}) for entry in schedule.entries]
+        try:
+            await self.send_to_controller(candlestick_id, {"type": MessageType.OFFLINE_SCHEDULE, "entries": entries})
+        except Exception as e:
+            # Sent again on the next connect
+            logger.error(f"Failed to send offline schedule to {candlestick_id}: {e}")
+    
+    async def set_reset_policy(self, candlestick_id: str, policy: ResetPolicy):
+        """Store the reset policy of a candlestick, sent now if connected and on every connect"""
+        self.reset_policies[candlestick_id] = policy
+        if self.is_connected(candlestick_id):
+            await self.send_reset_policy(candlestick_id)
+    
+    async def send_reset_policy(self, candlestick_id: str):
+        """Send a controller its reset policy, if one is set"""
+        policy = self.reset_policies.get(candlestick_id)
+        if policy is None:
+            return
+        try:
+            await self.send_to_controller(candlestick_id, {"type": MessageType.RESET_POLICY, **policy.model_dump(exclude_none=True)})
+        except Exception as e:
+            # Sent again on the next connect
+            logger.error(f"Failed to send reset policy to {candlestick_id}: {e}")
     
     def update_heartbeat(self, candlestick_id: str):
         """Update the last_seen timestamp for a candlestick"""
         if candlestick_id in self.states:
             self.states[candlestick_id].last_seen = datetime.now()
     
-    async def send_command(self, candlestick_id: str, command: CandlestickCommand):
-        """Send a command to a specific candlestick controller"""
+    async def send_command(
+        self,
+        candlestick_id: str,
+        command: CandlestickCommand,
+        wait: bool = False,
+        timeout: float = 5.0,
+        wait_written: bool = False,
+        message_type: MessageType = MessageType.COMMAND
+    ) -> PendingCommand:
+        """
+        Send a command to a specific candlestick controller.
+        
+        Each command is tagged with a sequence ID that the controller echoes back in an ack.
+        The state is updated when the ack arrives, not when the command is sent.
+        
+        Commands are sent at most command_rate times per second per candlestick. A command
+        arriving while the previous one is still waiting to be sent is merged into it, and
+        the merged command is acknowledged with the sequence ID of the latest one.
+        
+        Args:
+            candlestick_id: Target candlestick
+            command: The command to send
+            wait: Wait for the controller to acknowledge the command
+            timeout: Seconds to wait for the write or ack (only used when waiting)
+            wait_written: Wait until the command is written to the controller connection
+            message_type: COMMAND, or DESIRED_STATE for fields to converge to without restarting what is unchanged
+        
+        Returns:
+            The PendingCommand. In wait mode its future holds the AckMessage.
+        
+        Raises:
+            ValueError: If the candlestick is not connected
+            ConnectionError: If the connection to the candlestick is broken, also while waiting
+            asyncio.TimeoutError: If the command wasn't written (or acknowledged, when wait is True) within timeout
+        """
         if candlestick_id not in self.controller_connections:
             raise ValueError(f"Candlestick '{candlestick_id}' is not connected")
         
-        websocket = self.controller_connections[candlestick_id]
+        self._command_seq += 1
+        seq = self._command_seq
+        pending = PendingCommand(seq, candlestick_id, command, wait, message_type)
+        
+        writer = self.writers[candlestick_id]
+        if writer.closed:
+            raise ConnectionError(f"Connection to candlestick '{candlestick_id}' is broken")
+        previous = writer.buffered(candlestick_id)
+        if previous is not None:
+            # Not sent yet, replaced by the merged command
+            self.pending_acks.pop(previous.seq, None)
+            pending.absorb(previous)
+            self.commands_coalesced.inc()
         
         # Prepare command message
-        message = {
-            "type": MessageType.COMMAND,
-            **command.model_dump(exclude_none=True)
+        pending.message = {
+            "type": pending.message_type,
+            "seq": seq,
+            **pending.command.model_dump(exclude_none=True)
         }
+        if candlestick_id in self.gateway_routes:
+            pending.message["candlestick_id"] = candlestick_id
         
-        try:
-            await websocket.send_text(json.dumps(message))
-            logger.debug(f"Sent command to {candlestick_id}: {message}")
-            
-            # Update local state to reflect the command
-            self.update_state(
-                candlestick_id,
-                program=command.program,
-                speed=command.speed,
-                direction=command.direction,
-                color=command.color
-            )
-        except Exception as e:
-            logger.error(f"Failed to send command to {candlestick_id}: {e}")
-            raise
+        writer.put(candlestick_id, pending)
+        logger.debug(f"Queued command for {candlestick_id}: {pending.message}")
+        event = command.model_dump(exclude_none=True, mode="json")
+        if previous is not None:
+            # Merged into this one, never sent on its own
+            event["replaces"] = previous.seq
+        self.events.append(candlestick_id, message_type.value, seq=seq, **event)
+        
+        self.pending_acks[seq] = pending
+        while len(self.pending_acks) > MAX_PENDING_ACKS:
+            # Controllers without ack support never answer, forget the oldest entries
+            self.pending_acks.pop(next(iter(self.pending_acks)))
+        
+        if wait or wait_written:
+            # Shield the futures so a timeout doesn't cancel them, a late ack is still recorded
+            deadline = time.monotonic() + timeout
+            try:
+                if not await asyncio.wait_for(asyncio.shield(pending.written), timeout):
+                    raise ConnectionError(f"Connection to candlestick '{candlestick_id}' closed before the command was written")
+                if wait:
+                    await asyncio.wait_for(asyncio.shield(pending.future), deadline - time.monotonic())
+            except (asyncio.TimeoutError, ConnectionError):
+                pending.future = None  # Nobody is waiting anymore
+                raise
+        
+        return pending
+    
+    def handle_ack(self, candlestick_id: str, ack: AckMessage):
+        """
+        Process a command acknowledgement from a controller.
+        
+        The state is updated from the command unless the ack is stale: an ack of an older command
+        than one already acknowledged, or an ack at a revision of the controller's state cache for
+        which a status has already reported the actual state.
+        """
+        pending = self.pending_acks.pop(ack.seq, None)
+        if pending is None or pending.candlestick_id != candlestick_id:
+            logger.debug(f"Ack for unknown command seq={ack.seq} from {candlestick_id}")
+            return
+        
+        pending.resolve(ack)
+        self.command_latency.observe(pending.acked_at - pending.sent_at)
+        self.events.append(
+            candlestick_id, "ack",
+            seq=ack.seq, error=ack.error, latency_ms=round((pending.acked_at - pending.sent_at) * 1000, 1)
+        )
+        if ack.received_at is not None and ack.applied_at is not None:
+            self.apply_latency.observe(ack.applied_at - ack.received_at)
+        if ack.received_at is not None and ack.first_frame_at is not None:
+            self.first_frame_latency.observe(ack.first_frame_at - ack.received_at)
+        
+        if ack.error:
+            logger.warning(f"Command seq={ack.seq} failed on {candlestick_id}: {ack.error}")
+        elif ack.seq < self.acked_seqs.get(candlestick_id, 0) or self.is_stale(candlestick_id, ack.epoch, ack.revision):
+            self.stale_updates.inc(MessageType.ACK.value)
+            logger.info(f"State of {candlestick_id} is newer than command seq={ack.seq}, not updated from it")
+        elif self.is_stale(candlestick_id, ack.epoch, ack.revision, inclusive=True):
+            # The controller already reported its state after this command in a status
+            self.acked_seqs[candlestick_id] = ack.seq
+        else:
+            # Update local state to reflect the applied command, until the controller reports its status
+            self.acked_seqs[candlestick_id] = ack.seq
+            state = self.states.get(candlestick_id)
+            if state is not None:
+                self.update_state(candlestick_id, **command_state(state, pending.command), source="command")
+                self.set_reported_revision(candlestick_id, ack.epoch, ack.revision)
+    
+    def update_controller_metrics(self, candlestick_id: str, metrics: ControllerMetricsMessage):
+        """Store the latest metrics pushed by a controller"""
+        self.controller_metrics[candlestick_id] = metrics.model_dump(exclude={"type"}, exclude_none=True)
+    
+    async def request_profile(self, candlestick_id: str, profile_id: str, duration: float):
+        """Ask a controller to profile itself and upload the result"""
+        message = {"type": MessageType.PROFILE, "profile_id": profile_id, "duration": duration}
+        await self.send_to_controller(candlestick_id, message)
+    
+    def store_profile(self, candlestick_id: str, profile: ProfileResultMessage):
+        """Store a profile uploaded by a controller, dropping the oldest ones"""
+        profiles = self.profiles.setdefault(
+            candlestick_id, deque(maxlen=MAX_PROFILES_PER_CANDLESTICK * 2)
+        )
+        info = ProfileInfo(
+            profile_id=profile.profile_id,
+            target=profile.target,
+            duration=profile.duration,
+            samples=profile.samples,
+            error=profile.error,
+            received_at=datetime.now()
+        )
+        profiles.append((info, profile.collapsed))
+        logger.info(f"Stored profile {profile.profile_id} ({profile.target}) from {candlestick_id}")
+    
+    def list_profiles(self, candlestick_id: str) -> List[ProfileInfo]:
+        """List stored profiles for a candlestick, newest first"""
+        return [info for info, _ in reversed(self.profiles.get(candlestick_id, ()))]
+    
+    def get_profile(self, candlestick_id: str, profile_id: str, target: str) -> Optional[str]:
+        """Get the collapsed stacks of a stored profile, None if not found or empty"""
+        for info, collapsed in self.profiles.get(candlestick_id, ()):
+            if info.profile_id == profile_id and info.target == target:
+                return collapsed
+        return None
+    
+    async def start_show(self, show_id: str, show: Show) -> ShowInfo:
+        """
+        Compile a show and send each connected candlestick its schedule.
+        The schedule carries the backend time it was sent at, for the controller's clock offset estimate.
+        """
+        start_at = time.time() + show.start_in
+        schedules = compile_show(show, start_at)
+        sent = {}
+        missing = []
+        for candlestick_id, entries in schedules.items():
+            if candlestick_id not in self.controller_connections:
+                missing.append(candlestick_id)
+                continue
+            message = {
+                "type": MessageType.SCHEDULE,
+                "show_id": show_id,
+                "server_time": time.time(),
+                "entries": entries
+            }
+            try:
+                await self.send_to_controller(candlestick_id, message)
+                sent[candlestick_id] = len(entries)
+            except Exception as e:
+                logger.error(f"Failed to send schedule of show {show_id} to {candlestick_id}: {e}")
+                missing.append(candlestick_id)
+        
+        info = ShowInfo(
+            show_id=show_id,
+            name=show.name,
+            start_at=start_at,
+            end_at=start_at + max(cue.at for cue in show.cues),
+            schedules=sent,
+            missing=missing
+        )
+        self.shows[show_id] = info
+        while len(self.shows) > MAX_SHOWS:
+            self.shows.pop(next(iter(self.shows)))
+        logger.info(f"Show {show_id} starts at {start_at:.3f}, sent to {len(sent)} candlesticks, missing: {missing}")
+        return info
+    
+    async def cancel_show(self, show_id: str) -> Optional[ShowInfo]:
+        """Tell the controllers to drop the schedule of a show. Returns None for unknown shows."""
+        info = self.shows.pop(show_id, None)
+        if info is None:
+            return None
+        for candlestick_id in info.schedules:
+            if candlestick_id in self.controller_connections:
+                try:
+                    await self.send_to_controller(candlestick_id, {"type": MessageType.CANCEL_SCHEDULE, "show_id": show_id})
+                except Exception as e:
+                    logger.error(f"Failed to cancel show {show_id} on {candlestick_id}: {e}")
+        logger.info(f"Show {show_id} cancelled")
+        return info
+    
+    def render_metrics(self) -> str:
+        """Render backend and controller metrics in the Prometheus text format"""
+        # Controllers report their counters as running totals, named *_total
+        controller_help = {
+            name: ("counter" if name.endswith("_total") else "gauge", field.description)
+            for name, field in ControllerMetricsMessage.model_fields.items()
+            if name != "type"
+        }
+        return self.metrics.render() + render_per_candlestick(
+            "candlestick_controller_", self.controller_metrics, controller_help
+        )
+    
+    def get_latency_stats(self) -> Dict:
+        """Get the command latency histograms"""
+        return {
+            "command": self.command_latency.snapshot(),
+            "apply": self.apply_latency.snapshot(),
+            "first_frame": self.first_frame_latency.snapshot(),
+        }
     
     async def broadcast_to_web_clients(self, message: dict):
         """Broadcast a message to all connected web clients"""
@@ -187,27 +987,44 @@ class ConnectionManager:
         message_text = json.dumps(message)
         disconnected_clients = []
         
-        for client_id, websocket in self.web_client_connections.items():
+        for client_id, websocket in list(self.web_client_connections.items()):
+            self.broadcast_queue_depth.inc()
             try:
                 await websocket.send_text(message_text)
+                self.messages_out.inc(message.get("type"))
                 logger.debug(f"Sent message to web client {client_id}")
             except Exception as e:
                 logger.error(f"Failed to send message to web client {client_id}: {e}")
                 disconnected_clients.append(client_id)
+            finally:
+                self.broadcast_queue_depth.dec()
         
         # Clean up disconnected clients
         for client_id in disconnected_clients:
             self.disconnect_web_client(client_id)
     
-    async def cleanup_stale_connections(self, timeout_minutes: int = 5):
+    async def monitor_event_loop_lag(self, interval: float = 0.5):
+        """
+        Background task measuring event loop lag: how much later than requested a sleep returns.
+        A busy or blocked loop delays every WebSocket and HTTP request.
+        """
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.event_loop_lag.observe(time.perf_counter() - started - interval)
+    
+    async def cleanup_stale_connections(self, timeout_minutes: int = 5, settings_retention_days: float = 7):
         """
         Background task to clean up stale connection states.
-        Runs periodically to remove disconnected candlesticks that haven't been seen recently.
+        Runs periodically to remove disconnected candlesticks that haven't been seen recently,
+        and their desired state, offline schedule and reset policy once they have been gone
+        for settings_retention_days (they outlive ordinary outages).
         """
         while True:
             try:
                 await asyncio.sleep(60)  # Check every minute
                 
+                scan_started = time.perf_counter()
                 now = datetime.now()
                 stale_ids = []
                 
@@ -219,7 +1036,21 @@ class ConnectionManager:
                 
                 for candlestick_id in stale_ids:
                     logger.info(f"Removing stale state for {candlestick_id}")
-                    del self.states[candlestick_id]
+                    self.gone_since[candlestick_id] = self.states.pop(candlestick_id).last_seen
+                    self.controller_metrics.pop(candlestick_id, None)
+                    self.reported_revisions.pop(candlestick_id, None)
+                    self.acked_seqs.pop(candlestick_id, None)
+                    self.events.remove(candlestick_id)
+                
+                for candlestick_id, since in list(self.gone_since.items()):
+                    if now - since > timedelta(days=settings_retention_days):
+                        logger.info(f"Removing the settings of {candlestick_id}, gone since {since:%Y-%m-%d %H:%M}")
+                        del self.gone_since[candlestick_id]
+                        self.desired_states.pop(candlestick_id, None)
+                        self.offline_schedules.pop(candlestick_id, None)
+                        self.reset_policies.pop(candlestick_id, None)
+                
+                self.cleanup_scan_time.observe(time.perf_counter() - scan_started)
                     
             except Exception as e:
                 logger.error(f"Error in cleanup task: {e}")
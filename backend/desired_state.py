@@ -0,0 +1,42 @@
+"""
+Desired state of candlesticks.
+
+Clients set the full state a candlestick should be in, and the backend keeps it: it is
+sent to the controller when set, and after every reconnect only the fields in which the
+reported state differs from it are sent. The controller converges in one transition
+(see CandlestickDevice.converge), restarting the animation only when what is shown changes.
+"""
+
+from typing import Any, Dict, Optional
+
+from models import CandlestickState, DesiredState
+
+
+def validate_desired_state(desired: DesiredState):
+    """Raise ValueError unless the desired state has either a program or a color"""
+    if (desired.program is None) == (desired.color is None):
+        raise ValueError("A desired state has either a program or a color")
+    if desired.color is not None and desired.direction is not None:
+        raise ValueError("A static color has no direction")
+
+
+def desired_changes(desired: DesiredState, state: Optional[CandlestickState] = None) -> Dict[str, Any]:
+    """
+    Fields of the desired state the reported state differs in, as command fields.
+    All of them without a state. A direction of None (the program's default) matches any direction.
+    """
+    changes: Dict[str, Any] = {}
+    if desired.color is not None:
+        if state is None or state.program != "static_color" or (state.color or "").lower() != desired.color.lower():
+            changes["color"] = desired.color
+    elif desired.program == "random":
+        if state is None or not state.random:
+            changes["program"] = "random"
+    elif state is None or state.random or state.program != desired.program:
+        changes["program"] = desired.program
+
+    if state is None or state.speed != desired.speed:
+        changes["speed"] = desired.speed
+    if desired.direction is not None and (state is None or "program" in changes or state.direction != desired.direction):
+        changes["direction"] = desired.direction
+    return changes
@@ -0,0 +1,282 @@
+"""
+Event log of each candlestick: commands, acks, status changes, connects and disconnects.
+
+Events get consecutive sequence numbers per candlestick. The latest events are kept
+in a fixed size ring buffer, so appending is O(1) and an event is found from its
+sequence number without a scan.
+
+With a directory configured, events are also appended to JSON lines segment files of
+SEGMENT_EVENTS events each, named by the sequence number of their first event. Events
+no longer in memory are read from the segments holding them, found by sequence number
+(or, for a time, by a binary search over the segments' first events). Whenever a new
+segment is started, segments last written before the retention time, and the oldest
+segments beyond max_segments, are deleted.
+"""
+
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# Events kept in memory per candlestick
+DEFAULT_CAPACITY = 1000
+# Events per segment file
+SEGMENT_EVENTS = 10000
+# Segment files kept per candlestick
+DEFAULT_MAX_SEGMENTS = 100
+DEFAULT_RETENTION_SECONDS = 30 * 24 * 3600
+SEGMENT_SUFFIX = ".jsonl"
+
+
+def _directory_name(candlestick_id: str) -> str:
+    """Directory name for a candlestick ID (which comes from a URL) that can't escape the log directory"""
+    return re.sub(r"[^A-Za-z0-9_-]", lambda match: f"%{ord(match.group()):02X}", candlestick_id)
+
+
+class EventLog:
+    """
+    Events of one candlestick.
+
+    Args:
+        capacity: Events kept in memory
+        directory: Directory for the segment files of this candlestick, memory only if None
+        max_segments: Segment files kept
+        retention_seconds: Segment files last written longer ago are deleted
+    """
+
+    def __init__(
+        self,
+        capacity: int = DEFAULT_CAPACITY,
+        directory: Optional[str] = None,
+        max_segments: int = DEFAULT_MAX_SEGMENTS,
+        retention_seconds: float = DEFAULT_RETENTION_SECONDS
+    ):
+        self.capacity = capacity
+        self.directory = directory
+        self.max_segments = max_segments
+        self.retention_seconds = retention_seconds
+        self._ring: List[Optional[dict]] = [None] * capacity
+        # Sequence number of the latest event, events start at 1
+        self.last_seq = 0
+        # First sequence number held in memory (events before it are only on disk)
+        self._memory_start = 1
+        # First sequence number of each segment file, oldest first
+        self.segments: List[int] = []
+        self._segment_times: Dict[int, float] = {}
+        self._file = None
+        if directory is not None:
+            self._load_segments()
+
+    def _segment_path(self, first_seq: int) -> str:
+        return os.path.join(self.directory, f"{first_seq:012d}{SEGMENT_SUFFIX}")
+
+    def _load_segments(self):
+        """Continue the sequence numbers of the segments written before a restart"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit()
+        )
+        if not self.segments:
+            return
+        events = self._read_segment(self.segments[-1])
+        self.last_seq = events[-1]["seq"] if events else self.segments[-1] - 1
+        self._memory_start = self.last_seq + 1
+
+    def _read_segment(self, first_seq: int, skip: int = 0) -> List[dict]:
+        try:
+            with open(self._segment_path(first_seq)) as f:
+                return [json.loads(line) for index, line in enumerate(f) if index >= skip and line.strip()]
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to read event segment {self._segment_path(first_seq)}: {e}")
+            return []
+
+    def append(self, event_type: str, data: Dict[str, Any]) -> dict:
+        """Record an event"""
+        self.last_seq += 1
+        event = {"seq": self.last_seq, "time": time.time(), "type": event_type, "data": data}
+        self._ring[self.last_seq % self.capacity] = event
+        if self.directory is not None:
+            try:
+                self._write(event)
+            except (OSError, TypeError, ValueError) as e:
+                logger.error(f"Failed to write event {self.last_seq} to {self.directory}: {e}")
+        return event
+
+    def _write(self, event: dict):
+        if self._file is None or event["seq"] - self.segments[-1] >= SEGMENT_EVENTS:
+            self._start_segment(event["seq"])
+        self._file.write(json.dumps(event) + "\n")
+        self._file.flush()
+
+    def _start_segment(self, first_seq: int):
+        if self._file is not None:
+            self._file.close()
+        if self.segments and first_seq - self.segments[-1] < SEGMENT_EVENTS:
+            # Continue the latest segment, e.g. after a restart
+            self._file = open(self._segment_path(self.segments[-1]), "a")
+            return
+        self.segments.append(first_seq)
+        self._file = open(self._segment_path(first_seq), "a")
+        self._apply_retention()
+
+    def _apply_retention(self):
+        expired_before = time.time() - self.retention_seconds
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            path = self._segment_path(oldest)
+            try:
+                expired = len(self.segments) > self.max_segments or os.path.getmtime(path) < expired_before
+            except OSError:
+                expired = True
+            if not expired:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Failed to delete event segment {path}: {e}")
+            self.segments.pop(0)
+            self._segment_times.pop(oldest, None)
+
+    @property
+    def first_seq(self) -> int:
+        """Sequence number of the oldest event kept"""
+        return min(self.segments[0], self._first_in_memory()) if self.segments else self._first_in_memory()
+
+    def _first_in_memory(self) -> int:
+        return max(self._memory_start, self.last_seq - self.capacity + 1, 1)
+
+    def _segment_first_time(self, first_seq: int) -> float:
+        if first_seq not in self._segment_times:
+            try:
+                with open(self._segment_path(first_seq)) as f:
+                    self._segment_times[first_seq] = json.loads(f.readline())["time"]
+            except (OSError, ValueError, KeyError):
+                self._segment_times[first_seq] = 0.0
+        return self._segment_times[first_seq]
+
+    def _seq_at_time(self, since_time: float) -> int:
+        """Sequence number of the first event at or after since_time"""
+        memory_first = self._first_in_memory()
+        in_memory = memory_first <= self.last_seq and self._ring[memory_first % self.capacity]["time"] < since_time
+        if self.segments and not in_memory:
+            # Last segment starting before since_time, then the first event at or after it in that segment
+            low, high = 0, len(self.segments)
+            while low < high:
+                middle = (low + high) // 2
+                if self._segment_first_time(self.segments[middle]) < since_time:
+                    low = middle + 1
+                else:
+                    high = middle
+            for event in self._read_segment(self.segments[max(low - 1, 0)]):
+                if event["time"] >= since_time:
+                    return event["seq"]
+            return self.segments[low] if low < len(self.segments) else self.last_seq + 1
+        # Binary search over the events in memory
+        low, high = memory_first, self.last_seq + 1
+        while low < high:
+            middle = (low + high) // 2
+            if self._ring[middle % self.capacity]["time"] < since_time:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, since: Optional[int] = None, since_time: Optional[float] = None, limit: int = 100) -> List[dict]:
+        """
+        Events after sequence number since (or at or after since_time), oldest first.
+        Without either, starts at the oldest event kept.
+        """
+        if since_time is not None:
+            start = self._seq_at_time(since_time)
+        else:
+            start = (since or 0) + 1
+        start = max(start, self.first_seq)
+        end = min(start + limit - 1, self.last_seq)
+        if start > end:
+            return []
+
+        events = []
+        memory_first = self._first_in_memory()
+        if start < memory_first:
+            events = self._read_range(start, min(end, memory_first - 1))
+        for seq in range(max(start, memory_first), end + 1):
+            events.append(self._ring[seq % self.capacity])
+        return events
+
+    def _read_range(self, start: int, end: int) -> List[dict]:
+        """Events start to end (inclusive) from the segment files"""
+        events = []
+        index = max(bisect_right(self.segments, start) - 1, 0)
+        for first in self.segments[index:]:
+            if first > end:
+                break
+            events.extend(event for event in self._read_segment(first, skip=max(start - first, 0)) if event["seq"] <= end)
+        return events
+
+    def close(self):
+        """Close the open segment file, it is reopened by the next append"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class EventStore:
+    """
+    Event logs of all candlesticks.
+
+    Args:
+        capacity: Events kept in memory per candlestick
+        directory: Directory for segment files (one subdirectory per candlestick), memory only if None
+        max_segments: Segment files kept per candlestick
+        retention_seconds: Segment files last written longer ago are deleted
+    """
+
+    def __init__(
+        self,
+        capacity: int = DEFAULT_CAPACITY,
+        directory: Optional[str] = None,
+        max_segments: int = DEFAULT_MAX_SEGMENTS,
+        retention_seconds: float = DEFAULT_RETENTION_SECONDS
+    ):
+        self.capacity = capacity
+        self.directory = directory
+        self.max_segments = max_segments
+        self.retention_seconds = retention_seconds
+        self.logs: Dict[str, EventLog] = {}
+
+    def _path(self, candlestick_id: str) -> Optional[str]:
+        return os.path.join(self.directory, _directory_name(candlestick_id)) if self.directory else None
+
+    def append(self, candlestick_id: str, event_type: str, **data) -> dict:
+        """Record an event for a candlestick"""
+        log = self.logs.get(candlestick_id)
+        if log is None:
+            log = self.logs[candlestick_id] = EventLog(
+                self.capacity, self._path(candlestick_id), self.max_segments, self.retention_seconds
+            )
+        return log.append(event_type, data)
+
+    def get(self, candlestick_id: str) -> Optional[EventLog]:
+        """Event log of a candlestick, also one only on disk from before a restart. None if there is none."""
+        log = self.logs.get(candlestick_id)
+        if log is None and self.directory and os.path.isdir(self._path(candlestick_id)):
+            log = self.logs[candlestick_id] = EventLog(
+                self.capacity, self._path(candlestick_id), self.max_segments, self.retention_seconds
+            )
+        return log
+
+    def remove(self, candlestick_id: str):
+        """Drop the event log of a candlestick from memory. Its segment files stay, get() reads them again."""
+        log = self.logs.pop(candlestick_id, None)
+        if log is not None:
+            log.close()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
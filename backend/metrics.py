@@ -0,0 +1,187 @@
+"""
+Lightweight metrics primitives for the backend.
+
+All counters and histogram buckets are allocated up front, recording an event
+is a dict lookup and an integer increment. Metrics are exported in the
+Prometheus text exposition format.
+"""
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Default latency buckets in seconds (upper bounds, Prometheus style)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Buckets for short CPU-bound operations, such as decoding a message
+FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)
+
+# Label value used when a counter is incremented with a label value it doesn't know
+OTHER_LABEL = "other"
+
+
+def _escape_label_value(value) -> str:
+    """Escape a label value as the text format requires (candlestick IDs come from URLs)"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally split by a single label with a fixed set of values"""
+
+    def __init__(self, name: str, help: str, label: Optional[str] = None, label_values: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label = label
+        if label:
+            self.values = {value: 0 for value in label_values}
+            self.values.setdefault(OTHER_LABEL, 0)
+        else:
+            self.values = {None: 0}
+
+    def inc(self, label_value: Optional[str] = None, amount: int = 1):
+        """Increment the counter. Unknown label values are counted as 'other'"""
+        if label_value not in self.values:
+            label_value = OTHER_LABEL
+        self.values[label_value] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_value, value in self.values.items():
+            labels = {self.label: label_value} if self.label else {}
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge that is either set directly or read from a callback at export time"""
+
+    def __init__(self, name: str, help: str, callback: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def render(self) -> List[str]:
+        value = self.callback() if self.callback else self.value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class Histogram:
+    """Fixed-bucket histogram. Counts are preallocated, observe() does not allocate."""
+
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS, name: Optional[str] = None, help: str = ""):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # One slot per bucket plus the +Inf overflow slot
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Record a single observation"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate a quantile from the bucket counts.
+        Returns the upper bound of the bucket containing the quantile, or None if empty.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def snapshot(self) -> Dict:
+        """Return a JSON serializable summary of the histogram"""
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                str(bound): bucket_count
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), self.counts)
+            },
+        }
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics that are exported together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help: str, label: Optional[str] = None, label_values: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, label, label_values))
+
+    def gauge(self, name: str, help: str, callback: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, help, callback))
+
+    def histogram(self, name: str, help: str, buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(buckets, name=name, help=help))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def render_per_candlestick(prefix: str, samples: Dict[str, Dict[str, float]], help: Dict[str, Tuple[str, str]]) -> str:
+    """
+    Render values reported by controllers labeled with the candlestick ID.
+    
+    Args:
+        prefix: Metric name prefix
+        samples: candlestick_id -> {metric name -> value}
+        help: metric name -> (type, help text), type being 'counter' or 'gauge'. Only these metrics are rendered.
+    """
+    lines = []
+    for metric_name, (metric_type, metric_help) in help.items():
+        name = f"{prefix}{metric_name}"
+        lines.append(f"# HELP {name} {metric_help}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for candlestick_id, values in samples.items():
+            value = values.get(metric_name)
+            if value is not None:
+                lines.append(f"{name}{_format_labels({'candlestick': candlestick_id})} {value}")
+    return "\n".join(lines) + "\n"
@@ -3,7 +3,7 @@ Pydantic models for the RGB Candlestick Backend API
 """
 
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
 from datetime import datetime
 from enum import Enum
 
@@ -13,6 +13,22 @@ class MessageType(str, Enum):
     STATUS = "status"
     HEARTBEAT = "heartbeat"
     COMMAND = "command"
+    ACK = "ack"
+    METRICS = "metrics"
+    PROFILE = "profile"
+    PROFILE_RESULT = "profile_result"
+    ATTACH = "attach"
+    DETACH = "detach"
+    BATCH = "batch"
+    SCHEDULE = "schedule"
+    CANCEL_SCHEDULE = "cancel_schedule"
+    CLOCK_PING = "clock_ping"
+    CLOCK_PONG = "clock_pong"
+    RESYNC = "resync"
+    SYNC = "sync"
+    OFFLINE_SCHEDULE = "offline_schedule"
+    DESIRED_STATE = "desired_state"
+    RESET_POLICY = "reset_policy"
 
 
 class CandlestickCommand(BaseModel):
@@ -21,6 +37,7 @@ class CandlestickCommand(BaseModel):
     speed: Optional[int] = Field(None, ge=1, le=100, description="Speed of the program (1-100)")
     direction: Optional[str] = Field(None, description="Direction: 'left', 'right', 'up', 'down'")
     color: Optional[str] = Field(None, description="HTML color code (e.g., '#ff0000')")
+    start_at: Optional[float] = Field(None, description="Backend time (seconds since the epoch) to start the program at, for starting several candlesticks in phase")
 
     model_config = {
         "json_schema_extra": {
@@ -34,6 +51,127 @@ class CandlestickCommand(BaseModel):
     }
 
 
+class ShowCue(CandlestickCommand):
+    """A command applied at a point in a show"""
+    at: float = Field(..., ge=0, description="Seconds after the start of the show")
+    candlesticks: Optional[List[str]] = Field(None, description="Candlesticks the cue applies to, all candlesticks of the show if omitted")
+
+
+class Show(BaseModel):
+    """A timeline of commands for several candlesticks, executed by the controllers against a shared clock"""
+    name: Optional[str] = Field(None, description="Name of the show, for display only")
+    candlesticks: List[str] = Field(..., min_length=1, description="Candlesticks taking part in the show")
+    cues: List[ShowCue] = Field(..., min_length=1, description="Commands and when to apply them")
+    start_in: float = Field(2.0, ge=0.5, le=3600, description="Seconds from now until the show starts, schedules are sent ahead of time")
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "name": "Rainbow wave",
+                "candlesticks": ["candlestick_001", "candlestick_002"],
+                "cues": [
+                    {"at": 0, "program": "rb", "speed": 10, "direction": "right"},
+                    {"at": 5, "candlesticks": ["candlestick_002"], "color": "#ff0000"},
+                    {"at": 10, "program": "wave", "direction": "up"}
+                ],
+                "start_in": 2
+            }
+        }
+    }
+
+
+class DesiredState(BaseModel):
+    """The full state a candlestick should be in: a program (including 'random' and 'stop') or a static color"""
+    program: Optional[str] = Field(None, description="Program to run, 'random' or 'stop' (None for a static color)")
+    color: Optional[str] = Field(None, description="Static color, instead of a program")
+    speed: int = Field(..., ge=1, le=100, description="Speed of the program (1-100)")
+    direction: Optional[str] = Field(None, description="Direction of the program, None for the program's default")
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "program": "rb",
+                "speed": 10,
+                "direction": "left"
+            }
+        }
+    }
+
+
+class DesiredStateInfo(BaseModel):
+    """A desired state and how far the candlestick is from it"""
+    desired: DesiredState
+    converged: bool = Field(..., description="Whether the reported state matches the desired state")
+    differences: Dict[str, Any] = Field(default_factory=dict, description="Desired fields the reported state doesn't match yet")
+    seq: Optional[int] = Field(None, description="Sequence ID of the message sent to the controller, None when not sent (not connected)")
+
+
+class OfflineScheduleEntry(CandlestickCommand):
+    """A command applied daily at a time of day while the controller can't reach the backend"""
+    time: str = Field(..., pattern=r"^([01]\d|2[0-3]):[0-5]\d$", description="Time of day (HH:MM), controller local time")
+
+
+class OfflineSchedule(BaseModel):
+    """Commands a controller applies by time of day while the backend is unreachable"""
+    entries: List[OfflineScheduleEntry] = Field(default_factory=list, description="Entries, each repeated daily")
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "entries": [
+                    {"time": "08:00", "program": "rb", "speed": 10},
+                    {"time": "22:00", "program": "stop"}
+                ]
+            }
+        }
+    }
+
+
+class ResetScheduleEntry(DesiredState):
+    """Default state of a candlestick from a time of day on"""
+    time: str = Field(..., pattern=r"^([01]\d|2[0-3]):[0-5]\d$", description="Time of day (HH:MM), controller local time")
+
+
+class ResetPolicy(BaseModel):
+    """What a candlestick resets to after a period without commands, left out fields use the controller's settings"""
+    timeout: Optional[int] = Field(None, ge=0, description="Seconds without commands before the reset, 0 never resets")
+    defaults: Optional[DesiredState] = Field(None, description="Default state, when there is no schedule")
+    schedule: List[ResetScheduleEntry] = Field(default_factory=list, description="Default states by time of day, each repeated daily")
+
+    model_config = {
+        "json_schema_extra": {
+            "example": {
+                "timeout": 300,
+                "schedule": [
+                    {"time": "08:00", "program": "random", "speed": 10},
+                    {"time": "22:00", "program": "stop", "speed": 10}
+                ]
+            }
+        }
+    }
+
+
+class ShowInfo(BaseModel):
+    """A scheduled show"""
+    show_id: str
+    name: Optional[str] = None
+    start_at: float = Field(..., description="Start of the show, backend time (seconds since the epoch)")
+    end_at: float = Field(..., description="Time of the last cue, backend time (seconds since the epoch)")
+    schedules: Dict[str, int] = Field(..., description="Number of cues sent to each candlestick")
+    missing: List[str] = Field(default_factory=list, description="Candlesticks of the show that were not connected")
+
+
+class CommandResponse(BaseModel):
+    """Response returned after sending a command"""
+    status: str = Field(..., description="'success' when the command was sent (or applied, in wait mode), 'unchanged' when it was skipped (skip_unchanged)")
+    message: str = Field(..., description="Human readable result")
+    seq: Optional[int] = Field(None, description="Sequence ID assigned to the command, None when it was skipped")
+    version: int = Field(..., description="Version of the candlestick state when responding")
+    latency_ms: Optional[float] = Field(None, description="Backend send to ack round trip (wait mode only)")
+    apply_ms: Optional[float] = Field(None, description="Controller receive to apply time (wait mode only)")
+    first_frame_ms: Optional[float] = Field(None, description="Controller receive to first frame written (wait mode only)")
+
+
 class CandlestickState(BaseModel):
     """Current state of a candlestick"""
     id: str = Field(..., description="Unique identifier for the candlestick")
@@ -43,7 +181,10 @@ class CandlestickState(BaseModel):
     speed: Optional[int] = Field(None, description="Current speed setting")
     direction: Optional[str] = Field(None, description="Current direction")
     color: Optional[str] = Field(None, description="Current color (if in static color mode)")
+    timing: Optional[Dict[str, Any]] = Field(None, description="Frame lateness and serial write percentiles (ms) reported by the controller")
+    gateway: Optional[str] = Field(None, description="Gateway the candlestick is connected through (multiplexed connections only)")
     last_seen: datetime = Field(..., description="Last time the candlestick was seen")
+    version: int = Field(0, description="Incremented on every change of program, random, speed, direction or color, for If-Match")
 
     model_config = {
         "json_schema_extra": {
@@ -54,7 +195,8 @@ class CandlestickState(BaseModel):
                 "speed": 10,
                 "direction": "right",
                 "color": None,
-                "last_seen": "2025-10-16T10:30:00"
+                "last_seen": "2025-10-16T10:30:00",
+                "version": 12
             }
         }
     }
@@ -75,13 +217,33 @@ class WebSocketMessage(BaseModel):
 
 
 class StatusMessage(WebSocketMessage):
-    """Status update from controller"""
+    """
+    Status update from controller.
+    epoch and revision identify the state in the controller's state cache: a status with
+    an older revision of the same epoch than already seen is stale and dropped.
+    """
     type: MessageType = MessageType.STATUS
     program: Optional[str] = None
     random: Optional[bool] = None
     speed: Optional[int] = None
     direction: Optional[str] = None
     color: Optional[str] = None
+    timing: Optional[Dict[str, Any]] = None
+    epoch: Optional[str] = None
+    revision: Optional[int] = None
+
+
+class ResyncMessage(WebSocketMessage):
+    """
+    State changes from a controller after a (re)connect. The controller's state cache
+    (identified by epoch) numbers its changes, changes holds the fields changed after
+    revision base, the whole state when base is None.
+    """
+    type: MessageType = MessageType.RESYNC
+    epoch: str
+    revision: int
+    base: Optional[int] = None
+    changes: Dict[str, Any] = Field(default_factory=dict)
 
 
 class HeartbeatMessage(WebSocketMessage):
@@ -92,7 +254,110 @@ class HeartbeatMessage(WebSocketMessage):
 class CommandMessage(WebSocketMessage):
     """Command to controller"""
     type: MessageType = MessageType.COMMAND
+    seq: Optional[int] = None
     program: Optional[str] = None
     speed: Optional[int] = None
     direction: Optional[str] = None
     color: Optional[str] = None
+
+
+class AckMessage(WebSocketMessage):
+    """
+    Command acknowledgement from controller.
+    Timestamps are controller wall clock (time.time()), so only differences between them are meaningful.
+    """
+    type: MessageType = MessageType.ACK
+    seq: int
+    received_at: Optional[float] = None
+    applied_at: Optional[float] = None
+    first_frame_at: Optional[float] = None
+    error: Optional[str] = None
+    # State cache revision the controller was at after applying the command (see StatusMessage)
+    epoch: Optional[str] = None
+    revision: Optional[int] = None
+
+
+class ControllerMetricsMessage(WebSocketMessage):
+    """Metrics pushed periodically by a controller"""
+    type: MessageType = MessageType.METRICS
+    frames_per_second: Optional[float] = Field(None, description="Frames written per second since the last report")
+    frames_total: Optional[int] = Field(None, description="Frames written since the controller started")
+    frames_skipped_total: Optional[int] = Field(None, description="Frames not sent because they were identical to the previous frame")
+    program_cache_hits_total: Optional[int] = Field(None, description="Patterns replayed from the compiled program cache")
+    program_cache_misses_total: Optional[int] = Field(None, description="Patterns that had to be compiled")
+    program_cache_bytes: Optional[int] = Field(None, description="Size of the compiled program cache of the animation process")
+    serial_write_seconds_avg: Optional[float] = Field(None, description="Average serial write duration since the last report")
+    serial_write_seconds_max: Optional[float] = Field(None, description="Longest serial write since the last report")
+    frame_lateness_p99_ms: Optional[float] = Field(None, description="99th percentile of frame lateness for the running program")
+    process_restarts_total: Optional[int] = Field(None, description="Animation process restarts")
+    commands_dropped_total: Optional[int] = Field(None, description="Commands that could not be parsed or applied")
+    reconnects_total: Optional[int] = Field(None, description="Reconnects to the backend")
+    offline_seconds_total: Optional[float] = Field(None, description="Time spent without a backend connection")
+    first_frame_seconds: Optional[float] = Field(None, description="Controller process start to the first frame written")
+    boot_first_frame_seconds: Optional[float] = Field(None, description="System boot to the first frame written")
+    clock_offset_ms: Optional[float] = Field(None, description="Estimated backend clock minus controller clock")
+    clock_rtt_min_ms: Optional[float] = Field(None, description="Smallest clock ping round trip of the recent exchanges")
+    clock_rtt_max_ms: Optional[float] = Field(None, description="Largest clock ping round trip of the recent exchanges")
+    clock_rtt_last_ms: Optional[float] = Field(None, description="Round trip of the latest clock ping")
+
+
+class ProfileResultMessage(WebSocketMessage):
+    """Profile uploaded by a controller, in collapsed stack format"""
+    type: MessageType = MessageType.PROFILE_RESULT
+    profile_id: str
+    target: str = Field(..., description="What was profiled: 'animation' or 'event_loop'")
+    duration: float
+    samples: int = 0
+    collapsed: Optional[str] = None
+    error: Optional[str] = None
+
+
+class AttachMessage(WebSocketMessage):
+    """Candlesticks attached to (or with type 'detach', detached from) a gateway connection"""
+    type: MessageType = MessageType.ATTACH
+    candlestick_ids: List[str]
+
+
+class BatchMessage(WebSocketMessage):
+    """Several messages from a gateway in one frame, each with a candlestick_id"""
+    type: MessageType = MessageType.BATCH
+    messages: List[Dict[str, Any]]
+
+
+class GatewayInfo(BaseModel):
+    """A connected gateway and the candlesticks behind it"""
+    id: str
+    candlesticks: List[str]
+
+
+class ProfileInfo(BaseModel):
+    """A stored profile, without the stack data"""
+    profile_id: str
+    target: str
+    duration: float
+    samples: int
+    error: Optional[str] = None
+    received_at: datetime
+
+
+class ProfileRequestResponse(BaseModel):
+    """Response after requesting a profile from a controller"""
+    profile_id: str
+    duration: float
+    message: str
+
+
+class CandlestickEvent(BaseModel):
+    """An entry of a candlestick's event log"""
+    seq: int = Field(..., description="Sequence number, consecutive per candlestick")
+    time: float = Field(..., description="Unix timestamp")
+    type: str = Field(..., description="'connected', 'disconnected', 'command', 'desired_state', 'ack' or 'status'")
+    data: Dict[str, Any] = {}
+
+
+class EventPage(BaseModel):
+    """A page of a candlestick's event log, oldest first"""
+    events: List[CandlestickEvent]
+    next_since: Optional[int] = Field(None, description="Pass as 'since' for the next page, None when there are no more events")
+    first_seq: int = Field(..., description="Sequence number of the oldest event kept")
+    last_seq: int = Field(..., description="Sequence number of the latest event")
@@ -0,0 +1,233 @@
+"""
+Outgoing messages to controllers.
+
+Every controller connection (direct, or a gateway shared by several candlesticks)
+has one writer task sending its messages, so request handlers never write to a
+controller socket themselves. They queue a message and may wait for its `written`
+future, which resolves to True once the message is written and to False when it
+is dropped.
+
+Commands are buffered per candlestick: a command that arrives while an earlier one
+for the same candlestick is still waiting replaces it (the caller merges the two,
+last write wins), and each candlestick gets at most `rate` commands per second.
+While the socket's send buffer is full the writer is blocked in the send, and new
+commands merge into the buffered ones instead of queueing up behind it.
+
+Other messages wait in a bounded queue. When it is full, the drop policy decides
+between dropping the oldest message, dropping the new one, or rejecting it with
+QueueFull. A write that doesn't finish within the write timeout means the
+connection is dead: the writer stops and the connection is closed.
+"""
+
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Union
+import asyncio
+import json
+import logging
+import time
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+REJECT = "reject"
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, REJECT)
+# Reasons a message isn't written, for the dropped messages metric
+DROP_REASONS = ("queue_full", "write_timeout", "closed")
+
+# A message, or a function building it when it is written (for timestamps such as a clock pong's send time)
+Message = Union[dict, Callable[[], dict]]
+
+
+class QueueFull(Exception):
+    """A message was rejected because the connection's queue is full (drop policy 'reject')"""
+
+
+class OutboundMessage:
+    """A message waiting to be written to a controller"""
+
+    def __init__(self, message: Optional[Message] = None):
+        self.message = message
+        # Resolves to True when the message is written, False when it is dropped
+        self.written: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def done(self, written: bool):
+        if not self.written.done():
+            self.written.set_result(written)
+
+
+class ConnectionWriter:
+    """
+    Writer task of one controller WebSocket connection.
+
+    Args:
+        websocket: The connection
+        name: Controller or gateway ID, for logging
+        rate: Commands per second per candlestick, 0 for no limit
+        queue_size: Messages (other than commands) that may wait to be written
+        drop_policy: What to do with a message when the queue is full, one of DROP_POLICIES
+        write_timeout: Seconds a write may take before the connection is considered dead, 0 for no limit
+        on_sent: Called with every message written
+        on_drop: Called with the reason (one of DROP_REASONS) for every message dropped
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        name: str,
+        rate: float = 0,
+        queue_size: int = 100,
+        drop_policy: str = DROP_OLDEST,
+        write_timeout: float = 0,
+        on_sent: Optional[Callable[[dict], None]] = None,
+        on_drop: Optional[Callable[[str], None]] = None
+    ):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy '{drop_policy}', expected one of {', '.join(DROP_POLICIES)}")
+        self.websocket = websocket
+        self.name = name
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.write_timeout = write_timeout or None
+        self.on_sent = on_sent
+        self.on_drop = on_drop
+        # Messages other than commands, written in order and ahead of buffered commands
+        self.messages: Deque[OutboundMessage] = deque()
+        # Buffered commands: candlestick_id -> OutboundMessage, oldest first
+        self.commands: Dict[str, OutboundMessage] = {}
+        # When a command was last written for each candlestick (monotonic)
+        self.last_command: Dict[str, float] = {}
+        self.closed = False
+        self._writing: Optional[OutboundMessage] = None
+        self._wakeup = asyncio.Event()
+        # Closing the connection after close(websocket=True)
+        self._closing: Optional[asyncio.Task] = None
+        self._task = asyncio.create_task(self._run(), name=f"writer {name}")
+
+    def send(self, message: Message) -> OutboundMessage:
+        """
+        Queue a message.
+
+        Raises:
+            ConnectionError: If the writer is closed
+            QueueFull: If the queue is full and the drop policy is 'reject'
+        """
+        self._check_open()
+        item = OutboundMessage(message)
+        if len(self.messages) >= self.queue_size:
+            if self.drop_policy == REJECT:
+                raise QueueFull(f"Queue of '{self.name}' is full ({self.queue_size} messages)")
+            if self.drop_policy == DROP_NEWEST:
+                self._drop(item, "queue_full")
+                return item
+            self._drop(self.messages.popleft(), "queue_full")
+        self.messages.append(item)
+        self._wakeup.set()
+        return item
+
+    def buffered(self, candlestick_id: str) -> Optional[OutboundMessage]:
+        """The command buffered for a candlestick and not written yet, if any"""
+        return self.commands.get(candlestick_id)
+
+    def put(self, candlestick_id: str, item: OutboundMessage):
+        """Buffer a command for a candlestick, replacing the one buffered for it"""
+        self._check_open()
+        # A replaced command keeps its place, so candlesticks take turns
+        self.commands[candlestick_id] = item
+        self._wakeup.set()
+
+    def discard(self, candlestick_id: str) -> Optional[OutboundMessage]:
+        """Remove the command buffered for a candlestick, e.g. when it moves to another connection"""
+        self.last_command.pop(candlestick_id, None)
+        return self.commands.pop(candlestick_id, None)
+
+    def close(self, websocket: bool = False):
+        """
+        Stop the writer, messages not written yet are dropped. With websocket, the connection
+        is closed as well, e.g. when it is superseded by a reconnect.
+        """
+        if not self.closed:
+            self._task.cancel()
+            self._stop("closed")
+        if websocket and self._closing is None:
+            self._closing = asyncio.create_task(self._close_websocket())
+
+    def _check_open(self):
+        if self.closed:
+            raise ConnectionError(f"Connection to '{self.name}' is closed")
+
+    def _drop(self, item: OutboundMessage, reason: str):
+        item.done(False)
+        if self.on_drop:
+            self.on_drop(reason)
+
+    def _stop(self, reason: str):
+        """Mark the writer closed and drop everything not written"""
+        self.closed = True
+        pending = list(self.messages) + list(self.commands.values())
+        if self._writing is not None:
+            pending.append(self._writing)
+        self.messages.clear()
+        self.commands.clear()
+        for item in pending:
+            self._drop(item, reason)
+
+    def _next_command(self):
+        """The next command that may be written, or how long until one may be written (None for no command)"""
+        now = time.monotonic()
+        wait = None
+        for candlestick_id in self.commands:
+            due = self.last_command.get(candlestick_id, 0.0) + self.interval
+            if due <= now:
+                self.last_command[candlestick_id] = now
+                return self.commands.pop(candlestick_id), None
+            wait = due - now if wait is None else min(wait, due - now)
+        return None, wait
+
+    async def _write(self, item: OutboundMessage):
+        self._writing = item
+        message = item.message() if callable(item.message) else item.message
+        await asyncio.wait_for(self.websocket.send_text(json.dumps(message)), self.write_timeout)
+        self._writing = None
+        item.done(True)
+        if self.on_sent:
+            self.on_sent(message)
+
+    async def _run(self):
+        try:
+            while True:
+                self._wakeup.clear()
+                if self.messages:
+                    await self._write(self.messages.popleft())
+                    continue
+                item, wait = self._next_command()
+                if item is not None:
+                    await self._write(item)
+                    continue
+                if wait is None:
+                    await self._wakeup.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.error(f"Write to '{self.name}' took longer than {self.write_timeout}s, closing the connection")
+            self._stop("write_timeout")
+            # The receive loop of the connection notices the close and cleans up
+            await self._close_websocket()
+        except Exception as e:
+            # The receive loop of the connection notices the disconnect and cleans up
+            logger.error(f"Failed to write to '{self.name}': {e}")
+            self._stop("closed")
+
+    async def _close_websocket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(), self.write_timeout)
+        except Exception as e:
+            logger.debug(f"Closing '{self.name}' failed: {e}")
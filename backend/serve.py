@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Production entry point of the backend: `python serve.py` (the Docker image's command).
+
+Runs app:app on uvicorn with the tuning profile named by SERVER_PROFILE:
+
+    production:  uvloop event loop and httptools HTTP parser when installed (uvicorn[standard]
+                 installs both), no access log, and no per-message deflate on WebSockets:
+                 controller messages are small JSON, compressing them costs more CPU than it saves
+    development: uvicorn's pure Python asyncio loop and h11 parser with access log, the
+                 baseline of benchmark_server.py
+
+Both use WS_PING_INTERVAL, WS_PING_TIMEOUT and WS_MAX_SIZE for controller connections.
+The backend keeps its state (connections, candlestick states, shows) in the process, so
+it always runs a single worker.
+"""
+
+from importlib.util import find_spec
+import os
+
+import uvicorn
+
+DEFAULT_PROFILE = "production"
+# Controllers send an application heartbeat every 30s, the protocol ping only finds dead connections
+DEFAULT_WS_PING_INTERVAL = 30.0
+DEFAULT_WS_PING_TIMEOUT = 30.0
+# Largest message accepted from a controller (profile uploads are the largest)
+DEFAULT_WS_MAX_SIZE = 4 * 1024 * 1024
+
+SERVER_PROFILES = {
+    "production": {
+        "loop": "uvloop",
+        "http": "httptools",
+        "access_log": False,
+        "server_header": False,
+        "ws_per_message_deflate": False,
+        "timeout_keep_alive": 30,
+    },
+    "development": {
+        "loop": "asyncio",
+        "http": "h11",
+        "access_log": True,
+    },
+}
+
+
+def server_options(profile: str) -> dict:
+    """uvicorn options of a tuning profile, falling back to the pure Python loop and parser when not installed"""
+    if profile not in SERVER_PROFILES:
+        raise ValueError(f"Unknown server profile '{profile}', expected one of {', '.join(SERVER_PROFILES)}")
+    options = dict(SERVER_PROFILES[profile])
+    if options["loop"] == "uvloop" and find_spec("uvloop") is None:
+        options["loop"] = "asyncio"
+    if options["http"] == "httptools" and find_spec("httptools") is None:
+        options["http"] = "h11"
+    options.update(
+        ws_ping_interval=float(os.getenv("WS_PING_INTERVAL", DEFAULT_WS_PING_INTERVAL)),
+        ws_ping_timeout=float(os.getenv("WS_PING_TIMEOUT", DEFAULT_WS_PING_TIMEOUT)),
+        ws_max_size=int(os.getenv("WS_MAX_SIZE", DEFAULT_WS_MAX_SIZE)),
+    )
+    return options
+
+
+def main():
+    profile = os.getenv("SERVER_PROFILE", DEFAULT_PROFILE)
+    options = server_options(profile)
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    print(f"Starting backend on {host}:{port} with the '{profile}' profile: loop={options['loop']}, http={options['http']}", flush=True)
+    uvicorn.run("app:app", host=host, port=port, workers=1, **options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Shows: timelines of commands for several candlesticks.
+
+A show is compiled into one schedule per candlestick: the commands for that
+candlestick with absolute start times in backend time (seconds since the epoch).
+Schedules are sent to the controllers ahead of time and each controller applies
+its commands at the right moment using its estimate of the backend clock, so no
+real-time traffic is needed while the show runs.
+"""
+
+from typing import Dict, List
+
+from models import Show
+
+# Fields of a cue that are sent to the controller as part of a schedule entry
+COMMAND_FIELDS = ("program", "speed", "direction", "color")
+
+
+def validate_show(show: Show):
+    """Raise ValueError if a cue refers to a candlestick that isn't part of the show"""
+    participants = set(show.candlesticks)
+    for index, cue in enumerate(show.cues):
+        unknown = set(cue.candlesticks or ()) - participants
+        if unknown:
+            raise ValueError(f"Cue {index} refers to candlesticks not in the show: {', '.join(sorted(unknown))}")
+        if not any(getattr(cue, field) is not None for field in COMMAND_FIELDS):
+            raise ValueError(f"Cue {index} has no command")
+
+
+def compile_show(show: Show, start_at: float) -> Dict[str, List[dict]]:
+    """
+    Compile a show into per-candlestick schedules.
+
+    Args:
+        show: The show, validated with validate_show()
+        start_at: Backend time (seconds since the epoch) the show starts
+
+    Returns:
+        candlestick_id -> schedule entries ({"at": backend time, command fields...}), ordered by time
+    """
+    schedules: Dict[str, List[dict]] = {candlestick_id: [] for candlestick_id in show.candlesticks}
+    # Stable sort, cues at the same time keep the order they were given in
+    for cue in sorted(show.cues, key=lambda cue: cue.at):
+        entry = {"at": start_at + cue.at}
+        entry.update({field: getattr(cue, field) for field in COMMAND_FIELDS if getattr(cue, field) is not None})
+        for candlestick_id in cue.candlesticks or show.candlesticks:
+            schedules[candlestick_id].append(entry)
+    return schedules
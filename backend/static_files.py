@@ -0,0 +1,205 @@
+"""
+Static file serving of the web frontend.
+
+Vite names the files of the built bundle after a hash of their content
+(assets/index-C8n2Fox-.css), so they are cached forever: a new build references new
+names. Everything else, such as index.html which references them, is revalidated with
+its ETag on every load.
+
+Files up to MEMORY_MAX_SIZE are read into memory at startup, together with gzip and
+brotli variants: prebuilt ones next to the file (index.js.br, index.js.gz, e.g. from a
+build plugin or `gzip -k`), or else compressed once at startup (brotli only when the
+brotli package is installed). They are served without touching the disk, with an ETag
+hashed from the content, so a new frontend build needs a restart. Larger files are
+served from disk, with their prebuilt variants only.
+
+Each client gets the brotli variant if its Accept-Encoding allows, else the gzip one.
+"""
+
+from email.utils import formatdate
+from typing import Dict, Optional, Set
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Content encodings of variants by preference, with their file suffix
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# Directory of the hashed bundle files, relative to the static directory
+HASHED_DIRECTORY = "assets"
+# Name ending of a file named after its content hash by Vite, e.g. index-C8n2Fox-.css
+HASHED_NAME = re.compile(r"-[A-Za-z0-9_-]{8}\.\w+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+# Largest file kept in memory (the built JavaScript bundle is the largest file)
+MEMORY_MAX_SIZE = 1024 * 1024
+# Smaller files aren't worth compressing
+MIN_COMPRESS_SIZE = 256
+# Media types compressed at startup, others (images, fonts) are compressed already
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/manifest+json",
+                      "application/xml", "image/svg+xml", "application/wasm")
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    """Content codings of an Accept-Encoding header, without those refused with q=0"""
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def is_hashed(relative_path: str) -> bool:
+    """Whether a file of the static directory is named after its content"""
+    directory, name = os.path.split(relative_path)
+    return directory == HASHED_DIRECTORY and HASHED_NAME.search(name) is not None
+
+
+def cache_control(relative_path: str) -> str:
+    return IMMUTABLE if is_hashed(relative_path) else REVALIDATE
+
+
+def compress(content: bytes, encoding: str) -> Optional[bytes]:
+    """Compress with a content coding of ENCODINGS, None if it isn't available"""
+    if encoding == "gzip":
+        # No timestamp, so the variant (and its ETag) is the same on every start
+        return gzip.compress(content, compresslevel=9, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(content, quality=11)
+    return None
+
+
+class MemoryFile:
+    """A static file held in memory, with its compressed variants by content coding (None for the file itself)"""
+
+    def __init__(self, content: bytes, media_type: str, modified: float, relative_path: str):
+        self.bodies: Dict[Optional[str], bytes] = {None: content}
+        self.media_type = media_type
+        self.last_modified = formatdate(modified, usegmt=True)
+        self.cache_control = cache_control(relative_path)
+        self.etag = hashlib.sha1(content).hexdigest()[:20]
+
+
+class FrontendFiles(StaticFiles):
+    """StaticFiles with cache headers, compressed variants and small files served from memory"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Files in memory by path relative to the directory, with '/' separators
+        self.memory: Dict[str, MemoryFile] = {}
+        if self.directory is not None and os.path.isdir(self.directory):
+            self._load(str(self.directory))
+
+    def _load(self, directory: str):
+        """Read the files up to MEMORY_MAX_SIZE with their variants"""
+        suffixes = tuple(suffix for _, suffix in ENCODINGS)
+        built = 0
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(suffixes) and os.path.isfile(os.path.splitext(path)[0]):
+                    # A prebuilt variant, read with its file
+                    continue
+                try:
+                    if os.path.getsize(path) > MEMORY_MAX_SIZE:
+                        continue
+                    with open(path, "rb") as f:
+                        content = f.read()
+                    relative_path = os.path.relpath(path, directory).replace(os.sep, "/")
+                    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                    file = MemoryFile(content, media_type, os.path.getmtime(path), relative_path)
+                    compressible = len(content) >= MIN_COMPRESS_SIZE and media_type.startswith(COMPRESSIBLE_TYPES)
+                    for encoding, suffix in ENCODINGS:
+                        if os.path.isfile(path + suffix):
+                            with open(path + suffix, "rb") as f:
+                                variant = f.read()
+                        elif compressible:
+                            variant = compress(content, encoding)
+                            built += variant is not None
+                        else:
+                            variant = None
+                        if variant is not None and len(variant) < len(content):
+                            file.bodies[encoding] = variant
+                except OSError as e:
+                    logger.warning(f"Serving {path} from disk, reading it failed: {e}")
+                    continue
+                self.memory[relative_path] = file
+        size = sum(len(body) for file in self.memory.values() for body in file.bodies.values())
+        logger.info(f"Serving {len(self.memory)} frontend files from memory ({size / 1024:.0f} kB, {built} variants compressed at startup)")
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        # The root directory is "." and serves index.html (other directories are left to StaticFiles for the redirect)
+        file = self.memory.get("index.html" if path == "." else path.replace(os.sep, "/"))
+        if file is None or scope["method"] not in ("GET", "HEAD"):
+            return await super().get_response(path, scope)
+        return self.memory_response(file, Headers(scope=scope))
+
+    def memory_response(self, file: MemoryFile, request_headers: Headers) -> Response:
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        encoding = next((encoding for encoding, _ in ENCODINGS if encoding in accepted and encoding in file.bodies), None)
+        headers = {
+            # Each variant needs its own ETag, caches store them separately
+            "etag": f'"{file.etag}-{encoding}"' if encoding else f'"{file.etag}"',
+            "last-modified": file.last_modified,
+            "cache-control": file.cache_control,
+            "vary": "Accept-Encoding",
+        }
+        if encoding:
+            headers["content-encoding"] = encoding
+        if self.is_not_modified(Headers(headers=headers), request_headers):
+            return NotModifiedResponse(Headers(headers=headers))
+        return Response(file.bodies[encoding], media_type=file.media_type, headers=headers)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        """Files not in memory, with their prebuilt variants"""
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                variant_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            response = FileResponse(
+                full_path + suffix,
+                status_code=status_code,
+                stat_result=variant_stat,
+                media_type=mimetypes.guess_type(full_path)[0] or "application/octet-stream",
+                headers={"Content-Encoding": encoding}
+            )
+            break
+        if response is None:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result)
+
+        relative_path = os.path.relpath(full_path, os.path.realpath(self.directory)).replace(os.sep, "/")
+        response.headers["Cache-Control"] = cache_control(relative_path)
+        response.headers["Vary"] = "Accept-Encoding"
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
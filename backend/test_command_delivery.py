@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Test of command delivery to controllers, in process with FastAPI's TestClient (no backend
+or hardware needed): merging of queued commands, sequence IDs and acks, stale updates,
+If-Match, messages with an invalid type, the reject drop policy and the write timeout.
+
+A stalled connection is simulated by replacing the socket of the connection's writer
+with one whose sends never finish.
+
+Run from backend/: `python3 test_command_delivery.py` (or with pytest)
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+
+from fastapi.testclient import TestClient
+
+from app import app, manager
+
+STATUS = {"type": "status", "program": "random", "random": True, "speed": 10, "direction": None, "color": None}
+
+
+class StalledSocket:
+    """Socket of a controller that stopped reading: sends never finish"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    async def send_text(self, data: str):
+        await asyncio.sleep(3600)
+
+    async def close(self, *args, **kwargs):
+        await self.websocket.close(*args, **kwargs)
+
+
+@contextmanager
+def writer_options(**options):
+    """Options of the writers of connections made within the block"""
+    original = dict(manager.writer_options)
+    manager.writer_options.update(options)
+    try:
+        yield
+    finally:
+        manager.writer_options.clear()
+        manager.writer_options.update(original)
+
+
+def check(condition: bool, description: str):
+    print(f"  {'✓' if condition else '❌'} {description}")
+    if not condition:
+        raise AssertionError(description)
+
+
+def wait_until(condition, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_merge_and_ack():
+    print("\nMerging, acks and stale updates")
+    candlestick_id = "test_merge"
+    with writer_options(rate=1), TestClient(app) as client:
+        with client.websocket_connect(f"/ws/{candlestick_id}") as controller:
+            controller.send_json({**STATUS, "epoch": "e1", "revision": 1})
+            check(wait_until(lambda: manager.reported_revisions.get(candlestick_id) == ("e1", 1)), "Initial status applied")
+            url = f"/api/candlesticks/{candlestick_id}/command"
+
+            first = client.post(url, json={"speed": 5}).json()
+            check(controller.receive_json() == {"type": "command", "seq": first["seq"], "speed": 5}, "First command written right away")
+            # Rate limited to one command per second: these wait and merge
+            client.post(url, json={"program": "rb", "direction": "left"})
+            third = client.post(url, json={"direction": "right", "speed": 20}).json()
+            merged = controller.receive_json()
+            check(merged == {"type": "command", "seq": third["seq"], "program": "rb", "direction": "right", "speed": 20},
+                  "Queued commands merged, later fields win, sent with the latest seq")
+            events = client.get(f"/api/candlesticks/{candlestick_id}/events").json()["events"]
+            check(any(event["data"].get("replaces") == third["seq"] - 1 for event in events), "Merge recorded in the event log")
+
+            controller.send_json({"type": "ack", "seq": first["seq"], "epoch": "e1", "revision": 2})
+            controller.send_json({"type": "ack", "seq": merged["seq"], "epoch": "e1", "revision": 3})
+            check(wait_until(lambda: manager.get_state(candlestick_id).program == "rb"), "State updated from the acked command")
+            state = manager.get_state(candlestick_id)
+            check((state.speed, state.direction) == (20, "right"), "Fields of the merged command")
+            check(manager.reported_revisions[candlestick_id] == ("e1", 3), "Revision of the ack")
+
+            # A status that was overtaken by the acks
+            controller.send_json({**STATUS, "program": "wave", "epoch": "e1", "revision": 2})
+            # A heartbeat after it, handled once the status has been
+            controller.send_json({"type": "heartbeat"})
+            time.sleep(0.2)
+            check(manager.get_state(candlestick_id).program == "rb", "Stale status dropped")
+
+
+def test_if_match():
+    print("\nIf-Match")
+    candlestick_id = "test_if_match"
+    with TestClient(app) as client:
+        with client.websocket_connect(f"/ws/{candlestick_id}") as controller:
+            controller.send_json({**STATUS, "epoch": "e1", "revision": 1})
+            check(wait_until(lambda: manager.reported_revisions.get(candlestick_id) == ("e1", 1)), "Initial status applied")
+            response = client.get(f"/api/candlesticks/{candlestick_id}")
+            etag = response.headers["etag"]
+            url = f"/api/candlesticks/{candlestick_id}/command"
+
+            stale = client.post(url, json={"speed": 30}, headers={"If-Match": f'"{response.json()["version"] + 1}"'})
+            check(stale.status_code == 412, "Command based on another version rejected with 412")
+            current = client.post(url, json={"speed": 30}, headers={"If-Match": etag})
+            check(current.status_code == 200, "Command based on the current version sent")
+            check(controller.receive_json()["speed"] == 30, "Controller received it")
+
+
+def test_invalid_type_ignored():
+    print("\nInvalid message types")
+    candlestick_id = "test_invalid_type"
+    with TestClient(app) as client:
+        with client.websocket_connect(f"/ws/{candlestick_id}") as controller:
+            controller.send_json(STATUS)
+            check(wait_until(lambda: manager.is_connected(candlestick_id)), "Connected")
+            controller.send_json({"type": ["status"]})
+            controller.send_json(["status"])
+            controller.send_json({**STATUS, "program": "wave"})
+            check(wait_until(lambda: manager.get_state(candlestick_id).program == "wave"), "Messages after them handled")
+            check(manager.is_connected(candlestick_id), "Connection kept")
+        with client.websocket_connect("/ws/gateway/test_invalid_gateway") as gateway:
+            gateway.send_json({"type": "attach", "candlestick_ids": [candlestick_id]})
+            check(wait_until(lambda: manager.is_attached("test_invalid_gateway", candlestick_id)), "Attached to a gateway")
+            gateway.send_json({"type": "batch", "messages": [{"type": {"x": 1}}, {**STATUS, "candlestick_id": ["x"]}]})
+            gateway.send_json({**STATUS, "program": "rb", "candlestick_id": candlestick_id})
+            check(wait_until(lambda: manager.get_state(candlestick_id).program == "rb"), "Gateway messages after them handled")
+            check(manager.is_attached("test_invalid_gateway", candlestick_id), "Gateway connection kept")
+
+
+def test_reject_keeps_connection():
+    print("\nReject drop policy")
+    candlestick_id = "test_reject"
+    with writer_options(queue_size=1, drop_policy="reject", write_timeout=0), TestClient(app) as client:
+        with client.websocket_connect(f"/ws/{candlestick_id}") as controller:
+            controller.send_json(STATUS)
+            check(wait_until(lambda: manager.is_connected(candlestick_id)), "Connected")
+            writer = manager.writers[candlestick_id]
+            writer.websocket = StalledSocket(writer.websocket)
+
+            # The first pong blocks the writer, the second fills the queue, the others are rejected
+            for seq in range(4):
+                controller.send_json({"type": "clock_ping", "seq": seq, "t0": time.time()})
+            controller.send_json({"type": "heartbeat"})
+            check(wait_until(lambda: len(writer.messages) == 1), "Queue full")
+            response = client.post(f"/api/candlesticks/{candlestick_id}/profile?duration=1")
+            check(response.status_code == 503, f"Profile request rejected with 503 ({response.json()['detail']})")
+            time.sleep(0.1)
+            check(manager.is_connected(candlestick_id) and not writer.closed, "Connection kept")
+
+
+def test_write_timeout_closes_connection():
+    print("\nWrite timeout")
+    candlestick_id = "test_write_timeout"
+    with writer_options(write_timeout=0.2), TestClient(app) as client:
+        with client.websocket_connect(f"/ws/{candlestick_id}") as controller:
+            controller.send_json(STATUS)
+            check(wait_until(lambda: manager.is_connected(candlestick_id)), "Connected")
+            writer = manager.writers[candlestick_id]
+            writer.websocket = StalledSocket(writer.websocket)
+
+            response = client.post(f"/api/candlesticks/{candlestick_id}/command?sent=true&timeout=2", json={"speed": 40})
+            check(response.status_code == 503, f"Command not written, 503 ({response.json()['detail']})")
+            check(writer.closed, "Writer stopped")
+            check(controller.receive()["type"] == "websocket.close", "Connection closed by the backend")
+        check(wait_until(lambda: not manager.is_connected(candlestick_id)), "Candlestick disconnected")
+
+
+def main():
+    print("=" * 60)
+    print("RGB Candlestick command delivery test")
+    print("=" * 60)
+    test_merge_and_ack()
+    test_if_match()
+    test_invalid_type_ignored()
+    test_reject_keeps_connection()
+    test_write_timeout_closes_connection()
+    print("\n✓ Tests completed!")
+
+
+if __name__ == "__main__":
+    main()
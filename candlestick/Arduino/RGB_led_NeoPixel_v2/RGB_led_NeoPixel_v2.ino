@@ -0,0 +1,151 @@
+#include <Adafruit_NeoPixel.h>
+
+// NeoPixel sketch speaking the v2 serial protocol (see controller/src/candlestick/protocol.py)
+//
+// A packet is [version, type, payload..., crc8], COBS encoded and terminated by 0x00.
+// Unlike the original sketch, every byte value (including 254 and 255) can be used
+// as a color, corrupted packets are dropped and the receiver resynchronizes at the
+// next 0x00.
+//
+// Run the controller with `--serial-protocol v2` (the default baud rate for v2 is 1000000).
+
+#define PIN 6
+// Must match the LED count of the controller layout (--leds), one strip per sketch
+#define NUM_LEDS 7
+#define BAUD 1000000
+
+#define PROTOCOL_VERSION 2
+#define FULL_FRAME 0x01
+#define PARTIAL_FRAME 0x02
+
+// Largest decoded packet: version, type, 4 bytes per LED (partial frame), crc.
+// COBS adds one byte per 254 bytes, plus one.
+#define MAX_PACKET (3 + NUM_LEDS * 4 + 2 + NUM_LEDS * 4 / 254)
+
+Adafruit_NeoPixel strip = Adafruit_NeoPixel(NUM_LEDS, PIN, NEO_GRB + NEO_KHZ800);
+
+byte encoded[MAX_PACKET];
+byte decoded[MAX_PACKET];
+uint16_t encodedLength = 0;
+boolean overflow = false;
+unsigned long last_ping = millis();
+
+
+void setup() {
+  Serial.begin(BAUD);
+  strip.begin();
+  strip.show(); // Initialize all pixels to 'off'
+}
+
+// CRC-8, polynomial 0x07, initial value 0
+byte crc8(const byte *data, uint16_t length) {
+  byte crc = 0;
+  for (uint16_t i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (byte bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+    }
+  }
+  return crc;
+}
+
+// Returns the decoded length, or -1 if the data isn't valid COBS
+int cobsDecode(const byte *in, uint16_t length, byte *out) {
+  uint16_t read = 0;
+  uint16_t write = 0;
+  while (read < length) {
+    byte code = in[read];
+    if (code == 0 || read + code > length + 1) {
+      return -1;
+    }
+    read++;
+    for (byte i = 1; i < code; i++) {
+      out[write++] = in[read++];
+    }
+    if (code < 0xFF && read < length) {
+      out[write++] = 0;
+    }
+  }
+  return write;
+}
+
+// Same channel order as the original sketch, the controller sends R, G, B
+void setPixel(uint16_t index, const byte *rgb) {
+  strip.setPixelColor(index, rgb[1], rgb[2], rgb[0]);
+}
+
+void handlePacket(const byte *packet, int length) {
+  if (length < 3 || crc8(packet, length - 1) != packet[length - 1]) {
+    return;
+  }
+  if (packet[0] != PROTOCOL_VERSION) {
+    return;
+  }
+
+  const byte *payload = packet + 2;
+  int payloadLength = length - 3;
+
+  if (packet[1] == FULL_FRAME) {
+    if (payloadLength != NUM_LEDS * 3) {
+      return;
+    }
+    for (uint16_t i = 0; i < NUM_LEDS; i++) {
+      setPixel(i, payload + i * 3);
+    }
+  }
+  else if (packet[1] == PARTIAL_FRAME) {
+    if (payloadLength % 4 != 0) {
+      return;
+    }
+    for (int i = 0; i < payloadLength; i += 4) {
+      if (payload[i] < NUM_LEDS) {
+        setPixel(payload[i], payload + i + 1);
+      }
+    }
+  }
+  else {
+    return;
+  }
+  strip.show();
+}
+
+void receivePackets() {
+  while (Serial.available() > 0) {
+    byte rb = Serial.read();
+
+    if (rb == 0) {
+      if (!overflow && encodedLength > 0) {
+        int length = cobsDecode(encoded, encodedLength, decoded);
+        if (length > 0) {
+          handlePacket(decoded, length);
+        }
+      }
+      encodedLength = 0;
+      overflow = false;
+    }
+    else if (encodedLength < MAX_PACKET) {
+      encoded[encodedLength++] = rb;
+    }
+    else {
+      // Too long, drop everything until the next packet boundary
+      overflow = true;
+    }
+  }
+}
+
+// Ping every 30 seconds just to tell python that we're alive
+void ping() {
+  unsigned long now = millis();
+  if (now > last_ping + 30000) {
+    unsigned long uptime = now / 1000;
+    String string = "Ping, Uptime: ";
+    string += uptime;
+    Serial.println(string);
+    last_ping = now;
+  }
+}
+
+void loop() {
+  ping();
+  receivePackets();
+}
@@ -7,9 +7,11 @@ import asyncio
 import websockets
 import json
 import logging
-from typing import Optional, Callable, Dict, Any
+from typing import Optional, Callable, Awaitable, Dict, Any, List
 from datetime import datetime
 
+from clock_sync import ClockSync
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,12 +35,38 @@ class BackendClient:
         self.backend_url = backend_url
         self.candlestick_id = candlestick_id
         self.command_callback = command_callback
+        # Handlers for incoming message types: type -> callback(message)
+        self.message_handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {"command": command_callback}
         self.websocket: Optional[websockets.WebSocketClientProtocol] = None
         self.connected = False
         self.reconnect_delay = 5  # seconds
         self.heartbeat_interval = 30  # seconds
         self._running = False
+        # Counters reported in the controller metrics
+        self.reconnects = 0
+        self.invalid_messages = 0
+        # Estimate of the backend clock, from clock_ping/clock_pong exchanges
+        self.clock = ClockSync()
+        self.message_handlers["clock_pong"] = self.clock.handle_pong
+        # Coroutine functions called with True when connected, False when the connection is lost or fails
+        self.connection_handlers: List[Callable[[bool], Awaitable[None]]] = []
         
+    def add_message_handler(self, message_type: str, callback: Callable[[Dict[str, Any]], None]):
+        """Register a callback (sync or async) for messages of the given type from the backend"""
+        self.message_handlers[message_type] = callback
+    
+    def add_connection_handler(self, callback: Callable[[bool], Awaitable[None]]):
+        """Register a coroutine function called with True on (re)connect and False when the connection is lost or fails"""
+        self.connection_handlers.append(callback)
+    
+    async def connection_changed(self, connected: bool):
+        """Call the connection handlers"""
+        for handler in self.connection_handlers:
+            try:
+                await handler(connected)
+            except Exception as e:
+                logger.error(f"Error in connection handler: {e}")
+    
     async def connect(self):
         """Establish WebSocket connection to the backend"""
         ws_url = f"{self.backend_url}/ws/{self.candlestick_id}"
@@ -48,11 +76,11 @@ class BackendClient:
             self.websocket = await websockets.connect(ws_url)
             self.connected = True
             logger.info("Connected to backend successfully")
-            return True
         except Exception as e:
             logger.error(f"Failed to connect to backend: {e}")
             self.connected = False
-            return False
+        await self.connection_changed(self.connected)
+        return self.connected
     
     async def disconnect(self):
         """Close the WebSocket connection"""
@@ -62,18 +90,29 @@ class BackendClient:
         self.connected = False
         logger.info("Disconnected from backend")
     
+    async def send_message(self, message: Dict[str, Any]):
+        """Send a message to the backend. Raises on connection errors."""
+        await self.websocket.send(json.dumps(message))
+    
     async def send_status(
         self,
         program: Optional[str] = None,
         random: Optional[bool] = None,
         speed: Optional[int] = None,
         direction: Optional[str] = None,
-        color: Optional[str] = None
-    ):
-        """Send status update to the backend"""
+        color: Optional[str] = None,
+        timing: Optional[Dict[str, Any]] = None,
+        epoch: Optional[str] = None,
+        revision: Optional[int] = None
+    ) -> bool:
+        """
+        Send status update to the backend.
+        epoch and revision identify the state in the controller's state cache (see state_cache.py).
+        Returns whether the status was sent.
+        """
         if not self.connected or not self.websocket:
             logger.warning("Cannot send status - not connected to backend")
-            return
+            return False
         
         message = {
             "type": "status",
@@ -81,15 +120,101 @@ class BackendClient:
             "random": random,
             "speed": speed,
             "direction": direction,
-            "color": color
+            "color": color,
+            "timing": timing,
+            "epoch": epoch,
+            "revision": revision
         }
         
         try:
-            await self.websocket.send(json.dumps(message))
+            await self.send_message(message)
             logger.info(f"Sent status update: {message}")
+            return True
         except Exception as e:
             logger.error(f"Failed to send status: {e}")
             self.connected = False
+            return False
+    
+    async def send_ack(
+        self,
+        seq: int,
+        received_at: Optional[float] = None,
+        applied_at: Optional[float] = None,
+        first_frame_at: Optional[float] = None,
+        error: Optional[str] = None,
+        epoch: Optional[str] = None,
+        revision: Optional[int] = None
+    ):
+        """
+        Acknowledge a command, with timestamps (time.time()) for latency measurement.
+        epoch and revision identify the state in the state cache right after applying the command.
+        """
+        if not self.connected or not self.websocket:
+            logger.warning(f"Cannot send ack for command {seq} - not connected to backend")
+            return
+        
+        message = {
+            "type": "ack",
+            "seq": seq,
+            "received_at": received_at,
+            "applied_at": applied_at,
+            "first_frame_at": first_frame_at,
+            "error": error,
+            "epoch": epoch,
+            "revision": revision
+        }
+        
+        try:
+            await self.send_message(message)
+            logger.debug(f"Sent ack: {message}")
+        except Exception as e:
+            logger.error(f"Failed to send ack: {e}")
+            self.connected = False
+    
+    async def send_metrics(self, metrics: Dict[str, Any]):
+        """Push controller metrics to the backend"""
+        if not self.connected or not self.websocket:
+            return
+        
+        message = {"type": "metrics", **metrics}
+        
+        try:
+            await self.send_message(message)
+            logger.debug(f"Sent metrics: {message}")
+        except Exception as e:
+            logger.error(f"Failed to send metrics: {e}")
+            self.connected = False
+    
+    async def send_profile(
+        self,
+        profile_id: str,
+        target: str,
+        duration: float,
+        collapsed: Optional[str] = None,
+        samples: int = 0,
+        error: Optional[str] = None
+    ):
+        """Upload a profile (collapsed stacks) to the backend"""
+        if not self.connected or not self.websocket:
+            logger.warning(f"Cannot upload profile {profile_id} - not connected to backend")
+            return
+        
+        message = {
+            "type": "profile_result",
+            "profile_id": profile_id,
+            "target": target,
+            "duration": duration,
+            "samples": samples,
+            "collapsed": collapsed,
+            "error": error
+        }
+        
+        try:
+            await self.send_message(message)
+            logger.info(f"Uploaded profile {profile_id} ({target}, {samples} samples)")
+        except Exception as e:
+            logger.error(f"Failed to upload profile: {e}")
+            self.connected = False
     
     async def send_heartbeat(self):
         """Send heartbeat to keep connection alive"""
@@ -99,12 +224,28 @@ class BackendClient:
         message = {"type": "heartbeat"}
         
         try:
-            await self.websocket.send(json.dumps(message))
+            await self.send_message(message)
             logger.debug("Sent heartbeat")
         except Exception as e:
             logger.error(f"Failed to send heartbeat: {e}")
             self.connected = False
     
+    async def handle_message(self, data: Dict[str, Any]):
+        """Pass a decoded message from the backend to the handler for its type"""
+        try:
+            handler = self.message_handlers.get(data.get("type"))
+            if handler:
+                # Pass message to callback (handle both sync and async callbacks)
+                if asyncio.iscoroutinefunction(handler):
+                    await handler(data)
+                else:
+                    handler(data)
+            else:
+                logger.warning(f"Unknown message type: {data.get('type')}")
+        except Exception as e:
+            self.invalid_messages += 1
+            logger.error(f"Error processing message: {e}")
+    
     async def receive_messages(self):
         """Receive and process messages from the backend"""
         if not self.websocket:
@@ -115,20 +256,11 @@ class BackendClient:
                 try:
                     data = json.loads(message)
                     logger.debug(f"Received message: {data}")
-                    
-                    if data.get("type") == "command":
-                        # Pass command to callback (handle both sync and async callbacks)
-                        if asyncio.iscoroutinefunction(self.command_callback):
-                            await self.command_callback(data)
-                        else:
-                            self.command_callback(data)
-                    else:
-                        logger.warning(f"Unknown message type: {data.get('type')}")
-                        
                 except json.JSONDecodeError as e:
+                    self.invalid_messages += 1
                     logger.error(f"Failed to parse message: {e}")
-                except Exception as e:
-                    logger.error(f"Error processing message: {e}")
+                    continue
+                await self.handle_message(data)
                     
         except websockets.exceptions.ConnectionClosed:
             logger.warning("WebSocket connection closed")
@@ -144,6 +276,17 @@ class BackendClient:
                 await self.send_heartbeat()
             await asyncio.sleep(self.heartbeat_interval)
     
+    async def clock_sync_loop(self):
+        """Send periodic clock pings to the backend, the answers update self.clock"""
+        while self._running:
+            if self.connected:
+                try:
+                    await self.send_message(self.clock.ping())
+                except Exception as e:
+                    logger.error(f"Failed to send clock ping: {e}")
+                    self.connected = False
+            await asyncio.sleep(self.clock.next_interval())
+    
     async def run(self):
         """
         Main run loop with automatic reconnection.
@@ -159,19 +302,25 @@ class BackendClient:
                     logger.info(f"Retrying connection in {self.reconnect_delay} seconds...")
                     await asyncio.sleep(self.reconnect_delay)
                     continue
+                self.reconnects += 1
             
-            # Start heartbeat task
+            # Start heartbeat and clock sync tasks
             heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+            clock_task = asyncio.create_task(self.clock_sync_loop())
             
             # Receive messages (blocks until disconnection)
             await self.receive_messages()
+            self.connected = False
+            if self._running:
+                await self.connection_changed(False)
             
-            # Cancel heartbeat task
-            heartbeat_task.cancel()
-            try:
-                await heartbeat_task
-            except asyncio.CancelledError:
-                pass
+            # Cancel heartbeat and clock sync tasks
+            for task in (heartbeat_task, clock_task):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
             
             # Connection lost, retry
             if self._running:
@@ -1,2 +1,35 @@
-from .main import run_program, set_color
-from .serial_controller import SerialController
\ No newline at end of file
+"""
+Candlestick animations and serial output.
+
+Names are imported on first use, so importing the package (or one of its light
+modules, e.g. candlestick.worker) doesn't pull in the patterns, pyserial or asyncio.
+"""
+
+import importlib
+
+# Exported name -> module
+_exports = {
+    "run_program": ".main",
+    "set_color": ".main",
+    "blank": ".main",
+    "blank_wrapper": ".main",
+    "SerialController": ".serial_controller",
+    "DEFAULT_SERIAL_PORT": ".serial_controller",
+    "FrameStats": ".stats",
+    "parse_layout": ".layout",
+    "AnimationWorker": ".worker",
+    "AsyncSerialController": ".async_serial",
+    "run_program_async": ".async_serial",
+    "set_color_async": ".async_serial",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,175 @@
+"""
+Serial output for patterns running as asyncio tasks, in the controller process.
+
+Patterns are played as coroutines (play_async, run_program_async) on the
+controller's event loop, next to the backend connection. Writing to the serial
+port blocks, so frames are handed to a writer thread through a small bounded
+queue. Queueing a frame never blocks the event loop: when the writer falls behind,
+the oldest queued frame is dropped, so the candlestick shows the latest frame with
+at most queue_size frames of delay.
+"""
+
+import asyncio
+import logging
+import queue
+import random
+import threading
+import time
+
+from .frame_clock import FrameClock, frame_period
+from .main import specs
+from .patterns import directions
+from .serial_controller import SerialController
+
+logger = logging.getLogger(__name__)
+
+# Frames that may wait for the writer thread
+DEFAULT_QUEUE_SIZE = 2
+
+
+class AsyncSerialController:
+    """
+    Wraps a SerialController for use from asyncio. Offers the attributes patterns
+    use (layout, led_count, programs, frame_stats) and a non-blocking send_frame().
+    """
+
+    def __init__(self, controller: SerialController, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.controller = controller
+        self.layout = controller.layout
+        self.led_count = controller.led_count
+        self.programs = controller.programs
+        self.frame_stats = controller.frame_stats
+        # Frames dropped because the writer thread was behind
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._write_frames, name=f"serial-writer {controller.serial_port}", daemon=True)
+        self._thread.start()
+
+    def send_frame(self, frame: bytes):
+        """Queue a prepared frame for the writer thread, never blocks"""
+        while True:
+            try:
+                self._queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def flush(self):
+        # Frames are queued as they are sent, nothing is pending (called by the frame clock)
+        pass
+
+    def set_all(self, color):
+        """Set all LEDs to the same color"""
+        self.send_frame(bytes(color) * self.layout.physical_led_count)
+
+    def _write_frames(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            try:
+                self.controller.send_frame(frame)
+            except Exception as e:
+                logger.error("Failed to write frame: %s", e)
+
+    def close(self, timeout: float = 1.0):
+        """Stop the writer thread once the queued frames are written"""
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.warning("Serial writer is stuck, not waiting for it")
+            return
+        self._thread.join(timeout)
+
+
+class AsyncFrameClock(FrameClock):
+    """
+    FrameClock for patterns running as asyncio tasks.
+    tick() and tick_period() are coroutines that yield to the event loop while waiting,
+    and also when the frame is late, so a pattern never starves the loop.
+    """
+
+    async def tick(self, delay):
+        return await self.tick_period(frame_period(delay, self.speed.value))
+
+    async def tick_period(self, period):
+        late = self._advance(period)
+        await asyncio.sleep(max(-late, 0))
+        self._frame_done()
+        return late
+
+
+async def play_async(controller, program, speed=10, clock=None, delay=None):
+    """play() as a coroutine, for an AsyncSerialController on the controller's event loop"""
+    if clock is None:
+        clock = AsyncFrameClock(speed, controller)
+    frames = program.frames
+    delay = program.delay if delay is None else delay
+    send_frame = controller.send_frame
+    for frame_id, hold in zip(program.steps, program.holds):
+        send_frame(frames[frame_id])
+        if hold:
+            await clock.tick(delay * hold)
+    return clock
+
+
+async def run_pattern_async(controller, spec, rounds=None, direction=None, color=None, speed=10, delay=None):
+    """run_pattern() as a coroutine"""
+    program = controller.programs.get(spec, controller.layout, direction, rounds, color)
+    logger.info("%s, direction: %s, %s steps", program.name, program.direction, len(program))
+    await play_async(controller, program, speed, delay=delay)
+
+
+async def wait_until_async(start_at):
+    """wait_until() as a coroutine"""
+    if start_at is None:
+        return
+    delay = start_at - time.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    elif delay < -0.05:
+        logger.warning("Started %.0fms after the requested start time", -delay * 1000)
+
+
+async def run_program_async(controller, program, speed, direction=None, current_program_shared=None, current_direction_shared=None, start_at=None, on_change=None):
+    """
+    run_program() as a coroutine, runs on the controller's event loop until cancelled.
+    controller is an AsyncSerialController. on_change is called whenever the program
+    and direction in the shared values change.
+    """
+    await wait_until_async(start_at)
+
+    if direction is None:
+        direction = random.choice(directions)
+
+    reported = None
+    while True:
+        if program == "random":
+            name = random.choice(list(specs))
+            run_direction = random.choice(directions)
+            logger.info("Random program, Starting: %s with direction: %s", name, run_direction)
+        else:
+            name, run_direction = program, direction
+        # Normalize rb2 to rb for status reporting
+        program_to_report = 'rb' if name == 'rb2' else name
+        if current_program_shared is not None:
+            current_program_shared.value = program_to_report.encode('utf-8')
+        if current_direction_shared is not None:
+            current_direction_shared.value = run_direction.encode('utf-8')
+        if on_change is not None and (program_to_report, run_direction) != reported:
+            reported = (program_to_report, run_direction)
+            on_change()
+        await run_pattern_async(controller, specs[name], direction=run_direction, speed=speed)
+        # Never starve the event loop, even with a pattern that doesn't wait
+        await asyncio.sleep(0)
+
+
+async def set_color_async(controller, rgb_color, start_at=None):
+    """set_color() as a coroutine for an AsyncSerialController"""
+    await wait_until_async(start_at)
+    logger.info("Setting color to static value from API")
+    controller.set_all(rgb_color)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+'''
+Render cost per frame for each pattern at different LED counts, without hardware.
+Patterns are compiled (see candlestick.program), then played as fast as possible
+(no frame period) without writing frames anywhere.
+Use as `python -m candlestick.benchmark [led counts...]` from a parent directory,
+e.g. `python -m candlestick.benchmark 7 60 300 7,7`
+'''
+
+import sys
+import time
+from .serial_controller import SerialController
+from .stats import FrameStats
+from .program import compile_pattern, play
+from .patterns import COP, BOUNCE, WAVE, FALL, RAINBOW
+
+# Speed high enough that the frame period is effectively zero
+BENCHMARK_SPEED = 10 ** 6
+
+# Pattern spec and direction
+patterns = {
+    'cop': (COP, None),
+    'bounce': (BOUNCE, "right"),
+    'wave': (WAVE, "up"),
+    'fall': (FALL, "down"),
+    'rb': (RAINBOW, "left"),
+}
+
+
+def benchmark(layout):
+    print(f"\nLayout {layout}")
+    for name, (spec, direction) in patterns.items():
+        frame_stats = FrameStats()
+        controller = SerialController(frame_stats=frame_stats, port=None, layout=layout)
+        started = time.perf_counter()
+        program = compile_pattern(spec, controller.layout, direction, rounds=2)
+        compiled = time.perf_counter()
+        play(controller, program, BENCHMARK_SPEED)
+        elapsed = time.perf_counter() - compiled
+        frames = frame_stats.frames + frame_stats.skipped
+        print(f"  {name:<8} {frames:>5} frames  {elapsed / max(frames, 1) * 1e6:8.1f} µs/frame"
+              f"  compile {(compiled - started) * 1e3:7.2f} ms  {program.nbytes:>7} bytes")
+
+
+if __name__ == "__main__":
+    for layout in sys.argv[1:] or ["7", "60", "300"]:
+        benchmark(layout)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+'''
+CPU and memory of the two ways to run patterns, without hardware:
+
+    process: one animation worker process per candlestick, the controller's default
+    async:   patterns as asyncio tasks in the controller process with a serial writer
+             thread per candlestick (--async-serial)
+
+Each model runs in a fresh process for the given time at normal speed. CPU is user +
+system time of the model's processes, memory the sum of their proportional set size
+(resident size where PSS isn't available). Run it on the target (e.g. a Pi) as
+`python -m candlestick.benchmark_async [seconds] [candlestick counts...]` from a parent
+directory, e.g. `python -m candlestick.benchmark_async 30 1 4`
+'''
+
+import asyncio
+import os
+import resource
+import sys
+import time
+from multiprocessing import Process, Queue, Value
+from .worker import AnimationWorker
+from .async_serial import AsyncSerialController, run_program_async
+from .serial_controller import SerialController
+from .stats import FrameStats
+
+PROGRAM = 'rb'
+SPEED = 10
+
+
+def memory_kb(pid):
+    '''Proportional set size (kB) of a process, its resident size where PSS isn't available'''
+    for path, field in ((f"/proc/{pid}/smaps_rollup", "Pss:"), (f"/proc/{pid}/status", "VmRSS:")):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except OSError:
+            continue
+    return 0
+
+
+def cpu_seconds():
+    '''User + system time of this process and its waited for children'''
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+    )
+
+
+def process_model(count, seconds, results):
+    workers = [AnimationWorker({'port': None}, SPEED) for _ in range(count)]
+    for worker in workers:
+        worker.run_program(PROGRAM)
+    time.sleep(seconds)
+    memory = memory_kb(os.getpid()) + sum(memory_kb(worker.pid) for worker in workers)
+    for worker in workers:
+        worker.stop()
+    frames = sum(worker.frame_stats.frames + worker.frame_stats.skipped for worker in workers)
+    results.put((cpu_seconds(), memory, frames))
+
+
+async def _async_model(count, seconds):
+    all_stats = [FrameStats() for _ in range(count)]
+    controllers = [AsyncSerialController(SerialController(frame_stats=stats, port=None)) for stats in all_stats]
+    speed = Value('i', SPEED)
+    tasks = [asyncio.create_task(run_program_async(controller, PROGRAM, speed)) for controller in controllers]
+    await asyncio.sleep(seconds)
+    memory = memory_kb(os.getpid())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for controller in controllers:
+        controller.close()
+    return memory, sum(stats.frames + stats.skipped for stats in all_stats)
+
+
+def async_model(count, seconds, results):
+    memory, frames = asyncio.run(_async_model(count, seconds))
+    results.put((cpu_seconds(), memory, frames))
+
+
+def benchmark(count, seconds):
+    print(f"\n{count} candlestick(s), {PROGRAM} at speed {SPEED} for {seconds}s")
+    for name, model in (("process", process_model), ("async", async_model)):
+        results = Queue()
+        runner = Process(target=model, args=(count, seconds, results))
+        runner.start()
+        cpu, memory, frames = results.get()
+        runner.join()
+        print(f"  {name:<8} {frames:>6} frames  CPU {cpu:6.2f}s ({cpu / seconds * 100:5.1f}%)  memory {memory / 1024:6.1f} MB")
+
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for count in sys.argv[2:] or ["1", "4"]:
+        benchmark(int(count), seconds)
@@ -0,0 +1,104 @@
+"""
+Deadline based frame clock shared by all patterns.
+
+Instead of sleeping a fixed delay after each frame (which adds the serial write
+time and Python overhead to every frame), the clock keeps an absolute
+time.monotonic() deadline for the next frame and sleeps until it. When a frame
+is late the following frames are sent without sleeping until the animation has
+caught up. If it falls too far behind, the backlog is skipped and the clock
+restarts from now, so a stall doesn't turn into a burst of frames.
+
+When the controller has an `interrupt` event (set by the animation worker when a
+new program arrives), the clock waits on it instead of sleeping and raises
+ProgramInterrupted as soon as it is set, so a pattern stops within its current frame.
+"""
+
+import logging
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+
+class ProgramInterrupted(Exception):
+    """Raised by a FrameClock tick when the controller's interrupt event is set"""
+
+
+def frame_period(delay, speed_value):
+    """
+    Time between frames for a pattern's base delay at the given speed.
+    A speed of 10 is "normal" and gives the base delay.
+    """
+    if speed_value >= 10:
+        return delay / ((speed_value * (speed_value / 5)) / 20)
+    return delay / ((speed_value * 10) / 100)
+
+
+class _FixedSpeed:
+    """Stand-in for multiprocessing.Value when a pattern is called with a plain int speed"""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class FrameClock:
+    """
+    Args:
+        speed: multiprocessing.Value (or int) with the current speed, read once per frame
+        controller: Optional SerialController. Pending (coalesced) frames are flushed on
+                    every tick, frame lateness is recorded in its frame_stats and its
+                    interrupt event (if any) ends the pattern
+        max_catch_up: Frames a clock may fall behind before the backlog is skipped
+    """
+
+    def __init__(self, speed, controller=None, max_catch_up=3):
+        self.speed = speed if hasattr(speed, "value") else _FixedSpeed(speed)
+        self.max_catch_up = max_catch_up
+        self.controller = controller
+        self.frame_stats = getattr(controller, "frame_stats", None)
+        self.interrupt = getattr(controller, "interrupt", None)
+        self.skipped = 0
+        self._deadline = None
+
+    def tick(self, delay):
+        """Wait for the next frame of a pattern with base delay `delay`"""
+        return self.tick_period(frame_period(delay, self.speed.value))
+
+    def tick_period(self, period):
+        """
+        Wait until the next frame deadline, period seconds after the previous one.
+        Returns how late (seconds) the frame is, 0 or negative when on time.
+        """
+        late = self._advance(period)
+        if self.interrupt is not None:
+            if self.interrupt.wait(max(-late, 0)):
+                raise ProgramInterrupted()
+        elif late < 0:
+            sleep(-late)
+        self._frame_done()
+        return late
+
+    def _advance(self, period):
+        """Move the deadline by period, returns how late the frame is (negative: time to wait)"""
+        if self.controller is not None:
+            self.controller.flush()
+        now = monotonic()
+        if self._deadline is None:
+            self._deadline = now
+        self._deadline += period
+
+        late = now - self._deadline
+        if late > period * self.max_catch_up:
+            # Too far behind, skip the backlog instead of rushing through it
+            skipped = int(late // period)
+            self.skipped += skipped
+            logger.debug("Frame clock %.3fs late, skipping %s frames", late, skipped)
+            self._deadline = now
+        return late
+
+    def _frame_done(self):
+        if self.frame_stats is not None:
+            self.frame_stats.frame_late(monotonic() - self._deadline)
+
+    def reset(self):
+        """Restart timing from the next tick, e.g. after a deliberate pause"""
+        self._deadline = None
@@ -0,0 +1,103 @@
+"""
+LED layouts: how the LEDs of the candlestick (or any other strip) are arranged.
+
+Patterns draw on a logical canvas of `led_count` LEDs. For every direction the
+layout precomputes an index map that says, for each physical LED, which logical
+LED it shows. Rendering a frame is then a single pass over the map.
+
+Geometries:
+    candlestick: LEDs arranged as a candlestick, mirrored around the middle LED.
+                 "up" runs from both ends towards the middle, "down" from the
+                 middle out, so an up/down pattern only needs (led_count // 2) + 1 LEDs.
+    linear:      A plain strip, "up"/"down" are the same as "right"/"left".
+"""
+
+DIRECTIONS = ("right", "left", "up", "down")
+GEOMETRIES = ("candlestick", "linear")
+
+DEFAULT_LED_COUNT = 7
+DEFAULT_GEOMETRY = "candlestick"
+
+
+class Layout:
+    """A single strip of LEDs"""
+
+    def __init__(self, led_count=DEFAULT_LED_COUNT, geometry=DEFAULT_GEOMETRY):
+        if led_count < 1:
+            raise ValueError("A layout needs at least one LED")
+        if geometry not in GEOMETRIES:
+            raise ValueError(f"Unknown geometry '{geometry}', expected one of: {', '.join(GEOMETRIES)}")
+        self.led_count = led_count
+        self.geometry = geometry
+        self.center = (led_count - 1) // 2
+        self.index_maps = {direction: tuple(self._index_map(direction)) for direction in DIRECTIONS}
+
+    def _index_map(self, direction):
+        last = self.led_count - 1
+        if direction == "right":
+            return range(self.led_count)
+        if direction == "left":
+            return range(last, -1, -1)
+        if self.geometry == "linear":
+            return self._index_map("right" if direction == "up" else "left")
+        if direction == "up":
+            return [min(p, last - p) for p in range(self.led_count)]
+        return [self.center - min(p, last - p) for p in range(self.led_count)]
+
+    def span(self, direction):
+        """Number of distinct positions a pattern can move through in the direction"""
+        return max(self.index_maps[direction or "right"]) + 1
+
+    def __repr__(self):
+        return f"{self.led_count}:{self.geometry}"
+
+
+class StripSet:
+    """
+    One or more strips driven by the same controller, sent as one frame.
+
+    Patterns draw on the canvas of the first strip. Strips with a different LED
+    count show the canvas scaled to their length.
+    """
+
+    def __init__(self, strips):
+        if not strips:
+            raise ValueError("At least one strip is required")
+        self.strips = list(strips)
+        self.primary = self.strips[0]
+        self.led_count = self.primary.led_count
+        self.center = self.primary.center
+        self.physical_led_count = sum(strip.led_count for strip in self.strips)
+        self.index_maps = {
+            direction: tuple(
+                index * self.led_count // strip.led_count
+                for strip in self.strips
+                for index in strip.index_maps[direction]
+            )
+            for direction in DIRECTIONS
+        }
+
+    def span(self, direction):
+        return self.primary.span(direction)
+
+    def __repr__(self):
+        return ",".join(repr(strip) for strip in self.strips)
+
+
+def parse_layout(spec=None):
+    """
+    Build a StripSet from a layout specification.
+
+    The spec is a comma separated list of strips, each `count[:geometry]`,
+    e.g. "7", "60:linear" or "7:candlestick,7:candlestick". Defaults to a single
+    7 LED candlestick. StripSet instances are returned as is.
+    """
+    if isinstance(spec, StripSet):
+        return spec
+    if not spec:
+        return StripSet([Layout()])
+    strips = []
+    for part in str(spec).split(","):
+        count, _, geometry = part.strip().partition(":")
+        strips.append(Layout(int(count), geometry or DEFAULT_GEOMETRY))
+    return StripSet(strips)
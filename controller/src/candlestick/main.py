@@ -3,9 +3,12 @@
 import random
 import logging
 import sys
+import time
 from .serial_controller import SerialController
+from .frame_clock import ProgramInterrupted
 from .patterns import *
 from .patterns import directions  # Import directions list for random selection
+from .profiler import install_signal_trigger
 logger = logging.getLogger(__name__)
 
 functions = {
@@ -19,7 +22,17 @@ functions = {
     'rb2': rb,
 }
 
-def run_random(controller, speed=10, current_program_shared=None, current_direction_shared=None):
+# Pattern specs of the programs, for the async runners (see candlestick.async_serial)
+specs = {
+    'fall': FALL,
+    'wave': WAVE,
+    'bounce': BOUNCE,
+    'cop': COP,
+    'rb': RAINBOW,
+    'rb2': RAINBOW,
+}
+
+def run_random(controller, speed=10, current_program_shared=None, current_direction_shared=None, on_change=None):
     # Normalize rb2 to rb for reporting
     program_choices = list(functions.keys())
     program = random.choice(program_choices)
@@ -37,26 +50,60 @@ def run_random(controller, speed=10, current_program_shared=None, current_direct
         current_program_shared.value = program_to_report.encode('utf-8')
     if current_direction_shared is not None:
         current_direction_shared.value = direction.encode('utf-8')
+    if on_change is not None:
+        on_change()
     
     functions[program](controller, speed=speed, direction=direction)
 
-def run_program(program, speed, direction=None, rgb_color=None, current_program_shared=None, current_direction_shared=None):
+def wait_until(start_at, interrupt=None):
+    '''
+    Sleep until start_at (time.time()), used to start animations in phase on several candlesticks.
+    With an interrupt event, raises ProgramInterrupted when it is set while waiting.
+    '''
+    if start_at is None:
+        return
+    delay = start_at - time.time()
+    if delay > 0:
+        if interrupt is None:
+            time.sleep(delay)
+        elif interrupt.wait(delay):
+            raise ProgramInterrupted()
+    elif delay < -0.05:
+        logger.warning("Started %.0fms after the requested start time", -delay * 1000)
+
+def run_program(program, speed, direction=None, rgb_color=None, current_program_shared=None, current_direction_shared=None, frame_stats=None, profile_request=None, serial_options=None, start_at=None):
     '''This function is called when the script is run externally'''
-    controller = SerialController()
+    if profile_request is not None:
+        install_signal_trigger(profile_request)
+    # serial_options are passed on to the SerialController, e.g. {'coalesce': True}
+    controller = SerialController(frame_stats=frame_stats, **(serial_options or {}))
+    play_program(controller, program, speed, direction, current_program_shared, current_direction_shared, start_at)
+
+def play_program(controller, program, speed, direction=None, current_program_shared=None, current_direction_shared=None, start_at=None, on_change=None):
+    '''
+    Run a program on a controller forever (or until its interrupt event is set).
+    on_change is called whenever the program and direction in the shared values change.
+    '''
+    # Everything is set up, hold the first frame until the requested start time
+    wait_until(start_at, controller.interrupt)
     
     # If no direction specified, pick a random one
     if direction is None:
         direction = random.choice(directions)
 
+    if program != "random":
+        # Update shared values with the specific program and direction
+        if current_program_shared is not None:
+            current_program_shared.value = program.encode('utf-8')
+        if current_direction_shared is not None:
+            current_direction_shared.value = direction.encode('utf-8')
+        if on_change is not None:
+            on_change()
+
     while True:
         if program == "random":
-            run_random(controller, speed, current_program_shared, current_direction_shared)
+            run_random(controller, speed, current_program_shared, current_direction_shared, on_change)
         else:
-            # Update shared values with the specific program and direction
-            if current_program_shared is not None:
-                current_program_shared.value = program.encode('utf-8')
-            if current_direction_shared is not None:
-                current_direction_shared.value = direction.encode('utf-8')
             functions[program](controller=controller, speed=speed, direction=direction)
 
 def blank_wrapper():
@@ -64,8 +111,9 @@ def blank_wrapper():
     logger.info("Starting blank function")
     blank()
 
-def set_color(controller, rgb_color):
+def set_color(controller, rgb_color, start_at=None):
     #controller = SerialController()
+    wait_until(start_at, controller.interrupt)
     logger.info("Setting color to static value from API")
     set_color_from_api(controller, rgb_color)
 
@@ -1,8 +1,7 @@
-import random
-import copy
 import logging
 from time import sleep
 from random import randint
+from .program import run_pattern
 
 logger = logging.getLogger(__name__)
 
@@ -30,58 +29,6 @@ def get_random_color():
     old_random = new_random
     return colors[new_random]
 
-def speed_sleep(delay, speed):
-    # Normal is delay / 1
-    if type(speed) is int:
-        sleep_delay = delay / ((speed * 10) / 100)
-    else:
-        if speed.value >= 10:
-            sleep_delay = delay / ((speed.value * (speed.value / 5 )) / 20 )
-        else:
-            sleep_delay = delay / ((speed.value * 10 ) / 100)
-    logger.debug("Sleeping: %s", sleep_delay)
-    sleep(sleep_delay)
-
-def diff_set_array(controller, now, goal, direction=None, speed=10):
-    """
-    Gradually transitions an array of RGB values from `now` to `goal`.
-
-    Args:
-        controller: The object responsible for setting the RGB values.
-        now (list): Current RGB values, a 7x3 array of integers.
-        goal (list): Target RGB values, a 7x3 array of integers.
-        direction: Optional parameter for the controller to specify direction.
-        speed (int): Controls the transition speed (higher = faster).
-
-    Returns:
-        list: The final state of the RGB values (matches `goal`).
-    """
-    helper = copy.deepcopy(now)
-    goal = copy.deepcopy(goal)
-    steps = 50
-    delay = 0.2 / speed.value
-
-    for step in range(steps, 0, -1):
-        for x in range(7):
-            for i in range(3):
-                a = float(helper[x][i])
-                b = float(goal[x][i])
-                difference = abs(a - b)
-
-                if difference <= 2:
-                    helper[x][i] = b
-                else:
-                    adjustment = difference / step
-                    helper[x][i] = a + adjustment if a < b else a - adjustment
-
-                helper[x][i] = int(helper[x][i])
-
-        controller.set_full_array(helper, direction)
-        sleep(delay)
-
-    return helper
-
-
 ############### Patterns below here #################
 
 def debug(direction=None):
@@ -102,81 +49,6 @@ def debug(direction=None):
     controller.set_full_array(led, direction)
 
 
-def cop(controller, rounds=4, direction=None, delay=0.5, color=None, speed=10):
-    logger.info("Starting cop, %s rounds", rounds)
-    counter = 0
-    rounds_counter = 0
-    flash = 3
-
-    led1 = [
-        red, blue, blue,
-        blue,
-        red, red, blue
-    ]
-    led2 = [
-        blue, red, red,
-        red,
-        blue, blue, red
-    ]
-
-    while rounds_counter < rounds:
-        while counter < flash:
-
-            controller.set_full_array(led1, "right")
-            speed_sleep(delay, speed)
-
-            controller.set_full_array(led2, "right")
-            speed_sleep(delay, speed)
-            counter += 1
-
-        counter = 0
-        goal1 = copy.deepcopy(led1)
-        goal1.append(goal1[0])
-        goal1.remove(goal1[0])
-        goal1.append(goal1[0])
-        goal1.remove(goal1[0])
-        goal2 = copy.deepcopy(led2)
-        goal2.append(goal2[0])
-        goal2.remove(goal2[0])
-        goal2.append(goal2[0])
-        goal2.remove(goal2[0])
-        led1 = copy.deepcopy((goal1))
-        led2 = copy.deepcopy((goal2))
-
-        rounds_counter += 1
-
-def bounce(controller, rounds=None, direction=None, delay=0.3, color=None, speed=10):
-    if not direction:
-        direction = random.choice(directions)
-    if direction == "right" or direction == "left":
-        led_count = 6
-    else:
-        led_count = 3
-        delay = delay * 1.5
-    if not rounds:
-        if direction == "right" or direction == "left":
-            rounds = 3
-        else:
-            rounds = 5
-    logger.info("Studs, direction: %s, rounds: %s", direction, rounds)
-    counter = 0
-    while counter is not rounds:
-        if not color:
-            local_color = get_random_color()
-        for x in range(led_count):
-            controller.set_led(x, local_color, True, direction)
-            # sleep(delay)
-            speed_sleep(delay, speed)
-            controller.set_led(x, black, False, direction)
-        local_color = get_random_color()
-        for x in range(led_count,-1,-1):
-            controller.set_led(x, local_color, True, direction)
-            # sleep(delay)
-            speed_sleep(delay, speed)
-            controller.set_led(x, black, False, direction)
-        counter += 1
-        logger.debug("%s", counter)
-
 # TODO, not implemented.
 # Bounce, but each LED will be of a random color
 def bounce_random(controller, delay=0.5, speed=1):
@@ -190,73 +62,121 @@ def bounce_random(controller, delay=0.5, speed=1):
         sleep(delay)
         controller.set_led(x, black, False)
 
-def wave(controller, rounds=None, direction=None, delay=0.4, color=False, speed=10):
-    if direction == None:
-        direction = random.choice(directions)
-        logger.info("Direction not set, going: %s", direction)
-    else:
-        logger.info("Direction set to: %s", direction)
-    if direction == "right" or direction == "left":
-        led_count = 7
-    else:
-        led_count = 4
-    if not rounds:
-        if direction == "right" or direction == "left":
-            rounds = 4
-        else:
-            rounds = 6
-    logger.info("Wave, direction: %s", direction)
-    counter = 0
-    while counter is not rounds:
-        if not color:
-            local_color = get_random_color()
-        for x in range(led_count):
-            controller.set_led(x, local_color, True, direction)
-            speed_sleep(delay, speed)
-        counter += 1
-        logger.debug("%s", counter)
-
-def fall(controller, rounds=None, direction=None, delay=0.15, color=None, speed=10):
-    # if not direction:
-    #     direction = random.choice(directions)
-    if direction == "right" or direction == "left":
-        led_count = 6
-    else:
-        led_count = 3
-        delay = delay * 1.5
-    if not rounds:
-        if direction == "right" or direction == "left":
-            rounds = 3
-        else:
-            rounds = 5
-    logger.info("Fall, direction: %s, rounds: %s", direction, rounds)
-    counter = 0
-    first = True
-    while counter is not rounds:
-        if not color:
-            local_color = get_random_color()
-        for x in [4, 5, 6]:
-            if x == 4:
-                controller.set_led(3, black, False, direction)
-            if x == 6:
-                controller.set_led(3, local_color, False, direction)
-            controller.set_led(x, local_color, True, direction)
-            speed_sleep(delay, speed)
-            controller.set_led(x, black, False, direction)
-
-        for x in [2, 1, 0]:
-            if x == 2:
-                controller.set_led(3, black, False, direction)
-            if x == 0:
-                controller.set_led(3, local_color, False, direction)
-            controller.set_led(x, local_color, True, direction)
-            speed_sleep(delay, speed)
-            controller.set_led(x, black, False, direction)
-        counter += 1
-        logger.debug("%s", counter)
-
-
-def rb(controller, rounds=21, direction=None, delay=0.4, speed=10):
+# Declarative pattern specs, see candlestick.program for the format
+
+WAVE = {
+    "name": "wave",
+    "delay": 0.4,
+    "rounds": {"horizontal": 4, "vertical": 6},
+    "body": [
+        {"pick": "c"},
+        {"for": "x", "in": [0, "span"], "do": [
+            {"set": "x", "color": "c"},
+            {"show": 1},
+        ]},
+    ],
+}
+
+BOUNCE = {
+    "name": "bounce",
+    "delay": {"horizontal": 0.3, "vertical": 0.45},
+    "rounds": {"horizontal": 3, "vertical": 5},
+    "body": [
+        {"pick": "c"},
+        {"for": "x", "in": [0, "span - 1"], "do": [
+            {"set": "x", "color": "c"},
+            {"show": 1},
+            {"set": "x", "color": "black"},
+        ]},
+        {"pick": "c"},
+        {"for": "x", "in": ["span - 1", -1, -1], "do": [
+            {"set": "x", "color": "c"},
+            {"show": 1},
+            {"set": "x", "color": "black"},
+        ]},
+    ],
+}
+
+# Drops fall from the center LED towards both ends, the center LED lights up
+# with the last drop of each side
+FALL = {
+    "name": "fall",
+    "delay": {"horizontal": 0.15, "vertical": 0.225},
+    "rounds": {"horizontal": 3, "vertical": 5},
+    "direction": None,
+    "body": [
+        {"pick": "c"},
+        {"set": "center", "color": "black"},
+        {"for": "x", "in": ["center + 1", "n - 1"], "do": [
+            {"set": "x", "color": "c"},
+            {"show": 1},
+            {"set": "x", "color": "black"},
+        ]},
+        {"set": "center", "color": "c"},
+        {"set": "n - 1", "color": "c"},
+        {"show": 1},
+        {"set": "n - 1", "color": "black"},
+        {"set": "center", "color": "black"},
+        {"for": "x", "in": ["center - 1", 0, -1], "do": [
+            {"set": "x", "color": "c"},
+            {"show": 1},
+            {"set": "x", "color": "black"},
+        ]},
+        {"set": "center", "color": "c"},
+        {"set": 0, "color": "c"},
+        {"show": 1},
+        {"set": 0, "color": "black"},
+    ],
+}
+
+COP_PATTERN = ["red", "blue", "blue", "blue", "red", "red", "blue"]
+COP_INVERTED = ["blue", "red", "red", "red", "blue", "blue", "red"]
+
+# Flashes three times, then moves the lights two LEDs along
+COP = {
+    "name": "cop",
+    "delay": 0.5,
+    "rounds": 4,
+    "fixed_direction": "right",
+    "body": [
+        {"repeat": 3, "do": [
+            {"fill": COP_PATTERN, "fit": "tile", "offset": "2 * round"},
+            {"show": 1},
+            {"fill": COP_INVERTED, "fit": "tile", "offset": "2 * round"},
+            {"show": 1},
+        ]},
+    ],
+}
+
+# Rainbow spread over all LEDs, fading one color band further every round
+RAINBOW = {
+    "name": "rb",
+    "delay": 0.4,
+    "rounds": 21,
+    "setup": [
+        {"fill": ["red", "orange", "yellow", "green", "cyan", "blue", "white"], "fit": "spread"},
+        {"show": 0},
+    ],
+    "body": [
+        {"fade": [{"rotate": "band"}], "steps": 50, "hold": 0.05},
+        {"hold": 1},
+    ],
+}
+
+
+def wave(controller, rounds=None, direction=None, delay=None, color=None, speed=10):
+    run_pattern(controller, WAVE, rounds, direction, color, speed, delay)
+
+def bounce(controller, rounds=None, direction=None, delay=None, color=None, speed=10):
+    run_pattern(controller, BOUNCE, rounds, direction, color, speed, delay)
+
+def fall(controller, rounds=None, direction=None, delay=None, color=None, speed=10):
+    run_pattern(controller, FALL, rounds, direction, color, speed, delay)
+
+def cop(controller, rounds=None, direction=None, delay=None, color=None, speed=10):
+    run_pattern(controller, COP, rounds, direction, color, speed, delay)
+
+def rb(controller, rounds=None, direction=None, delay=None, speed=10):
     """
     Displays a rainbow effect on LEDs, cycling through colors in the specified direction.
 
@@ -267,27 +187,7 @@ def rb(controller, rounds=21, direction=None, delay=0.4, speed=10):
         delay (float): Base delay between transitions.
         speed (int): Adjusts the delay (higher = faster transitions).
     """
-    if direction is None:
-        direction = random.choice(directions)
-    logger.info("Rainbow effect, direction: %s", direction)
-
-    # Initialize the rainbow colors
-    led = [red, orange, yellow, green, cyan, blue, white]
-    controller.set_full_array(led, direction)
-
-    for counter in range(rounds):
-        # Rotate the LED array by one position
-        goal = led[1:] + [led[0]]
-
-        # Transition to the new LED configuration
-        led = diff_set_array(controller, led, goal, direction, speed)
-
-        # Adjust speed-based delay
-        speed_sleep(delay, speed)
-
-        # Log progress
-        logger.debug("Round: %d", counter + 1)
-
+    run_pattern(controller, RAINBOW, rounds, direction, None, speed, delay)
 
 # Not used? Could probably be replaced by set_all directly
 def blank():
@@ -0,0 +1,125 @@
+"""
+Low overhead sampling profiler, used for field diagnostics on the controller.
+
+A timer signal interrupts the main thread at a fixed interval and the current
+Python stack is recorded. The result is in the "collapsed stack" format used by
+flamegraph.pl and speedscope (`outer;inner;innermost count`).
+
+Wall clock sampling (the default) also captures time spent sleeping or blocked
+in serial writes, which is usually what matters for stuttering animations.
+"""
+
+import os
+import signal
+import tempfile
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Signal used by the controller to ask the animation process to profile itself
+PROFILE_SIGNAL = signal.SIGUSR1
+# Unique stacks kept in a report, the rest are summarized as "(truncated)"
+MAX_STACKS = 2000
+
+_TIMERS = {
+    "wall": (signal.ITIMER_REAL, signal.SIGALRM),
+    "cpu": (signal.ITIMER_PROF, signal.SIGPROF),
+}
+
+
+class SamplingProfiler:
+    """Signal based stack sampler. Must be started from the main thread."""
+
+    def __init__(self, interval=0.005, mode="wall"):
+        self.interval = interval
+        self.timer, self.signum = _TIMERS[mode]
+        self.samples = {}
+        self.running = False
+        self._deadline = None
+        self._previous_handler = None
+        self._on_stop = None
+
+    def start(self, duration, on_stop=None):
+        """
+        Start sampling for duration seconds.
+
+        Args:
+            duration: Seconds to sample before stopping automatically
+            on_stop: Optional callback, called with the profiler when sampling stops
+        """
+        if self.running:
+            logger.warning("Profiler already running")
+            return
+        self.samples = {}
+        self.running = True
+        self._deadline = time.monotonic() + duration
+        self._on_stop = on_stop
+        self._previous_handler = signal.signal(self.signum, self._sample)
+        signal.setitimer(self.timer, self.interval, self.interval)
+        logger.info("Profiling for %ss (pid %s)", duration, os.getpid())
+
+    def stop(self):
+        """Stop sampling and restore the previous signal handler"""
+        if not self.running:
+            return
+        signal.setitimer(self.timer, 0, 0)
+        signal.signal(self.signum, self._previous_handler or signal.SIG_DFL)
+        self.running = False
+        logger.info("Profiling stopped, %s samples", self.sample_count)
+        if self._on_stop:
+            self._on_stop(self)
+
+    @property
+    def sample_count(self):
+        return sum(self.samples.values())
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.samples[key] = self.samples.get(key, 0) + 1
+        if time.monotonic() >= self._deadline:
+            self.stop()
+
+    def collapsed(self):
+        """Return the samples in collapsed stack format, most frequent stacks first"""
+        stacks = sorted(self.samples.items(), key=lambda item: item[1], reverse=True)
+        lines = [f"{stack} {count}" for stack, count in stacks[:MAX_STACKS]]
+        truncated = sum(count for _, count in stacks[MAX_STACKS:])
+        if truncated:
+            lines.append(f"(truncated) {truncated}")
+        return "\n".join(lines) + "\n"
+
+
+def profile_output_path(pid):
+    """File where the animation process with the given pid writes its profile"""
+    return os.path.join(tempfile.gettempdir(), f"rgb_candlestick_profile_{pid}.txt")
+
+
+def install_signal_trigger(profile_request):
+    """
+    Let the parent process start profiling in this (animation) process.
+
+    The parent sets profile_request.value to the duration in seconds and sends
+    PROFILE_SIGNAL. The collapsed stacks are written to profile_output_path(pid).
+
+    Args:
+        profile_request: multiprocessing.Value('d') shared with the parent
+    """
+    profiler = SamplingProfiler()
+
+    def write_output(stopped_profiler):
+        path = profile_output_path(os.getpid())
+        with open(path + ".tmp", "w") as f:
+            f.write(stopped_profiler.collapsed())
+        # Atomic rename so the parent never reads a partial file
+        os.replace(path + ".tmp", path)
+
+    def handler(signum, frame):
+        profiler.start(profile_request.value, on_stop=write_output)
+
+    signal.signal(PROFILE_SIGNAL, handler)
@@ -0,0 +1,433 @@
+"""
+Declarative patterns, compiled to frame programs.
+
+A pattern is described as data (plain dicts and lists, so it can be stored as JSON)
+and compiled once for a layout and direction into a FrameProgram: the distinct
+frames, already mapped to the physical LED order and packed as bytes, plus a list
+of steps (frame, hold). Playing a program is then a loop that writes prepared
+frames, with no per-LED work left in the animation process.
+
+Spec format:
+
+    {
+        "name": "wave",
+        "delay": 0.4,                        # base delay, or {"horizontal": ..., "vertical": ...}
+        "rounds": {"horizontal": 4, "vertical": 6},   # or an int
+        "direction": "random",               # default direction: "random", None or a direction
+        "fixed_direction": "right",          # optional, ignore the requested direction
+        "setup": [ops...],                   # optional, run once before the first round
+        "body": [ops...],                    # run once per round, with variable `round`
+    }
+
+Ops, run in order on a canvas of `n` logical LEDs that starts black:
+
+    {"pick": "c"}                            random color (never the same twice in a row) into variable c
+    {"pick": "c", "from": [colors...]}       same, from a given palette
+    {"set": "x", "color": "c"}               set LED x (expression) to a color
+    {"set": "all", "color": "black"}         set every LED
+    {"fill": [colors...], "fit": "tile"}     fill the canvas, "tile" repeats, "spread" stretches,
+                                             optional "offset" (expression) shifts the pattern
+    {"rotate": "band"}                       rotate the canvas left by an expression
+    {"show": 1}                              emit a frame and hold it for 1 base delay
+    {"hold": 1}                              hold the current frame for longer
+    {"fade": [ops...], "steps": 50, "hold": 0.05, "easing": "linear"}
+                                             transition to the canvas the ops produce,
+                                             emitting steps frames held for hold each
+    {"for": "x", "in": [start, stop, step], "do": [ops...]}
+    {"repeat": 3, "do": [ops...]}
+
+Expressions are ints or strings using + - * // and the variables n (LED count),
+center, span (positions in the direction), band (n // 7, at least 1), round,
+rounds and loop variables. Colors are names ("red"), variables, or [r, g, b].
+
+Holds are in base delays and scaled by the speed while playing, so one compiled
+program serves every speed.
+
+Compiled programs are kept in a ProgramCache (LRU, bounded by size). Patterns
+without random colors compile to the same program every time. Patterns with random
+colors are compiled for one of a few seeded color sequences, so a pattern that
+loops forever soon only replays cached programs.
+"""
+
+import ast
+import logging
+import operator
+import random
+from array import array
+from collections import OrderedDict
+
+from .frame_clock import FrameClock
+
+logger = logging.getLogger(__name__)
+
+COLORS = {
+    "red": (250, 0, 0),
+    "orange": (250, 127, 0),
+    "yellow": (250, 250, 0),
+    "green": (0, 250, 0),
+    "blue": (0, 0, 250),
+    "cyan": (139, 0, 250),
+    "white": (250, 250, 250),
+    "black": (0, 0, 0),
+}
+# Palette of {"pick": ...} without "from"
+RANDOM_COLORS = ("red", "orange", "yellow", "green", "cyan", "blue", "white")
+
+DIRECTIONS = ("right", "up", "down", "left")
+HORIZONTAL = ("right", "left")
+
+EASINGS = {
+    "linear": lambda t: t,
+    "ease_in": lambda t: t * t,
+    "ease_out": lambda t: t * (2 - t),
+    "ease_in_out": lambda t: t * t * (3 - 2 * t),
+}
+
+# Memory limit of a ProgramCache (bytes)
+DEFAULT_CACHE_BYTES = 4 * 1024 * 1024
+# Cached color sequences per pattern, layout and direction for patterns with random colors
+CACHE_VARIANTS = 8
+
+_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+
+class ProgramError(ValueError):
+    """Invalid pattern spec"""
+
+
+def spread(pattern, led_count):
+    """Stretch (or shrink) a list of colors over led_count LEDs"""
+    return [pattern[i * len(pattern) // led_count] for i in range(led_count)]
+
+
+def tile(pattern, led_count, offset=0):
+    """Repeat a list of colors over led_count LEDs, starting offset entries into the pattern"""
+    return [pattern[(i + offset) % len(pattern)] for i in range(led_count)]
+
+
+def _evaluate(node, variables):
+    if isinstance(node, ast.Constant) and isinstance(node.value, int):
+        return node.value
+    if isinstance(node, ast.Name):
+        try:
+            return variables[node.id]
+        except KeyError:
+            raise ProgramError(f"Unknown variable '{node.id}'") from None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_evaluate(node.operand, variables)
+    if isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+        return _OPERATORS[type(node.op)](_evaluate(node.left, variables), _evaluate(node.right, variables))
+    raise ProgramError(f"Unsupported expression: {ast.dump(node)}")
+
+
+def evaluate(expression, variables):
+    """Value of an int expression such as 3, "span" or "center + 1" """
+    if isinstance(expression, int):
+        return expression
+    try:
+        tree = ast.parse(str(expression), mode="eval")
+    except SyntaxError:
+        raise ProgramError(f"Invalid expression '{expression}'") from None
+    return _evaluate(tree.body, variables)
+
+
+class FrameProgram:
+    """
+    A compiled pattern.
+
+    frames: distinct wire frames (bytes, physical LED order)
+    steps: frame index of every step
+    holds: hold of every step, in base delays
+    """
+
+    __slots__ = ("name", "direction", "delay", "frames", "steps", "holds")
+
+    def __init__(self, name, direction, delay, frames, steps, holds):
+        self.name = name
+        self.direction = direction
+        self.delay = delay
+        self.frames = frames
+        self.steps = steps
+        self.holds = holds
+
+    def __len__(self):
+        return len(self.steps)
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the frames and steps"""
+        return (sum(len(frame) for frame in self.frames)
+                + self.steps.itemsize * len(self.steps) + self.holds.itemsize * len(self.holds))
+
+    @property
+    def duration(self):
+        """Play time in base delays"""
+        return sum(self.holds)
+
+    def __repr__(self):
+        return (f"<FrameProgram {self.name} {self.direction}: {len(self.steps)} steps, "
+                f"{len(self.frames)} frames, {self.nbytes} bytes>")
+
+
+class _Compiler:
+    def __init__(self, layout, direction, rng, color):
+        self.layout = layout
+        self.direction = direction
+        self.index_map = layout.index_maps[direction or "right"]
+        self.rng = rng
+        # Fixed color for every pick
+        self.color = color
+        self.canvas = [COLORS["black"]] * layout.led_count
+        self.frames = []
+        self.frame_ids = {}
+        self.steps = array("I")
+        self.holds = array("f")
+        self.last_picks = {}
+
+    def color_value(self, color, variables):
+        if isinstance(color, str):
+            if color in variables:
+                return variables[color]
+            try:
+                return COLORS[color]
+            except KeyError:
+                raise ProgramError(f"Unknown color '{color}'") from None
+        if len(color) != 3:
+            raise ProgramError(f"A color needs 3 channels: {color}")
+        return tuple(int(channel) for channel in color)
+
+    def emit(self, hold):
+        frame = bytes(channel for i in self.index_map for channel in self.canvas[i])
+        frame_id = self.frame_ids.get(frame)
+        if frame_id is None:
+            frame_id = self.frame_ids[frame] = len(self.frames)
+            self.frames.append(frame)
+        self.steps.append(frame_id)
+        self.holds.append(hold)
+
+    def run(self, ops, variables):
+        for op in ops:
+            self.run_op(op, variables)
+
+    def run_op(self, op, variables):
+        n = len(self.canvas)
+        if "pick" in op:
+            if self.color is not None:
+                variables[op["pick"]] = self.color_value(self.color, variables)
+                return
+            palette = [self.color_value(color, variables) for color in op.get("from", RANDOM_COLORS)]
+            previous = self.last_picks.get(op["pick"])
+            choices = [color for color in palette if color != previous] or palette
+            variables[op["pick"]] = self.last_picks[op["pick"]] = self.rng.choice(choices)
+        elif "set" in op:
+            color = self.color_value(op["color"], variables)
+            if op["set"] == "all":
+                self.canvas = [color] * n
+            else:
+                x = evaluate(op["set"], variables)
+                if not 0 <= x < n:
+                    raise ProgramError(f"LED {x} is outside the canvas of {n} LEDs")
+                self.canvas[x] = color
+        elif "fill" in op:
+            pattern = [self.color_value(color, variables) for color in op["fill"]]
+            fit = op.get("fit", "tile")
+            if fit == "tile":
+                self.canvas = tile(pattern, n, evaluate(op.get("offset", 0), variables))
+            elif fit == "spread":
+                self.canvas = spread(pattern, n)
+            else:
+                raise ProgramError(f"Unknown fit '{fit}'")
+        elif "rotate" in op:
+            k = evaluate(op["rotate"], variables) % n
+            self.canvas = self.canvas[k:] + self.canvas[:k]
+        elif "fade" in op:
+            self.fade(op, variables)
+        elif "show" in op:
+            self.emit(op["show"])
+        elif "hold" in op:
+            if self.holds:
+                self.holds[-1] += op["hold"]
+        elif "for" in op:
+            bounds = [evaluate(bound, variables) for bound in op["in"]]
+            for value in range(*bounds):
+                variables[op["for"]] = value
+                self.run(op["do"], variables)
+        elif "repeat" in op:
+            for _ in range(evaluate(op["repeat"], variables)):
+                self.run(op["do"], variables)
+        else:
+            raise ProgramError(f"Unknown op: {op}")
+
+    def fade(self, op, variables):
+        start = self.canvas
+        self.run(op["fade"], variables)
+        goal = self.canvas
+        steps = op.get("steps", 50)
+        hold = op.get("hold", 0)
+        try:
+            easing = EASINGS[op.get("easing", "linear")]
+        except KeyError:
+            raise ProgramError(f"Unknown easing '{op['easing']}'") from None
+        for step in range(1, steps + 1):
+            t = easing(step / steps)
+            self.canvas = [
+                tuple(int(a + (b - a) * t) for a, b in zip(now, target))
+                for now, target in zip(start, goal)
+            ]
+            self.emit(hold)
+        self.canvas = goal
+
+
+def _by_orientation(value, direction):
+    if isinstance(value, dict):
+        return value["horizontal" if direction in HORIZONTAL else "vertical"]
+    return value
+
+
+def resolve_direction(spec, direction=None, rng=random):
+    """Direction a spec runs in for a requested direction"""
+    if spec.get("fixed_direction"):
+        return spec["fixed_direction"]
+    if direction is None:
+        direction = spec.get("direction", "random")
+    if direction == "random":
+        direction = rng.choice(DIRECTIONS)
+    return direction
+
+
+def compile_pattern(spec, layout, direction=None, rounds=None, color=None, rng=random):
+    """
+    Compile a pattern spec for a layout (StripSet) into a FrameProgram.
+
+    Args:
+        direction: Requested direction, the spec's default when None
+        rounds: Number of rounds, the spec's default when None
+        color: Fixed color for every pick, random colors when None
+        rng: random.Random (or the random module) used for directions and colors
+    """
+    direction = resolve_direction(spec, direction, rng)
+    if rounds is None:
+        rounds = _by_orientation(spec.get("rounds", 1), direction)
+    variables = {
+        "n": layout.led_count,
+        "center": layout.center,
+        "span": layout.span(direction),
+        "band": max(1, layout.led_count // 7),
+        "rounds": rounds,
+    }
+    compiler = _Compiler(layout, direction, rng, color)
+    compiler.run(spec.get("setup", []), variables)
+    for index in range(rounds):
+        variables["round"] = index
+        compiler.run(spec["body"], variables)
+    return FrameProgram(
+        spec.get("name", "pattern"),
+        direction,
+        _by_orientation(spec.get("delay", 0.4), direction),
+        compiler.frames,
+        compiler.steps,
+        compiler.holds,
+    )
+
+
+def _picks_colors(ops):
+    """Whether any of the ops (or the ops nested in them) picks a random color"""
+    for op in ops:
+        if "pick" in op:
+            return True
+        for key in ("do", "fade"):
+            if key in op and _picks_colors(op[key]):
+                return True
+    return False
+
+
+class ProgramCache:
+    """
+    LRU cache of compiled programs, bounded by their total size (FrameProgram.nbytes).
+
+    Programs are keyed by pattern name, layout, direction, rounds and color (plus a
+    color sequence variant for patterns with random colors). The speed is not part of
+    the key, holds are scaled while playing.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, frame_stats=None, variants=CACHE_VARIANTS):
+        """
+        Args:
+            max_bytes: Memory limit, 0 disables the cache
+            frame_stats: Optional FrameStats that counts hits and misses
+            variants: Color sequences cached per pattern for patterns with random colors
+        """
+        self.max_bytes = max_bytes
+        self.frame_stats = frame_stats
+        self.variants = variants
+        self.programs = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.programs)
+
+    def get(self, spec, layout, direction=None, rounds=None, color=None, rng=random):
+        """Return the compiled program for the parameters, compiling it on a miss"""
+        direction = resolve_direction(spec, direction, rng)
+        variant = 0
+        if color is None and _picks_colors(spec.get("setup", []) + spec["body"]):
+            variant = rng.randrange(self.variants)
+        key = (spec.get("name"), repr(layout), direction, rounds,
+               tuple(color) if isinstance(color, list) else color, variant)
+
+        program = self.programs.get(key)
+        if program is not None:
+            self.programs.move_to_end(key)
+            self.hits += 1
+            if self.frame_stats is not None:
+                self.frame_stats.program_cache_hit()
+            return program
+
+        self.misses += 1
+        # Seeded by the key, a variant always has the same color sequence
+        program = compile_pattern(spec, layout, direction, rounds, color, random.Random(repr(key)))
+        if program.nbytes <= self.max_bytes:
+            self.programs[key] = program
+            self.nbytes += program.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.programs.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        if self.frame_stats is not None:
+            self.frame_stats.program_cache_miss(self.nbytes)
+        return program
+
+    def clear(self):
+        self.programs.clear()
+        self.nbytes = 0
+
+
+def play(controller, program, speed=10, clock=None, delay=None):
+    """
+    Play a FrameProgram on a SerialController, timed by a FrameClock.
+    delay overrides the program's base delay.
+    """
+    if clock is None:
+        clock = FrameClock(speed, controller)
+    frames = program.frames
+    delay = program.delay if delay is None else delay
+    send_frame = controller.send_frame
+    for frame_id, hold in zip(program.steps, program.holds):
+        send_frame(frames[frame_id])
+        if hold:
+            clock.tick(delay * hold)
+    return clock
+
+
+def run_pattern(controller, spec, rounds=None, direction=None, color=None, speed=10, delay=None):
+    """Play a pattern spec on the controller, compiled for its layout or replayed from its program cache"""
+    program = controller.programs.get(spec, controller.layout, direction, rounds, color)
+    logger.info("%s, direction: %s, %s steps", program.name, program.direction, len(program))
+    play(controller, program, speed, delay=delay)
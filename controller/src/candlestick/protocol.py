@@ -0,0 +1,152 @@
+"""
+Serial protocols spoken between the controller and the candlestick (Arduino).
+
+legacy:
+    The original protocol, understood by RGB_led_NeoPixel.ino at 57600 baud.
+    A frame is 0xFF, followed by R, G, B for each LED, followed by 0xFE.
+    The markers are not escaped, so color values are clamped to 253 to keep
+    them from being read as a frame boundary.
+
+v2:
+    Versioned protocol, understood by RGB_led_NeoPixel_v2.ino (up to 1 Mbaud).
+    A packet is [version, type, payload..., crc8], COBS encoded and terminated
+    by a 0x00 byte. COBS makes every byte value usable in the payload and lets
+    the receiver resynchronize at the next 0x00 after a corrupted packet.
+
+    Packet types:
+        FULL_FRAME    payload = R, G, B for every LED
+        PARTIAL_FRAME payload = (index, R, G, B) for each changed LED
+"""
+
+PROTOCOL_VERSION = 2
+
+FULL_FRAME = 0x01
+PARTIAL_FRAME = 0x02
+
+# Legacy frame markers
+LEGACY_START = 0xFF
+LEGACY_END = 0xFE
+LEGACY_MAX_VALUE = 0xFD
+
+
+def _crc8_table(poly=0x07):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+_CRC8_TABLE = _crc8_table()
+
+
+def crc8(data):
+    """CRC-8 (polynomial 0x07, initial value 0), the same checksum as the v2 sketch computes"""
+    crc = 0
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def cobs_encode(data):
+    """Consistent Overhead Byte Stuffing. The result contains no 0x00 bytes."""
+    encoded = bytearray(b"\x00")
+    code_index = 0
+    code = 1
+    for byte in data:
+        if byte:
+            encoded.append(byte)
+            code += 1
+        if not byte or code == 0xFF:
+            encoded[code_index] = code
+            code = 1
+            code_index = len(encoded)
+            encoded.append(0)
+    encoded[code_index] = code
+    return bytes(encoded)
+
+
+def cobs_decode(data):
+    """Decode a COBS encoded packet (without the 0x00 terminator)"""
+    decoded = bytearray()
+    index = 0
+    while index < len(data):
+        code = data[index]
+        if code == 0 or index + code > len(data) + 1:
+            raise ValueError("Invalid COBS data")
+        decoded += data[index + 1:index + code]
+        index += code
+        if code < 0xFF and index < len(data):
+            decoded.append(0)
+    return bytes(decoded)
+
+
+class LegacyProtocol:
+    """0xFF/0xFE delimited frames, compatible with the original Arduino sketch"""
+
+    name = "legacy"
+    default_baud = 57600
+    supports_partial = False
+
+    def encode_frame(self, values):
+        """Encode a full frame from a flat list of R, G, B values"""
+        return bytes([LEGACY_START] + [min(value, LEGACY_MAX_VALUE) for value in values] + [LEGACY_END])
+
+
+class CobsProtocol:
+    """Versioned, COBS framed packets with a CRC-8 checksum"""
+
+    name = "v2"
+    default_baud = 1000000
+    supports_partial = True
+
+    def _packet(self, packet_type, payload):
+        body = bytes([PROTOCOL_VERSION, packet_type]) + bytes(payload)
+        return cobs_encode(body + bytes([crc8(body)])) + b"\x00"
+
+    def encode_frame(self, values):
+        """Encode a full frame from a flat list of R, G, B values"""
+        return self._packet(FULL_FRAME, values)
+
+    def encode_partial(self, changes):
+        """
+        Encode a partial frame.
+
+        Args:
+            changes: Iterable of (index, (r, g, b)) for each LED to update
+        """
+        payload = bytearray()
+        for index, (red, green, blue) in changes:
+            payload += bytes((index, red, green, blue))
+        return self._packet(PARTIAL_FRAME, payload)
+
+
+def decode_packet(packet):
+    """
+    Decode a v2 packet (without the 0x00 terminator), as the sketch does.
+    Returns (packet_type, payload). Raises ValueError on a bad version or checksum.
+    """
+    body = cobs_decode(packet)
+    if len(body) < 3:
+        raise ValueError("Packet too short")
+    if crc8(body[:-1]) != body[-1]:
+        raise ValueError("Checksum mismatch")
+    if body[0] != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol version {body[0]}")
+    return body[1], body[2:-1]
+
+
+PROTOCOLS = {
+    LegacyProtocol.name: LegacyProtocol,
+    CobsProtocol.name: CobsProtocol,
+}
+
+
+def get_protocol(name):
+    """Get a protocol instance by name ('legacy' or 'v2')"""
+    try:
+        return PROTOCOLS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown serial protocol '{name}', expected one of: {', '.join(PROTOCOLS)}")
@@ -1,65 +1,133 @@
 from serial import Serial, serialutil
 import logging
+import time
+from .protocol import get_protocol
+from .layout import parse_layout
+from .program import ProgramCache, DEFAULT_CACHE_BYTES
+
+DEFAULT_SERIAL_PORT = "/dev/ttyUSB0"
 
 class SerialController:
-    def __init__(self):
+    def __init__(self, frame_stats=None, coalesce=False, port=DEFAULT_SERIAL_PORT, baud=None, protocol="legacy", layout=None, program_cache_bytes=DEFAULT_CACHE_BYTES):
+        '''
+        Args:
+            frame_stats: Optional FrameStats updated after every frame
+            coalesce: Only mark frames as pending in commit_arr and send them on flush().
+                      The FrameClock flushes once per frame period, so several set_led()
+                      calls within one period become a single transmission.
+            port: Serial port of the candlestick. None to only log frames (no hardware)
+            baud: Baud rate, defaults to the protocol's default (57600 legacy, 1000000 v2)
+            protocol: Serial protocol, 'legacy' or 'v2' (see candlestick.protocol)
+            layout: LED layout spec or StripSet (see candlestick.layout), defaults to a 7 LED candlestick
+            program_cache_bytes: Memory limit of the cache of compiled patterns, 0 disables it
+        '''
         self.logger = logging.getLogger(__name__)
         self.logger.debug("Initiating Serial controller")
-        self.serial_port = "/dev/ttyUSB0"
-        self.led = [[0, 0, 0] for _ in range(7)]
+        self.serial_port = port
+        self.protocol = get_protocol(protocol)
+        self.baud = baud or self.protocol.default_baud
+        self.layout = parse_layout(layout)
+        self.led_count = self.layout.led_count
+        self.led = [[0, 0, 0] for _ in range(self.led_count)]
+        self.frame_stats = frame_stats
+        self.coalesce = coalesce
+        # Compiled patterns, replayed with send_frame
+        self.programs = ProgramCache(program_cache_bytes, frame_stats)
+        # threading.Event that ends the running pattern when set (see candlestick.worker)
+        self.interrupt = None
+        # Last frame sent to the candlestick, identical frames are not sent again
+        self._last_frame = None
+        # Direction of the pending frame when coalescing, False when nothing is pending
+        self._pending_direction = False
+        if self.serial_port is None:
+            self.serial_connected = False
+            return
         try:
-            self.ser = Serial(self.serial_port, 57600)
+            self.ser = Serial(self.serial_port, self.baud)
             self.serial_connected = True
-            self.logger.debug("Connected to serial port: %s", self.serial_port)
+            self.logger.debug("Connected to serial port: %s (%s baud, %s protocol)", self.serial_port, self.baud, self.protocol.name)
         except serialutil.SerialException:
             self.logger.critical("Could not open serial port, printing values to screen instead")
             self.serial_connected = False
 
     def commit_arr(self, direction=None):
-        #self.logger.debug("Commiting array, direction: %s", direction)
-        # Array sent to Arduino:
-        if not direction or direction == "right":
-            values = [
-                self.led[i][j]
-                for i in range(7)  # Rows 0 through 6
-                for j in range(3)  # Columns 0 through 2
-            ]
-        elif direction == "left":
-            values = [
-                self.led[i][j]
-                for i in range(6, -1, -1)  # Rows 6 through 0 (reversed)
-                for j in range(3)          # Columns 0 through 2
-            ]
-        elif direction == "down":
-            values = [
-                self.led[i][j]
-                for i in [3, 2, 1, 0, 1, 2, 3]
-                for j in range(3)
-            ]
-        elif direction == "up":
-            values = [
-                self.led[i][j]
-                for i in [0, 1, 2, 3, 2, 1, 0]
-                for j in range(3)
-            ]
+        if self.coalesce:
+            self._pending_direction = direction
+        else:
+            self._send(direction)
+
+    def flush(self):
+        '''Send the pending frame, if any (only used when coalescing)'''
+        if self._pending_direction is not False:
+            direction = self._pending_direction
+            self._pending_direction = False
+            self._send(direction)
+
+    def _send(self, direction=None):
+        # Array sent to Arduino, each physical LED shows the logical LED from the direction's index map
+        led = self.led
+        values = [
+            channel
+            for i in self.layout.index_maps[direction or "right"]
+            for channel in led[i]
+        ]
+        self.send_frame(bytes(values))
+
+    def send_frame(self, frame):
+        '''
+        Send a prepared frame: bytes in physical LED order, already index mapped
+        (see candlestick.program). Bypasses self.led and coalescing.
+        '''
+        if frame == self._last_frame:
+            # The candlestick already shows this frame
+            if self.frame_stats is not None:
+                self.frame_stats.frame_skipped()
+            return
+        previous_frame = self._last_frame
+        self._last_frame = frame
 
         if self.serial_connected:
-            self.serial_write(values)
+            write_seconds = self.serial_write(frame, previous_frame)
         else:
-            self.logger.debug(values)
+            self.logger.debug(list(frame))
+            write_seconds = None
+
+        if self.frame_stats is not None:
+            self.frame_stats.frame_written(write_seconds)
+
+    def encode(self, values, previous_frame=None):
+        '''
+        Encode a frame for the wire. When the protocol supports it and only a few LEDs
+        changed since previous_frame, a smaller partial frame is used.
+        '''
+        # Partial frames address LEDs with a single byte
+        if (self.protocol.supports_partial and previous_frame is not None
+                and len(previous_frame) == len(values) and len(values) <= 256 * 3):
+            changes = [
+                (i // 3, values[i:i + 3])
+                for i in range(0, len(values), 3)
+                if previous_frame[i:i + 3] != values[i:i + 3]
+            ]
+            # Each changed LED costs 4 bytes in a partial frame, 3 per LED in a full one
+            if len(changes) * 4 < len(values):
+                return self.protocol.encode_partial(changes)
+        return self.protocol.encode_frame(values)
 
-    def serial_write(self, values):
+    def serial_write(self, values, previous_frame=None):
+        '''Write a frame, returns the time (seconds) spent blocked in the write itself'''
         while self.ser.in_waiting:
             response = self.ser.readline()
             print("Response: ", response)
-            sleep(0.02)
-        values.insert(0, 255)
-        values.append(254)
-        self.ser.write(bytearray(values))
+            time.sleep(0.02)
+        data = self.encode(values, previous_frame)
+        write_started = time.perf_counter()
+        self.ser.write(data)
+        write_seconds = time.perf_counter() - write_started
         while self.ser.in_waiting:
             response = self.ser.readline()
             print("Response: ", response)
-            sleep(0.02)
+            time.sleep(0.02)
+        return write_seconds
 
     def set_full_array(self, values, direction=None):
         self.led = values
@@ -75,6 +143,7 @@ class SerialController:
         '''
         Set all LEDs to the same color.
         '''
-        for i in range(7):
+        for i in range(self.led_count):
             self.led[i] = color
         self.commit_arr("right")
+        self.flush()
@@ -0,0 +1,191 @@
+"""
+Frame statistics shared between the animation process and the controller process.
+Backed by multiprocessing shared memory so the animation process can update it
+without any IPC round trips.
+"""
+
+import time
+from multiprocessing import Array
+
+# Histogram resolution: 2**_SUB_BUCKET_BITS sub-buckets per power of two (~12% precision)
+_SUB_BUCKET_BITS = 3
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+# Highest power of two tracked, in microseconds (2**26 us ~ 67 s)
+_MAX_EXPONENT = 26
+_HISTOGRAM_SLOTS = (_MAX_EXPONENT + 1) * _SUB_BUCKETS
+
+
+def _bucket_index(microseconds):
+    """Log-linear (HDR style) bucket index for a non-negative integer value"""
+    if microseconds < _SUB_BUCKETS:
+        return microseconds
+    exponent = microseconds.bit_length() - _SUB_BUCKET_BITS - 1
+    index = (exponent + 1) * _SUB_BUCKETS + (microseconds >> exponent) - _SUB_BUCKETS
+    return min(index, _HISTOGRAM_SLOTS - 1)
+
+
+def _bucket_value(index):
+    """Lowest value (microseconds) that falls in the bucket"""
+    if index < _SUB_BUCKETS:
+        return index
+    exponent = index // _SUB_BUCKETS - 1
+    return (index % _SUB_BUCKETS + _SUB_BUCKETS) << exponent
+
+
+class SharedHistogram:
+    """
+    HDR style histogram of durations in shared memory.
+    Values are stored in microseconds in log-linear buckets, recording is a single increment.
+    """
+
+    def __init__(self):
+        self._counts = Array('L', _HISTOGRAM_SLOTS, lock=False)
+
+    def record(self, seconds):
+        """Record a duration in seconds. Negative values are recorded as 0"""
+        self._counts[_bucket_index(max(int(seconds * 1_000_000), 0))] += 1
+
+    def reset(self):
+        for index in range(_HISTOGRAM_SLOTS):
+            self._counts[index] = 0
+
+    def summary(self):
+        """Return count and p50/p90/p99/max in milliseconds, or None if empty"""
+        counts = self._counts[:]
+        total = sum(counts)
+        if not total:
+            return None
+        result = {"count": total}
+        targets = [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)]
+        seen = 0
+        for index, count in enumerate(counts):
+            if not count:
+                continue
+            seen += count
+            while targets and seen >= targets[0][1] * total:
+                result[targets.pop(0)[0]] = round(_bucket_value(index) / 1000, 3)
+        return result
+
+# Slots in the shared array
+_LAST_FRAME_TIME = 0
+_FRAMES = 1
+_WRITE_SECONDS_SUM = 2
+_WRITE_COUNT = 3
+_WRITE_SECONDS_MAX = 4
+_SKIPPED = 5
+_PROGRAM_CACHE_HITS = 6
+_PROGRAM_CACHE_MISSES = 7
+_PROGRAM_CACHE_BYTES = 8
+_FIRST_FRAME_TIME = 9
+_SLOTS = 10
+
+
+class FrameStats:
+    """Shared counters describing frames written to the candlestick"""
+
+    def __init__(self):
+        # Preallocated, updating a counter never allocates shared memory
+        self._values = Array('d', _SLOTS, lock=False)
+        # How late each frame is relative to its deadline
+        self.frame_lateness = SharedHistogram()
+        # Time spent blocked in the serial write
+        self.serial_write = SharedHistogram()
+
+    def frame_written(self, write_seconds=None):
+        """
+        Called by the SerialController after each frame has been written.
+
+        Args:
+            write_seconds: Time spent in the serial write, None if nothing was written to a port
+        """
+        values = self._values
+        values[_LAST_FRAME_TIME] = time.time()
+        if not values[_FIRST_FRAME_TIME]:
+            values[_FIRST_FRAME_TIME] = values[_LAST_FRAME_TIME]
+        values[_FRAMES] += 1
+        if write_seconds is not None:
+            self.serial_write.record(write_seconds)
+            values[_WRITE_SECONDS_SUM] += write_seconds
+            values[_WRITE_COUNT] += 1
+            if write_seconds > values[_WRITE_SECONDS_MAX]:
+                values[_WRITE_SECONDS_MAX] = write_seconds
+
+    def frame_skipped(self):
+        """Called by the SerialController when a frame identical to the last one isn't sent"""
+        values = self._values
+        # The candlestick is showing the requested frame, so it counts for command acks
+        values[_LAST_FRAME_TIME] = time.time()
+        values[_SKIPPED] += 1
+
+    def program_cache_hit(self):
+        """Called when a pattern is replayed from the program cache"""
+        self._values[_PROGRAM_CACHE_HITS] += 1
+
+    def program_cache_miss(self, cache_bytes):
+        """Called when a pattern had to be compiled, with the cache size afterwards"""
+        values = self._values
+        values[_PROGRAM_CACHE_MISSES] += 1
+        values[_PROGRAM_CACHE_BYTES] = cache_bytes
+
+    def frame_late(self, seconds):
+        """Record how late (seconds) a frame was relative to its deadline"""
+        self.frame_lateness.record(seconds)
+
+    def reset_timing(self):
+        """Reset the timing histograms, e.g. when a new program starts"""
+        self.frame_lateness.reset()
+        self.serial_write.reset()
+
+    def timing_summary(self):
+        """Frame lateness and serial write duration percentiles in milliseconds"""
+        return {
+            "frame_lateness_ms": self.frame_lateness.summary(),
+            "serial_write_ms": self.serial_write.summary(),
+        }
+
+    @property
+    def last_frame_time(self):
+        """Wall clock time (time.time()) of the last frame written, 0.0 if none yet"""
+        return self._values[_LAST_FRAME_TIME]
+
+    @property
+    def first_frame_time(self):
+        """Wall clock time (time.time()) of the first frame written, 0.0 if none yet"""
+        return self._values[_FIRST_FRAME_TIME]
+
+    @property
+    def frames(self):
+        return int(self._values[_FRAMES])
+
+    @property
+    def skipped(self):
+        """Frames not sent because they were identical to the previous frame"""
+        return int(self._values[_SKIPPED])
+
+    @property
+    def program_cache_hits(self):
+        return int(self._values[_PROGRAM_CACHE_HITS])
+
+    @property
+    def program_cache_misses(self):
+        return int(self._values[_PROGRAM_CACHE_MISSES])
+
+    @property
+    def program_cache_bytes(self):
+        """Size of the program cache of the running animation process"""
+        return int(self._values[_PROGRAM_CACHE_BYTES])
+
+    def take_write_stats(self):
+        """
+        Return (average, max) serial write duration since the previous call and reset them.
+        Both are None if nothing was written.
+        """
+        values = self._values
+        count = values[_WRITE_COUNT]
+        if not count:
+            return None, None
+        result = (values[_WRITE_SECONDS_SUM] / count, values[_WRITE_SECONDS_MAX])
+        values[_WRITE_SECONDS_SUM] = 0.0
+        values[_WRITE_COUNT] = 0
+        values[_WRITE_SECONDS_MAX] = 0.0
+        return result
@@ -0,0 +1,203 @@
+"""
+Long-lived animation process for a candlestick.
+
+The worker is started once, as early as possible (the controller starts it before
+it imports its networking modules) and keeps the serial port open for its whole
+life. Programs and colors are switched by sending the worker a message instead of
+starting a new process: the running pattern is interrupted at its next frame (see
+ProgramInterrupted in candlestick.frame_clock) and the new one starts right away.
+
+The program and direction actually running (e.g. in random mode) are written to shared
+memory, and the worker tells the controller about each change over a second pipe that
+the controller watches on its event loop (see AnimationWorker.watch), so nothing polls.
+
+This module only imports what is needed to fork the worker. The patterns, pyserial
+and the profiler are imported in the worker process itself.
+"""
+
+import logging
+import os
+import threading
+from multiprocessing import Process, Pipe, Value, Array
+
+from .stats import FrameStats
+
+logger = logging.getLogger(__name__)
+
+
+class _Mailbox:
+    """Latest command for the worker's main thread, setting interrupt when one arrives"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.interrupt = threading.Event()
+        self.command = None
+
+    def put(self, command):
+        with self.condition:
+            self.command = command
+            self.interrupt.set()
+            self.condition.notify()
+
+    def take(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.command is not None)
+            command, self.command = self.command, None
+            self.interrupt.clear()
+            return command
+
+
+def _receive_commands(connection, mailbox):
+    while True:
+        try:
+            command = connection.recv()
+        except (EOFError, OSError):
+            # The controller process is gone, don't keep the candlestick animating without it
+            os._exit(0)
+        mailbox.put(command)
+
+
+def _run_worker(connection, changes, speed, frame_stats, profile_request, serial_options, current_program_shared, current_direction_shared):
+    from .frame_clock import ProgramInterrupted
+    from .main import play_program, set_color
+    from .profiler import install_signal_trigger
+    from .serial_controller import SerialController
+
+    install_signal_trigger(profile_request)
+    controller = SerialController(frame_stats=frame_stats, **serial_options)
+    mailbox = _Mailbox()
+    controller.interrupt = mailbox.interrupt
+    threading.Thread(target=_receive_commands, args=(connection, mailbox), name="commands", daemon=True).start()
+    # Never block the animation on a controller that doesn't read the changes
+    os.set_blocking(changes.fileno(), False)
+
+    def program_changed():
+        try:
+            changes.send_bytes(b"")
+        except OSError:
+            pass
+
+    while True:
+        command = mailbox.take()
+        try:
+            if command[0] == "program":
+                _, program, direction, start_at = command
+                play_program(controller, program, speed, direction, current_program_shared, current_direction_shared, start_at,
+                             on_change=program_changed)
+            elif command[0] == "color":
+                _, rgb_color, start_at = command
+                set_color(controller, rgb_color, start_at)
+        except ProgramInterrupted:
+            pass
+        except Exception:
+            logger.exception("Animation failed, waiting for the next command")
+
+
+class AnimationWorker:
+    """
+    Animation process of a candlestick and the shared memory used to talk to it.
+
+    Args:
+        serial_options: Options for the SerialController in the worker, including the port
+        speed: Initial speed
+    """
+
+    def __init__(self, serial_options=None, speed=10):
+        self.serial_options = serial_options or {}
+        self.speed = Value('i', speed)
+        # Frame statistics written by the worker (used for command acks and metrics)
+        self.frame_stats = FrameStats()
+        # Profile duration requested from the worker (see candlestick.profiler)
+        self.profile_request = Value('d', 0.0)
+        # Program and direction actually running, e.g. in random mode.
+        # Size 20 should be enough for program names and direction
+        self.current_program = Array('c', 20)
+        self.current_direction = Array('c', 10)
+        self.process = None
+        self.starts = 0
+        self._connection = None
+        # Receiving end of the program changes, and the (loop, callback) watching it
+        self._changes = None
+        self._watch = None
+
+    def start(self):
+        """Fork the worker process"""
+        self._close_changes()
+        receiver, self._connection = Pipe(duplex=False)
+        self._changes, changes_sender = Pipe(duplex=False)
+        self.process = Process(
+            target=_run_worker,
+            args=(receiver, changes_sender, self.speed, self.frame_stats, self.profile_request, self.serial_options,
+                  self.current_program, self.current_direction),
+            name=f"animation {self.serial_options.get('port')}",
+            daemon=True
+        )
+        self.process.start()
+        receiver.close()
+        changes_sender.close()
+        if self._watch is not None:
+            self._watch[0].add_reader(self._changes.fileno(), self._read_changes)
+        self.starts += 1
+
+    def watch(self, loop, callback):
+        """
+        Call callback on the event loop whenever the running program or direction changes
+        (read from the current_program and current_direction shared values), also after a restart
+        """
+        self._watch = (loop, callback)
+        if self._changes is not None:
+            loop.add_reader(self._changes.fileno(), self._read_changes)
+
+    def _read_changes(self):
+        changed = False
+        try:
+            while self._changes.poll():
+                self._changes.recv_bytes()
+                changed = True
+        except (EOFError, OSError):
+            # The worker is gone, watched again once it is restarted
+            self._close_changes()
+        if changed:
+            self._watch[1]()
+
+    def _close_changes(self):
+        if self._changes is None:
+            return
+        if self._watch is not None:
+            self._watch[0].remove_reader(self._changes.fileno())
+        self._changes.close()
+        self._changes = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def send(self, command):
+        """Send a command, (re)starting the worker if it isn't running"""
+        if not self.is_alive():
+            if self.process is not None:
+                logger.warning("Animation worker for %s died, restarting it", self.serial_options.get('port'))
+            self.start()
+        self._connection.send(command)
+
+    def run_program(self, program, direction=None, start_at=None):
+        """Switch to a program. With start_at (time.time()) its first frame is held until then"""
+        self.send(("program", program, direction, start_at))
+
+    def set_color(self, rgb_color, start_at=None):
+        """Show a static color"""
+        self.send(("color", rgb_color, start_at))
+
+    def stop(self):
+        """Stop the worker process"""
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self._connection.close()
+        self._close_changes()
+        self.process = None
@@ -0,0 +1,103 @@
+"""
+Estimate of the backend clock, so that controllers can act at the same backend time
+without relying on system NTP.
+
+offset is backend time minus local time (both time.time()), a backend timestamp t
+happens locally at t - offset.
+
+The controller periodically sends a clock_ping with its send time t0. The backend
+answers with a clock_pong holding t0, its receive time t1 and its send time t2, and
+the controller notes the receive time t3 (NTP style):
+
+    offset     = ((t1 - t0) + (t2 - t3)) / 2
+    round trip = (t3 - t0) - (t2 - t1)
+
+The offset error is at most half the round trip, and is largest when the network
+delay is asymmetric (e.g. a queued packet). Like NTP's clock filter, the estimate
+uses the exchange with the smallest round trip among the recent ones.
+
+Before the first exchange (or with a backend that doesn't answer pings) the offset
+is estimated one-way from backend timestamps in received messages.
+"""
+
+import time
+from collections import deque
+
+# Exchanges kept for the estimate
+CLOCK_WINDOW = 8
+# One-way samples kept for the fallback estimate
+ONE_WAY_WINDOW = 16
+# Seconds between pings, and the quicker interval for the first few pings
+CLOCK_SYNC_INTERVAL = 10
+CLOCK_SYNC_STARTUP_INTERVAL = 0.5
+CLOCK_SYNC_STARTUP_SAMPLES = 4
+
+
+class ClockSync:
+    """Filtered backend clock offset and round trip statistics"""
+
+    def __init__(self, window: int = CLOCK_WINDOW):
+        # (round trip, offset) of recent exchanges, oldest first
+        self.exchanges = deque(maxlen=window)
+        self.one_way = deque(maxlen=ONE_WAY_WINDOW)
+        self.seq = 0
+
+    def ping(self) -> dict:
+        """Build a clock_ping message"""
+        self.seq += 1
+        return {"type": "clock_ping", "seq": self.seq, "t0": time.time()}
+
+    def handle_pong(self, message: dict):
+        """Handle a clock_pong message from the backend"""
+        self.observe_exchange(message["t0"], message["t1"], message["t2"], time.time())
+
+    def observe_exchange(self, t0: float, t1: float, t2: float, t3: float):
+        """Add a ping/pong exchange (t0, t3 local times, t1, t2 backend times)"""
+        round_trip = (t3 - t0) - (t2 - t1)
+        if round_trip < 0:
+            # Only possible if the local clock was stepped during the exchange
+            return
+        self.exchanges.append((round_trip, ((t1 - t0) + (t2 - t3)) / 2))
+
+    def observe(self, server_time: float, received_at: float = None):
+        """Add a one-way sample from a message sent by the backend at server_time"""
+        if received_at is None:
+            received_at = time.time()
+        # server_time - received_at = offset - transit delay, the largest sample is the best estimate
+        self.one_way.append(server_time - received_at)
+
+    @property
+    def synchronized(self) -> bool:
+        """Whether the estimate is based on ping/pong exchanges"""
+        return bool(self.exchanges)
+
+    @property
+    def offset(self) -> float:
+        """Backend time minus local time (seconds), 0 without any samples"""
+        if self.exchanges:
+            return min(self.exchanges)[1]
+        if self.one_way:
+            return max(self.one_way)
+        return 0.0
+
+    def to_local(self, server_time: float) -> float:
+        """Local time.time() of a backend timestamp"""
+        return server_time - self.offset
+
+    def next_interval(self) -> float:
+        """Seconds until the next ping"""
+        if self.seq < CLOCK_SYNC_STARTUP_SAMPLES:
+            return CLOCK_SYNC_STARTUP_INTERVAL
+        return CLOCK_SYNC_INTERVAL
+
+    def stats(self) -> dict:
+        """Offset and round trip statistics (ms) for metrics, empty before the first exchange"""
+        if not self.exchanges:
+            return {}
+        round_trips = [round_trip for round_trip, _ in self.exchanges]
+        return {
+            "clock_offset_ms": round(self.offset * 1000, 3),
+            "clock_rtt_min_ms": round(min(round_trips) * 1000, 3),
+            "clock_rtt_max_ms": round(max(round_trips) * 1000, 3),
+            "clock_rtt_last_ms": round(round_trips[-1] * 1000, 3),
+        }
@@ -0,0 +1,622 @@
+"""
+A single candlestick driven by the controller: its serial device, animation process,
+backend session and the background tasks that report its state.
+
+While the backend is unreachable the candlestick keeps its state, which is cached
+locally (see state_cache.py), and follows its offline schedule.
+
+Several devices can run in one controller process, sharing one asyncio loop.
+"""
+
+import logging
+import asyncio
+import os
+import time
+from datetime import datetime
+
+from backend_client import BackendClient
+from metrics import ControllerMetrics
+from schedule import ScheduleRunner, OfflineSchedule, InactivityReset
+from state_cache import StateCache, CandlestickCache, resume_animation
+import candlestick as rgb_serial
+from candlestick.profiler import SamplingProfiler, PROFILE_SIGNAL, profile_output_path
+from device_config import (
+    DEFAULT_PROGRAM, DEFAULT_SPEED, DEFAULT_DIRECTION, DEFAULT_COLOR, INACTIVITY_TIMEOUT_SECONDS,
+    html_color_to_rgb, default_state
+)
+
+# How long to wait for the first frame after a command before acking without it
+FIRST_FRAME_TIMEOUT_SECONDS = 2.0
+METRICS_INTERVAL_SECONDS = 15
+DEFAULT_PROFILE_SECONDS = 10
+MAX_PROFILE_SECONDS = 120
+# How long to wait for the first frame at startup before giving up on reporting it
+STARTUP_FRAME_TIMEOUT_SECONDS = 60
+
+
+class CandlestickDevice:
+    """
+    State and background tasks for one candlestick.
+
+    Args:
+        candlestick_id: Unique identifier of the candlestick in the backend
+        serial_options: Options for the SerialController in the animation process
+        inactivity_timeout: Seconds of inactivity before resetting to defaults, unless the backend's reset policy sets it
+        async_serial: Run patterns as asyncio tasks in the controller process, writing frames
+                      from a thread (see candlestick.async_serial), instead of in an animation process
+        worker: AnimationWorker, possibly already started, created if not given
+        cache: Cached state to start from and keep up to date, kept in memory only if not given
+    """
+
+    # Only one profiler can sample the (shared) event loop at a time
+    _loop_profiler_busy = False
+
+    def __init__(self, candlestick_id: str, serial_options: dict, inactivity_timeout: int = INACTIVITY_TIMEOUT_SECONDS, async_serial: bool = False, worker=None, cache: CandlestickCache = None):
+        self.candlestick_id = candlestick_id
+        self.serial_options = serial_options
+        self.inactivity_timeout = inactivity_timeout
+        self.async_serial = async_serial
+        self.logger = logging.getLogger(f"{__name__}.{candlestick_id}")
+        # State reported to the backend, also used to resume after a restart
+        self.cache = cache or StateCache(":memory:").candlestick(candlestick_id)
+        state = self.cache.state
+
+        # Animation process, started once. Its shared memory (speed, frame statistics, running
+        # program) is also used by the animation task with async_serial, the process isn't started then.
+        self.worker = worker or rgb_serial.AnimationWorker(serial_options, state.get('speed', DEFAULT_SPEED))
+
+        self.current_program = state.get('program', DEFAULT_PROGRAM)
+        self.random_mode = state.get('random', True)  # Track if we're in random mode
+        self.current_speed = self.worker.speed
+        self.current_direction = state.get('direction', DEFAULT_DIRECTION)
+        self.current_color = state.get('color', DEFAULT_COLOR)
+        # Pattern task when running with async_serial
+        self.animation_task = None
+        self.controller = None
+        self.backend_client = None
+        # Actual running state reported by the animation (e.g. in random mode), and set when it changes
+        self.current_program_shared = self.worker.current_program
+        self.current_direction_shared = self.worker.current_direction
+        self.program_changed = asyncio.Event()
+        # Frame statistics written by the animation (used for command acks and metrics)
+        self.frame_stats = self.worker.frame_stats
+        self.metrics = ControllerMetrics(self.frame_stats)
+        self.profile_request = self.worker.profile_request
+        self.profiling_task = None
+        # Command acks waiting for their first frame, referenced until done
+        self.ack_tasks = set()
+        # Show schedules, run against the backend client's clock estimate
+        self.schedules = None
+        # Commands by time of day, applied while the backend is unreachable
+        self.offline_schedule = OfflineSchedule(self.handle_backend_command, self.logger, self.cache.offline_schedule)
+        # Resets to the defaults after inactivity, with the policy (timeouts, defaults by time of day) from the backend
+        self.inactivity = InactivityReset(self.reset_to_defaults, self.logger, inactivity_timeout, default_state(), self.cache.reset_policy)
+        # When the backend became unreachable, None while connected
+        self.offline_since = None
+        self._tasks = []
+
+    def stop_process(self):
+        """Stop the animation process (or task), if running"""
+        if self.animation_task and not self.animation_task.done():
+            self.animation_task.cancel()
+        self.worker.stop()
+
+    def restart_candle(self, program, speed, direction, start_at=None):
+        """
+        Restart the candlestick program with new parameters.
+        With start_at (local time.time()) the first frame is delayed until then, so that
+        candlesticks started at the same backend time run in phase.
+        """
+        self.logger.info(f"Starting/restarting candle: program={program}, speed={speed.value}, direction={direction}")
+
+        # Clear the shared values
+        self.current_program_shared.value = b''
+        self.current_direction_shared.value = b''
+        # Timing statistics describe the currently running program
+        self.frame_stats.reset_timing()
+
+        if self.async_serial:
+            self.start_animation_task(rgb_serial.run_program_async(
+                self.controller, program, speed, direction,
+                self.current_program_shared, self.current_direction_shared, start_at,
+                on_change=self.program_changed.set
+            ))
+        else:
+            # The worker interrupts the running program
+            self.worker.run_program(program, direction, start_at)
+
+    def resume(self):
+        """Start the animation of the current state, e.g. the cached state at startup"""
+        program, direction, rgb_color = resume_animation(self.status())
+        if rgb_color is not None:
+            self.show_color(rgb_color)
+        else:
+            self.restart_candle(program, self.current_speed, direction)
+
+    def show_color(self, rgb_color, start_at=None):
+        """Show a static color instead of a program"""
+        # Clear shared values since no animated program is running
+        self.current_program_shared.value = b''
+        self.current_direction_shared.value = b''
+        if self.async_serial:
+            self.start_animation_task(rgb_serial.set_color_async(self.controller, rgb_color, start_at))
+        else:
+            self.worker.set_color(rgb_color, start_at)
+
+    def start_animation_task(self, coroutine):
+        """Run a pattern coroutine on the event loop (async_serial), replacing the running one"""
+        if self.animation_task and not self.animation_task.done():
+            self.animation_task.cancel()
+        self.animation_task = asyncio.create_task(coroutine)
+        self.animation_task.add_done_callback(self._animation_task_done)
+
+    def _animation_task_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error(f"Animation task failed: {task.exception()!r}")
+
+    def status(self, program=None, direction=None) -> dict:
+        """The current state, optionally overriding program and direction"""
+        return {
+            'program': program or self.current_program,
+            'random': self.random_mode,
+            'speed': self.current_speed.value,
+            'direction': direction or self.current_direction,
+            'color': self.current_color,
+        }
+
+    async def send_status(self, program=None, direction=None):
+        """
+        Record the current state in the cache and send it to the backend if connected,
+        optionally overriding program and direction
+        """
+        status = self.status(program, direction)
+        revision = self.cache.update(**status)
+        if not self.backend_client or not self.backend_client.connected:
+            return
+        sent = await self.backend_client.send_status(
+            **status,
+            timing=self.frame_stats.timing_summary(),
+            epoch=self.cache.epoch,
+            revision=revision
+        )
+        if sent:
+            self.cache.mark_synced(revision)
+
+    async def resync(self, base=None):
+        """
+        Send the backend the state changed since a revision of the cache (all of it for None).
+        The backend asks for another base with a sync message if it doesn't have this one.
+        """
+        revision = self.cache.update(**self.status())
+        message = {
+            'type': 'resync',
+            'epoch': self.cache.epoch,
+            'revision': revision,
+            'base': base,
+            'changes': self.cache.changes_since(base),
+        }
+        try:
+            await self.backend_client.send_message(message)
+            self.cache.mark_synced(revision)
+            self.logger.info(f"Resync from revision {base} to {revision}: {message['changes']}")
+        except Exception as e:
+            self.logger.error(f"Failed to send resync: {e}")
+
+    async def handle_sync(self, message: dict):
+        """Handle a sync request: the backend's revision of the state doesn't match the resync base"""
+        revision = message.get('revision')
+        if message.get('epoch') != self.cache.epoch or revision is None or revision > self.cache.revision:
+            # The backend knows nothing or has the state of another cache
+            revision = None
+        await self.resync(revision)
+
+    async def handle_connection(self, connected: bool):
+        """Resync when (re)connected, keep running from the cache and offline schedule while the backend is unreachable"""
+        if connected:
+            self.offline_schedule.stop()
+            if self.offline_since is not None:
+                offline_seconds = time.time() - self.offline_since
+                self.metrics.offline_seconds += offline_seconds
+                self.logger.info(f"Backend reachable again after {offline_seconds:.0f}s offline")
+                self.offline_since = None
+            # Inactivity counts from the reconnect, commands sent before are long gone
+            self.inactivity.start()
+            await self.resync(self.cache.synced_revision)
+        elif self.offline_since is None:
+            self.offline_since = time.time()
+            self.inactivity.stop()
+            self.logger.warning(f"Backend unreachable, keeping the current state ({len(self.offline_schedule.entries)} offline schedule entries)")
+            self.offline_schedule.start()
+
+    def handle_offline_schedule(self, message: dict):
+        """Store the offline schedule sent by the backend"""
+        entries = message.get('entries', [])
+        self.cache.set_offline_schedule(entries)
+        self.offline_schedule.set_entries(entries)
+        self.logger.info(f"Received offline schedule: {len(self.offline_schedule.entries)} entries")
+
+    async def send_command_ack(self, seq: int, received_at: float, applied_at: float, error: str = None, revision: int = None):
+        """
+        Acknowledge a command once the first frame after it has been written, with the cache
+        revision it was applied at so the backend can tell it from older and newer states.
+        Runs as a separate task so the receive loop isn't blocked while waiting for the frame.
+        """
+        first_frame_at = None
+        if error is None:
+            deadline = time.time() + FIRST_FRAME_TIMEOUT_SECONDS
+            while time.time() < deadline:
+                if self.frame_stats.last_frame_time >= applied_at:
+                    first_frame_at = self.frame_stats.last_frame_time
+                    break
+                await asyncio.sleep(0.01)
+            else:
+                self.logger.debug(f"No frame written within {FIRST_FRAME_TIMEOUT_SECONDS}s of command {seq}")
+
+        if self.backend_client and self.backend_client.connected:
+            await self.backend_client.send_ack(
+                seq,
+                received_at=received_at,
+                applied_at=applied_at,
+                first_frame_at=first_frame_at,
+                error=error,
+                epoch=self.cache.epoch,
+                revision=revision
+            )
+
+    def converge(self, changes: dict, start_at=None, restart: bool = False):
+        """
+        Apply state changes (command fields) in one transition. The speed is changed on the running
+        animation, which is only restarted when what is shown changes (program, direction or color),
+        or with restart.
+        """
+        if 'speed' in changes:
+            self.current_speed.value = int(changes['speed'])
+            self.logger.info(f"Speed changed to: {self.current_speed.value}")
+
+        if 'color' in changes:
+            color = changes['color']
+            changed = self.current_program != "static_color" or (self.current_color or "").lower() != color.lower()
+            # When setting static color, we're in a special mode
+            self.current_color = color
+            self.current_program = "static_color"
+            self.current_direction = None
+            self.random_mode = False
+            if changed or restart:
+                rgb_color = html_color_to_rgb(color)
+                self.logger.info(f"Setting static color: {color} -> {rgb_color}")
+                self.show_color(rgb_color, start_at)
+            return
+
+        program = changes.get('program')
+        direction = changes.get('direction', self.current_direction)
+        if program is None:
+            if 'direction' not in changes:
+                return
+            changed = direction != self.current_direction
+            self.current_direction = direction
+            if self.current_program in ("static_color", "stop"):
+                # Applies to the next program
+                return
+            program = self.current_program
+        else:
+            # Random mode picks its own directions, stop has none
+            directed = program not in ("random", "stop")
+            changed = program != ("random" if self.random_mode else self.current_program) or (directed and direction != self.current_direction)
+            self.random_mode = (program == "random")
+            # Clear color when switching to a program (not static color mode)
+            self.current_color = None
+            if directed or changed:
+                self.current_direction = direction
+            self.logger.info(f"Switching to program: {program}, random_mode: {self.random_mode}")
+            # Don't update current_program yet for random mode - let the monitor task report it
+            if not self.random_mode:
+                self.current_program = program
+
+        if not (changed or restart):
+            self.logger.info(f"Already running {program}, not restarting")
+        elif program == "stop":
+            self.show_color([0, 0, 0])
+        else:
+            self.restart_candle(program, self.current_speed, self.current_direction, start_at)
+
+    async def handle_backend_command(self, command: dict, restart: bool = True):
+        """
+        Handle commands received from the backend via WebSocket.
+        This is called by the BackendClient when a command is received. A command restarts
+        the program it names even if it is running, unless restart is False.
+        """
+        self.logger.info(f"Received command from backend: {command}")
+
+        self.inactivity.activity()
+        received_at = time.time()
+        error = None
+        # Backend time to start at, converted to local time with the clock estimate
+        start_at = None
+        if command.get('start_at') is not None:
+            start_at = self.backend_client.clock.to_local(command['start_at'])
+
+        try:
+            changes = {field: command[field] for field in ('program', 'speed', 'direction', 'color') if field in command}
+            self.converge(changes, start_at, restart)
+
+            applied_at = time.time()
+
+            # Send status update back to backend after handling command
+            # For random mode with program change, wait for monitor task to report actual program
+            if 'program' in command and self.random_mode and command['program'] == 'random':
+                self.logger.debug("Waiting for monitor task to report actual program in random mode")
+                # Record random mode, the ack carries the new revision
+                self.cache.update(**self.status())
+            else:
+                await self.send_status()
+                self.logger.debug("Sent status update to backend")
+
+        except Exception as e:
+            self.logger.error(f"Error handling command: {e}", exc_info=True)
+            self.metrics.commands_dropped += 1
+            applied_at = time.time()
+            error = str(e)
+
+        # Commands from older backends carry no sequence ID and are not acknowledged
+        if 'seq' in command:
+            task = asyncio.create_task(self.send_command_ack(command['seq'], received_at, applied_at, error, self.cache.revision))
+            self.ack_tasks.add(task)
+            task.add_done_callback(self._ack_task_done)
+
+    def _ack_task_done(self, task: asyncio.Task):
+        self.ack_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.error(f"Failed to acknowledge command: {task.exception()!r}")
+
+    async def handle_desired_state(self, message: dict):
+        """
+        Converge to the desired state sent by the backend (all of it, or the fields the reported
+        state differs in after a reconnect), restarting only what changes. The desired state
+        stands: it isn't reset after inactivity.
+        """
+        await self.handle_backend_command(message, restart=False)
+        self.inactivity.hold()
+
+    def handle_reset_policy(self, message: dict):
+        """Store the reset policy sent by the backend"""
+        policy = {key: value for key, value in message.items() if key != 'type'}
+        self.cache.set_reset_policy(policy)
+        self.inactivity.set_policy(policy)
+        self.logger.info(f"Received reset policy: timeout {self.inactivity.timeout}s, {len(self.inactivity.entries)} schedule entries")
+
+    async def monitor_program_changes(self):
+        """
+        Background task that sends status updates when the actual running program and direction
+        change (happens in random mode). It only wakes when the animation reports a change: the
+        worker over its changes pipe (see AnimationWorker.watch), the async_serial task directly.
+        """
+        last_reported_program = ""
+        last_reported_direction = ""
+
+        while True:
+            await self.program_changed.wait()
+            self.program_changed.clear()
+
+            # Read the actual running program and direction from shared memory
+            try:
+                actual_program = self.current_program_shared.value.decode('utf-8').rstrip('\x00')
+                actual_direction = self.current_direction_shared.value.decode('utf-8').rstrip('\x00')
+
+                # Only send updates if we have a program running (not in static color mode)
+                if actual_program and (actual_program != last_reported_program or actual_direction != last_reported_direction):
+                    self.logger.info(f"State changed - program: {actual_program}, direction: {actual_direction}, random_mode: {self.random_mode}")
+                    last_reported_program = actual_program
+                    last_reported_direction = actual_direction
+
+                    # Update current values if they changed
+                    if actual_direction:
+                        self.current_direction = actual_direction
+                    if actual_program:
+                        self.current_program = actual_program
+
+                    # Record and send status update with the actual program and direction
+                    await self.send_status(program=actual_program, direction=actual_direction)
+            except Exception as e:
+                self.logger.error(f"Error monitoring program changes: {e}")
+
+    async def run_profile(self, profile_id: str, duration: float):
+        """
+        Profile both the animation process and the asyncio loop for duration seconds
+        and upload the collapsed stacks to the backend.
+        """
+        animation_process = None if self.async_serial else self.worker.process
+        animation_path = None
+        if animation_process and animation_process.is_alive():
+            animation_path = profile_output_path(animation_process.pid)
+            if os.path.exists(animation_path):
+                os.remove(animation_path)
+            self.profile_request.value = duration
+            os.kill(animation_process.pid, PROFILE_SIGNAL)
+
+        loop_profiler = None
+        if not CandlestickDevice._loop_profiler_busy:
+            CandlestickDevice._loop_profiler_busy = True
+            loop_profiler = SamplingProfiler()
+            loop_profiler.start(duration)
+        try:
+            # Give the animation process a moment to write its output
+            await asyncio.sleep(duration + 1)
+        finally:
+            if loop_profiler:
+                loop_profiler.stop()
+                CandlestickDevice._loop_profiler_busy = False
+
+        if not self.backend_client:
+            return
+
+        if loop_profiler:
+            await self.backend_client.send_profile(
+                profile_id, "event_loop", duration,
+                collapsed=loop_profiler.collapsed(),
+                samples=loop_profiler.sample_count
+            )
+        else:
+            await self.backend_client.send_profile(profile_id, "event_loop", duration, error="Event loop already being profiled for another candlestick")
+
+        if self.async_serial:
+            await self.backend_client.send_profile(profile_id, "animation", duration, error="Patterns run on the event loop (async serial), see the event_loop profile")
+        elif animation_path is None:
+            await self.backend_client.send_profile(profile_id, "animation", duration, error="No animation process running")
+        elif not os.path.exists(animation_path):
+            # The process was most likely restarted by a command while profiling
+            await self.backend_client.send_profile(profile_id, "animation", duration, error="Animation process produced no profile")
+        else:
+            with open(animation_path) as f:
+                collapsed = f.read()
+            os.remove(animation_path)
+            samples = sum(int(line.rsplit(" ", 1)[1]) for line in collapsed.splitlines() if line)
+            await self.backend_client.send_profile(profile_id, "animation", duration, collapsed=collapsed, samples=samples)
+
+    def start_profile(self, profile_id: str, duration: float = DEFAULT_PROFILE_SECONDS):
+        """Start a profiling run in the background, unless one is already running"""
+        if self.profiling_task and not self.profiling_task.done():
+            self.logger.warning(f"Profiling already in progress, ignoring request {profile_id}")
+            return
+        duration = min(max(float(duration), 0.1), MAX_PROFILE_SECONDS)
+        self.logger.info(f"Starting profile {profile_id} for {duration}s")
+        self.profiling_task = asyncio.create_task(self.run_profile(profile_id, duration))
+
+    def handle_profile_request(self, message: dict):
+        """Handle a profile request from the backend"""
+        self.start_profile(message.get('profile_id', f"controller-{int(time.time())}"), message.get('duration', DEFAULT_PROFILE_SECONDS))
+
+    async def push_metrics(self, interval: int = METRICS_INTERVAL_SECONDS):
+        """
+        Background task that pushes controller metrics to the backend every interval seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+
+            if not self.backend_client or not self.backend_client.connected:
+                continue
+
+            try:
+                # Restarts after the first start, e.g. when the worker died
+                self.metrics.process_restarts = max(self.worker.starts - 1, 0)
+                report = self.metrics.report(reconnects=self.backend_client.reconnects)
+                report["commands_dropped_total"] += self.backend_client.invalid_messages
+                report.update(self.backend_client.clock.stats())
+                await self.backend_client.send_metrics(report)
+            except Exception as e:
+                self.logger.error(f"Error pushing metrics: {e}")
+
+    async def report_startup(self):
+        """Log how long after the controller (and system) started the first frame was written"""
+        deadline = time.time() + STARTUP_FRAME_TIMEOUT_SECONDS
+        while not self.frame_stats.first_frame_time:
+            if time.time() > deadline:
+                self.logger.warning(f"No frame written within {STARTUP_FRAME_TIMEOUT_SECONDS}s of startup")
+                return
+            await asyncio.sleep(0.01)
+        startup = self.metrics.startup()
+        message = f"First frame {startup['first_frame_seconds']:.3f}s after process start"
+        if 'boot_first_frame_seconds' in startup:
+            message += f", {startup['boot_first_frame_seconds']:.1f}s after boot"
+        self.logger.info(message)
+
+    async def reset_to_defaults(self, defaults: dict = None):
+        """
+        Reset the candlestick to its default state (of the reset policy at this time of day if not given).
+        Called after inactivity timeout or can be called manually. An animation already showing
+        the defaults isn't restarted, and nothing is sent when the state doesn't change.
+        """
+        defaults = defaults or self.inactivity.defaults_at(datetime.now())
+        if defaults.get('program') not in (None, "random", "stop"):
+            # The program's default direction unless given
+            defaults = {'direction': None, **defaults}
+        before = self.status()
+        self.converge(defaults)
+        if self.status() == before:
+            self.logger.info("Already on defaults, nothing to reset")
+            return
+        self.logger.info(f"Reset to defaults: {defaults}")
+
+        # Record and send status update to backend
+        await self.send_status()
+
+    async def run(self, backend_url: str, gateway=None):
+        """
+        Run the candlestick: start the cached (or default) program, connect to the backend and
+        keep the background tasks running until cancelled.
+
+        Args:
+            backend_url: WebSocket URL of the backend server
+            gateway: Optional GatewayClient, shares one backend connection between candlesticks
+        """
+        self.logger.info(f"Starting candlestick {self.candlestick_id} on {self.serial_options.get('port')}")
+
+        # The serial port is only opened once: by the animation worker, or here with async_serial
+        if self.async_serial:
+            self.controller = rgb_serial.AsyncSerialController(
+                rgb_serial.SerialController(frame_stats=self.frame_stats, **self.serial_options)
+            )
+
+        if not self.async_serial:
+            self.worker.watch(asyncio.get_running_loop(), self.program_changed.set)
+        # Start the cached program, unless the worker was started early with it
+        if self.async_serial or not self.worker.is_alive():
+            self.resume()
+        startup_task = asyncio.create_task(self.report_startup())
+
+        if gateway is not None:
+            self.backend_client = gateway.session(self.candlestick_id, self.handle_backend_command)
+        else:
+            self.backend_client = BackendClient(
+                backend_url=backend_url,
+                candlestick_id=self.candlestick_id,
+                command_callback=self.handle_backend_command
+            )
+        self.backend_client.add_message_handler("profile", self.handle_profile_request)
+        self.schedules = ScheduleRunner(self.handle_backend_command, self.backend_client.clock, self.logger)
+        self.backend_client.add_message_handler("schedule", self.schedules.handle_schedule)
+        self.backend_client.add_message_handler("cancel_schedule", self.schedules.handle_cancel)
+        self.backend_client.add_message_handler("offline_schedule", self.handle_offline_schedule)
+        self.backend_client.add_message_handler("sync", self.handle_sync)
+        self.backend_client.add_message_handler("desired_state", self.handle_desired_state)
+        self.backend_client.add_message_handler("reset_policy", self.handle_reset_policy)
+        # Resyncs the state on every (re)connect
+        self.backend_client.add_connection_handler(self.handle_connection)
+
+        await self.backend_client.connect()
+
+        self._tasks = [
+            startup_task,
+            # Monitor program changes (reported by the animation process in random mode)
+            asyncio.create_task(self.monitor_program_changes()),
+            # Push metrics to the backend
+            asyncio.create_task(self.push_metrics()),
+        ]
+
+        # Run the client (this will keep reconnecting if connection is lost)
+        try:
+            await self.backend_client.run()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        """Cancel the background tasks, disconnect and stop the animation process"""
+        if self.schedules:
+            self.schedules.cancel()
+        self.offline_schedule.stop()
+        self.inactivity.close()
+        for task in list(self.ack_tasks):
+            task.cancel()
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+        if self.backend_client:
+            await self.backend_client.disconnect()
+        self.stop_process()
+        if self.async_serial and self.controller:
+            self.controller.close()
@@ -0,0 +1,80 @@
+"""
+Candlestick configuration needed at startup: defaults and the serial devices to drive.
+
+Kept free of the networking and animation imports, so the controller can start its
+animation workers before loading them (see main_websocket.py).
+"""
+
+import glob
+import os
+
+# Default settings (used on startup and after inactivity timeout)
+DEFAULT_PROGRAM = "random"
+DEFAULT_SPEED = 10
+DEFAULT_DIRECTION = None
+DEFAULT_COLOR = None
+INACTIVITY_TIMEOUT_SECONDS = 60
+# Serial devices considered when discovering candlesticks
+DISCOVERY_PATTERNS = ("/dev/ttyUSB*", "/dev/ttyACM*")
+
+
+
+def default_state():
+    """The default settings as command fields"""
+    if DEFAULT_COLOR:
+        return {'color': DEFAULT_COLOR, 'speed': DEFAULT_SPEED}
+    return {'program': DEFAULT_PROGRAM, 'speed': DEFAULT_SPEED, 'direction': DEFAULT_DIRECTION}
+
+
+def parse_device_specs(specs):
+    """
+    Parse device specifications of the form `ID=PORT`, e.g. `hall=/dev/ttyUSB0`.
+
+    Returns:
+        Dict of candlestick ID -> serial port, in the given order
+    """
+    devices = {}
+    for spec in specs:
+        candlestick_id, separator, port = spec.partition('=')
+        if not separator or not candlestick_id or not port:
+            raise ValueError(f"Invalid device '{spec}', expected ID=PORT")
+        if candlestick_id in devices:
+            raise ValueError(f"Duplicate candlestick ID '{candlestick_id}'")
+        devices[candlestick_id] = port
+    return devices
+
+
+def discover_devices(prefix):
+    """
+    Find USB serial devices that may be candlesticks.
+
+    IDs are derived from the USB serial number when the adapter has one, so they stay the
+    same when devices are plugged into other ports. Otherwise the device name is used.
+
+    Returns:
+        Dict of candlestick ID -> serial port
+    """
+    from serial.tools import list_ports
+
+    ports = set()
+    for pattern in DISCOVERY_PATTERNS:
+        ports.update(glob.glob(pattern))
+    serial_numbers = {port.device: port.serial_number for port in list_ports.comports()}
+
+    devices = {}
+    for port in sorted(ports):
+        suffix = serial_numbers.get(port) or os.path.basename(port)
+        devices[f"{prefix}_{suffix}"] = port
+    return devices
+
+
+def html_color_to_rgb(color_code):
+    """Convert HTML color code to RGB array"""
+    if color_code.startswith('#'):
+        color_code = color_code[1:]
+
+    red = int(color_code[0:2], 16)
+    green = int(color_code[2:4], 16)
+    blue = int(color_code[4:6], 16)
+
+    return [red, green, blue]
@@ -0,0 +1,311 @@
+"""
+Multiplexed WebSocket client: one connection to the backend carries the messages of
+all candlesticks driven by this controller (a "gateway").
+
+Every message is tagged with the candlestick ID it belongs to. Heartbeats are sent
+once per connection instead of once per candlestick, and status, metrics and resync
+messages are batched into a single WebSocket frame.
+"""
+
+import asyncio
+import websockets
+import json
+import logging
+from typing import Optional, Callable, Dict, Any, List
+
+from backend_client import BackendClient
+from clock_sync import ClockSync
+
+logger = logging.getLogger(__name__)
+
+# Message types that are batched instead of sent immediately
+BATCHED_TYPES = ("status", "metrics", "resync")
+# How long a batched message may wait for others (seconds)
+BATCH_DELAY = 0.05
+
+
+class GatewayClient:
+    """Shared WebSocket connection for several candlesticks"""
+
+    def __init__(self, backend_url: str, gateway_id: str):
+        """
+        Args:
+            backend_url: WebSocket URL of the backend (e.g., 'ws://localhost:8000')
+            gateway_id: Unique identifier for this controller
+        """
+        self.backend_url = backend_url
+        self.gateway_id = gateway_id
+        self.sessions: Dict[str, "GatewaySession"] = {}
+        # Candlesticks attached on the current connection
+        self.attached = set()
+        self.websocket: Optional[websockets.WebSocketClientProtocol] = None
+        self.connected = False
+        self.reconnect_delay = 5  # seconds
+        self.heartbeat_interval = 30  # seconds
+        self.reconnects = 0
+        self.invalid_messages = 0
+        # Estimate of the backend clock, shared by all sessions
+        self.clock = ClockSync()
+        self._running = False
+        self._connect_lock = asyncio.Lock()
+        self._run_task: Optional[asyncio.Task] = None
+        self._batch: List[Dict[str, Any]] = []
+        # Resolved when the pending batch has been sent, or failed with the send error
+        self._batch_sent: Optional[asyncio.Future] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def session(self, candlestick_id: str, command_callback: Callable[[Dict[str, Any]], None]) -> "GatewaySession":
+        """Create the session for a candlestick, used in place of a BackendClient"""
+        session = GatewaySession(self, candlestick_id, command_callback)
+        self.sessions[candlestick_id] = session
+        return session
+
+    async def connect(self):
+        """
+        Establish the WebSocket connection (once for concurrent callers) and attach
+        all candlesticks that aren't attached on it yet.
+        """
+        async with self._connect_lock:
+            try:
+                if not self.connected:
+                    ws_url = f"{self.backend_url}/ws/gateway/{self.gateway_id}"
+                    logger.info(f"Connecting to backend at {ws_url}")
+                    self.websocket = await websockets.connect(ws_url)
+                    self.connected = True
+                    self.attached = set()
+                    logger.info("Connected to backend successfully")
+                unattached = [candlestick_id for candlestick_id in self.sessions if candlestick_id not in self.attached]
+                if unattached:
+                    await self.attach(unattached)
+            except Exception as e:
+                logger.error(f"Failed to connect to backend: {e}")
+                self.connected = False
+                await self.sessions_changed(list(self.sessions), False)
+                return False
+        await self.sessions_changed(unattached, True)
+        return True
+
+    async def sessions_changed(self, candlestick_ids: List[str], connected: bool):
+        """Call the connection handlers of the sessions"""
+        for candlestick_id in candlestick_ids:
+            session = self.sessions.get(candlestick_id)
+            if session is not None:
+                await session.connection_changed(connected)
+
+    async def attach(self, candlestick_ids: List[str]):
+        """Tell the backend which candlesticks are behind this connection"""
+        await self.websocket.send(json.dumps({"type": "attach", "candlestick_ids": candlestick_ids}))
+        self.attached.update(candlestick_ids)
+        logger.info(f"Attached candlesticks: {', '.join(candlestick_ids)}")
+
+    async def disconnect(self):
+        """Close the WebSocket connection"""
+        self._running = False
+        if self.websocket and not self.websocket.closed:
+            await self.websocket.close()
+        self.connected = False
+        logger.info("Disconnected from backend")
+
+    async def send(self, candlestick_id: str, message: Dict[str, Any]):
+        """
+        Send a message for a candlestick. Status, metrics and resync messages are batched
+        and return once their batch has been sent. Raises on connection errors.
+        """
+        message = {**message, "candlestick_id": candlestick_id}
+        if message["type"] not in BATCHED_TYPES:
+            await self.websocket.send(json.dumps(message))
+            return
+        self._batch.append(message)
+        if self._batch_sent is None:
+            self._batch_sent = asyncio.get_running_loop().create_future()
+            self._flush_task = asyncio.create_task(self._flush_after(BATCH_DELAY))
+        # Shielded: the batch is sent for the other senders even if this one is cancelled
+        await asyncio.shield(self._batch_sent)
+
+    async def _flush_after(self, delay: float):
+        await asyncio.sleep(delay)
+        # Messages sent from now on go into the next batch
+        messages, self._batch = self._batch, []
+        sent, self._batch_sent = self._batch_sent, None
+        try:
+            if not self.connected:
+                raise ConnectionError("Not connected to backend")
+            if len(messages) == 1:
+                await self.websocket.send(json.dumps(messages[0]))
+            else:
+                await self.websocket.send(json.dumps({"type": "batch", "messages": messages}))
+            logger.debug(f"Sent batch of {len(messages)} messages")
+        except Exception as e:
+            logger.error(f"Failed to send batch of {len(messages)} messages: {e}")
+            self.connected = False
+            sent.set_exception(e)
+            return
+        sent.set_result(None)
+
+    async def send_heartbeat(self):
+        """Send one heartbeat for all candlesticks on the connection"""
+        if not self.connected or not self.websocket:
+            return
+
+        try:
+            await self.websocket.send(json.dumps({"type": "heartbeat"}))
+            logger.debug("Sent heartbeat")
+        except Exception as e:
+            logger.error(f"Failed to send heartbeat: {e}")
+            self.connected = False
+
+    async def receive_messages(self):
+        """Receive messages from the backend and route them to the candlestick sessions"""
+        if not self.websocket:
+            return
+
+        try:
+            async for message in self.websocket:
+                try:
+                    data = json.loads(message)
+                    logger.debug(f"Received message: {data}")
+                except json.JSONDecodeError as e:
+                    self.invalid_messages += 1
+                    logger.error(f"Failed to parse message: {e}")
+                    continue
+
+                if data.get("type") == "clock_pong":
+                    self.clock.handle_pong(data)
+                    continue
+
+                session = self.sessions.get(data.pop("candlestick_id", None))
+                if session is None:
+                    self.invalid_messages += 1
+                    logger.warning(f"Message for unknown candlestick: {data}")
+                    continue
+                await session.handle_message(data)
+
+        except websockets.exceptions.ConnectionClosed:
+            logger.warning("WebSocket connection closed")
+            self.connected = False
+        except Exception as e:
+            logger.error(f"Error in receive loop: {e}")
+            self.connected = False
+
+    async def heartbeat_loop(self):
+        """Send periodic heartbeats to the backend"""
+        while self._running:
+            if self.connected:
+                await self.send_heartbeat()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def clock_sync_loop(self):
+        """Send periodic clock pings to the backend, one for all candlesticks"""
+        while self._running:
+            if self.connected:
+                try:
+                    await self.websocket.send(json.dumps(self.clock.ping()))
+                except Exception as e:
+                    logger.error(f"Failed to send clock ping: {e}")
+                    self.connected = False
+            await asyncio.sleep(self.clock.next_interval())
+
+    async def _run(self):
+        self._running = True
+
+        while self._running:
+            if not self.connected:
+                # Try to connect/reconnect
+                success = await self.connect()
+                if not success:
+                    logger.info(f"Retrying connection in {self.reconnect_delay} seconds...")
+                    await asyncio.sleep(self.reconnect_delay)
+                    continue
+                self.reconnects += 1
+
+            heartbeat_task = asyncio.create_task(self.heartbeat_loop())
+            clock_task = asyncio.create_task(self.clock_sync_loop())
+
+            # Receive messages (blocks until disconnection)
+            await self.receive_messages()
+            self.connected = False
+            if self._running:
+                await self.sessions_changed(list(self.sessions), False)
+
+            for task in (heartbeat_task, clock_task):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+            # Connection lost, retry
+            if self._running:
+                logger.info(f"Connection lost. Reconnecting in {self.reconnect_delay} seconds...")
+                await asyncio.sleep(self.reconnect_delay)
+
+        if self.websocket:
+            await self.websocket.close()
+
+    async def run(self):
+        """
+        Main run loop with automatic reconnection. May be awaited by every session,
+        the connection is only run once and is not cancelled with a single session.
+        """
+        if self._run_task is None:
+            self._run_task = asyncio.create_task(self._run())
+        await asyncio.shield(self._run_task)
+
+
+class GatewaySession(BackendClient):
+    """
+    A candlestick's view of a GatewayClient, with the same interface as a BackendClient.
+    Messages are sent over, and received from, the shared gateway connection.
+    """
+
+    def __init__(self, gateway: GatewayClient, candlestick_id: str, command_callback: Callable[[Dict[str, Any]], None]):
+        super().__init__(gateway.backend_url, candlestick_id, command_callback)
+        self.gateway = gateway
+        # Pongs are handled by the gateway
+        self.clock = gateway.clock
+
+    @property
+    def websocket(self):
+        return self.gateway.websocket
+
+    @websocket.setter
+    def websocket(self, value):
+        # Owned by the gateway
+        pass
+
+    @property
+    def connected(self):
+        return self.gateway.connected
+
+    @connected.setter
+    def connected(self, value):
+        # A failed send means the shared connection is broken
+        if not value and hasattr(self, "gateway"):
+            self.gateway.connected = False
+
+    @property
+    def reconnects(self):
+        return self.gateway.reconnects
+
+    @reconnects.setter
+    def reconnects(self, value):
+        pass
+
+    async def connect(self):
+        return await self.gateway.connect()
+
+    async def disconnect(self):
+        """Detach from the gateway, the shared connection is closed with the last session"""
+        self.gateway.sessions.pop(self.candlestick_id, None)
+        if not self.gateway.sessions:
+            await self.gateway.disconnect()
+
+    async def send_message(self, message: Dict[str, Any]):
+        await self.gateway.send(self.candlestick_id, message)
+
+    async def send_heartbeat(self):
+        # Heartbeats are sent once for the whole gateway
+        pass
+
+    async def run(self):
+        await self.gateway.run()
@@ -2,335 +2,131 @@
 """
 Controller application with WebSocket backend connection.
 This version connects to a central backend server instead of running a local HTTP server.
+One process can drive several candlesticks (serial devices), see device.py.
+
+Startup is ordered for the first frame: the animation workers are forked with the
+cached (or default) program before the networking modules (asyncio, websockets, the
+backend client) are imported, so those are only imported at the top level when used.
 """
 
-from multiprocessing import Process, Queue, Value, Array
 import signal
 import sys
 import argparse
 import logging
-import asyncio
 import os
 import time
 
-from backend_client import BackendClient
 import candlestick as rgb_serial
+from device_config import DEFAULT_SPEED, INACTIVITY_TIMEOUT_SECONDS, parse_device_specs, discover_devices
+from state_cache import StateCache, DEFAULT_CACHE_PATH, resume_animation
 
 logger = logging.getLogger(__name__)
 
-# Default settings (used on startup and after inactivity timeout)
-DEFAULT_PROGRAM = "random"
-DEFAULT_SPEED = 10
-DEFAULT_DIRECTION = None
-DEFAULT_COLOR = None
-INACTIVITY_TIMEOUT_SECONDS = 60
-
-# Global state
-current_program = DEFAULT_PROGRAM
-random_mode = True  # Track if we're in random mode
-current_speed = Value('i', DEFAULT_SPEED)
-current_direction = DEFAULT_DIRECTION
-current_color = DEFAULT_COLOR
-candle_process = None
-controller = None
-backend_client = None  # Global reference to backend client for status updates
-last_command_time = None  # Track when the last command was received
-# Shared arrays to communicate the actual running state from the subprocess
-# Size 20 should be enough for program names and direction
-current_program_shared = Array('c', 20)
-current_direction_shared = Array('c', 10)
+# Candlesticks driven by this process
+devices = []
 
 
 def signal_handler(signal, frame):
     """Handle Ctrl+C gracefully"""
     logger.info('Received interrupt signal, shutting down...')
-    if candle_process and candle_process.is_alive():
-        candle_process.terminate()
-        candle_process.join()
+    for device in devices:
+        device.stop_process()
+    # Workers started before the devices exist are daemons, stopped on exit
     sys.exit(0)
 
 
-def restart_candle(program, speed, direction):
-    """Restart the candlestick program with new parameters"""
-    global candle_process, current_program_shared, current_direction_shared
-    
-    logger.info(f"Starting/restarting candle: program={program}, speed={speed.value}, direction={direction}")
-    
-    if candle_process and candle_process.is_alive():
-        candle_process.terminate()
-        candle_process.join()
-    
-    # Clear the shared values
-    current_program_shared.value = b''
-    current_direction_shared.value = b''
-    
-    candle_process = Process(target=rgb_serial.run_program, args=(program, speed, direction, None, current_program_shared, current_direction_shared))
-    candle_process.start()
-    return candle_process
-
-
-def html_color_to_rgb(color_code):
-    """Convert HTML color code to RGB array"""
-    if color_code.startswith('#'):
-        color_code = color_code[1:]
-    
-    red = int(color_code[0:2], 16)
-    green = int(color_code[2:4], 16)
-    blue = int(color_code[4:6], 16)
-    
-    return [red, green, blue]
-
-
-async def handle_backend_command(command: dict):
-    """
-    Handle commands received from the backend via WebSocket.
-    This is called by the BackendClient when a command is received.
-    """
-    global current_program, random_mode, current_speed, current_direction, current_color, candle_process, controller, backend_client, last_command_time
-    
-    logger.info(f"Received command from backend: {command}")
-    
-    # Update last command time for inactivity tracking
-    last_command_time = time.time()
-    
-    try:
-        if 'direction' in command:
-            current_direction = command['direction']
-            restart_candle(current_program, current_speed, current_direction)
-        
-        if 'program' in command:
-            requested_program = command['program']
-            random_mode = (requested_program == "random")
-            # Clear color when switching to a program (not static color mode)
-            current_color = None
-            logger.info(f"Switching to program: {requested_program}, random_mode: {random_mode}")
-            
-            if requested_program == "stop":
-                current_program = "stop"
-                if candle_process and candle_process.is_alive():
-                    candle_process.terminate()
-                    candle_process.join()
-                candle_process = Process(target=rgb_serial.blank_wrapper)
-                candle_process.start()
-            else:
-                # Don't update current_program yet for random mode - let the monitor task report it
-                if not random_mode:
-                    current_program = requested_program
-                restart_candle(requested_program, current_speed, current_direction)
-        
-        if 'speed' in command:
-            current_speed.value = int(command['speed'])
-            logger.info(f"Speed changed to: {current_speed.value}")
-        
-        if 'color' in command:
-            current_color = command['color']
-            rgb_color = html_color_to_rgb(current_color)
-            logger.info(f"Setting static color: {current_color} -> {rgb_color}")
-            
-            # When setting static color, we're in a special mode
-            current_program = "static_color"
-            current_direction = None
-            random_mode = False
-            
-            if candle_process and candle_process.is_alive():
-                candle_process.terminate()
-                candle_process.join()
-            
-            # Clear shared values since no animated program is running
-            current_program_shared.value = b''
-            current_direction_shared.value = b''
-            
-            candle_process = Process(target=rgb_serial.set_color, args=(controller, rgb_color))
-            candle_process.start()
-        
-        # Send status update back to backend after handling command
-        # For random mode with program change, wait for monitor task to report actual program
-        should_send_status = True
-        if 'program' in command and random_mode and command['program'] == 'random':
-            should_send_status = False
-            logger.debug("Waiting for monitor task to report actual program in random mode")
-        
-        if should_send_status and backend_client and backend_client.connected:
-            await backend_client.send_status(
-                program=current_program,
-                random=random_mode,
-                speed=current_speed.value,
-                direction=current_direction,
-                color=current_color
-            )
-            logger.debug("Sent status update to backend")
-            
-    except Exception as e:
-        logger.error(f"Error handling command: {e}", exc_info=True)
-
-
-async def monitor_program_changes():
+def start_workers(device_ports: dict, serial_options: dict, caches: dict):
     """
-    Background task that monitors the shared program and direction values and sends status updates
-    when the actual running state changes (happens in random mode)
-    """
-    global current_program_shared, current_direction_shared, backend_client, random_mode, current_direction, current_program
-    
-    last_reported_program = ""
-    last_reported_direction = ""
-    
-    while True:
-        await asyncio.sleep(0.5)  # Check every 0.5 seconds for faster updates
-        
-        if not backend_client or not backend_client.connected:
-            continue
-        
-        # Read the actual running program and direction from shared memory
-        try:
-            actual_program = current_program_shared.value.decode('utf-8').rstrip('\x00')
-            actual_direction = current_direction_shared.value.decode('utf-8').rstrip('\x00')
-            
-            # Only send updates if we have a program running (not in static color mode)
-            if actual_program and (actual_program != last_reported_program or actual_direction != last_reported_direction):
-                logger.info(f"State changed - program: {actual_program}, direction: {actual_direction}, random_mode: {random_mode}")
-                last_reported_program = actual_program
-                last_reported_direction = actual_direction
-                
-                # Update global values if they changed
-                if actual_direction:
-                    current_direction = actual_direction
-                if actual_program:
-                    current_program = actual_program
-                
-                # Send status update with the actual program and direction
-                await backend_client.send_status(
-                    program=actual_program,
-                    random=random_mode,
-                    speed=current_speed.value,
-                    direction=actual_direction if actual_direction else current_direction,
-                    color=current_color
-                )
-        except Exception as e:
-            logger.error(f"Error monitoring program changes: {e}")
-
+    Fork the animation worker of every candlestick and start its cached program
+    (the default program when nothing is cached).
 
-async def reset_to_defaults():
+    Returns:
+        Dict of candlestick ID -> AnimationWorker
     """
-    Reset the candlestick to default settings.
-    Called after inactivity timeout or can be called manually.
-    """
-    global current_program, random_mode, current_speed, current_direction, current_color, backend_client
-    
-    logger.info("Resetting to default settings")
-    
-    current_program = DEFAULT_PROGRAM
-    random_mode = True
-    current_speed.value = DEFAULT_SPEED
-    current_direction = DEFAULT_DIRECTION
-    current_color = DEFAULT_COLOR
-    
-    # Restart with default program
-    restart_candle(current_program, current_speed, current_direction)
-    
-    # Send status update to backend
-    if backend_client and backend_client.connected:
-        await backend_client.send_status(
-            program=current_program,
-            random=random_mode,
-            speed=current_speed.value,
-            direction=current_direction,
-            color=current_color
-        )
-        logger.info("Sent default status to backend after reset")
+    workers = {}
+    for candlestick_id, port in device_ports.items():
+        state = caches[candlestick_id].state
+        worker = rgb_serial.AnimationWorker({**serial_options, 'port': port}, state.get('speed', DEFAULT_SPEED))
+        program, direction, rgb_color = resume_animation(state)
+        if rgb_color is not None:
+            worker.set_color(rgb_color)
+        else:
+            worker.run_program(program, direction)
+        workers[candlestick_id] = worker
+    return workers
 
 
-async def monitor_inactivity(timeout_seconds: int = INACTIVITY_TIMEOUT_SECONDS):
-    """
-    Background task that monitors for inactivity and resets to defaults
-    after timeout_seconds of no commands from the frontend.
-    
-    Args:
-        timeout_seconds: Seconds of inactivity before resetting to defaults
-    """
-    global last_command_time
-    
-    while True:
-        await asyncio.sleep(5)  # Check every 5 seconds
-        
-        # Skip if no command has been received yet (still on defaults)
-        if last_command_time is None:
-            continue
-        
-        # Check if we've exceeded the inactivity timeout
-        elapsed = time.time() - last_command_time
-        if elapsed >= timeout_seconds:
-            logger.info(f"Inactivity timeout reached ({timeout_seconds}s), resetting to defaults")
-            await reset_to_defaults()
-            # Reset the timer to prevent repeated resets
-            last_command_time = None
+def open_state_cache(path: str) -> StateCache:
+    """Open the state cache, falling back to one in memory when the file can't be used"""
+    try:
+        return StateCache(path)
+    except Exception as e:
+        logger.warning(f"Cannot use state cache {path} ({e}), state is not kept across restarts")
+        return StateCache(":memory:")
 
 
-async def run_with_backend(backend_url: str, candlestick_id: str, inactivity_timeout: int = INACTIVITY_TIMEOUT_SECONDS):
+async def run_with_backend(backend_url: str, device_ports: dict, serial_options: dict, inactivity_timeout: int = INACTIVITY_TIMEOUT_SECONDS, gateway_id: str = None, async_serial: bool = False, workers: dict = None, caches: dict = None):
     """
     Main async function that runs the controller with backend connection.
+    All candlesticks share this event loop, each with its own backend session.
     
     Args:
         backend_url: WebSocket URL of the backend server
-        candlestick_id: Unique identifier for this candlestick
+        device_ports: Candlestick ID -> serial port for each candlestick to drive
+        serial_options: SerialController options shared by all candlesticks
         inactivity_timeout: Seconds of inactivity before resetting to defaults
+        gateway_id: Multiplex all candlesticks over one connection, identified by this ID
+        async_serial: Run patterns on this event loop instead of in animation processes
+        workers: Candlestick ID -> AnimationWorker started ahead (see start_workers)
+        caches: Candlestick ID -> CandlestickCache with the state to start from
     """
-    global candle_process, controller, current_program, current_speed, current_direction, backend_client
-    
-    logger.info("Starting controller with backend connection")
-    
-    # Initialize serial controller
-    controller = rgb_serial.SerialController()
-    
-    # Start default program
-    candle_process = restart_candle(current_program, current_speed, current_direction)
-    
-    # Initialize backend client and store globally
-    backend_client = BackendClient(
-        backend_url=backend_url,
-        candlestick_id=candlestick_id,
-        command_callback=handle_backend_command
-    )
+    import asyncio
+    from device import CandlestickDevice
+    from gateway_client import GatewayClient
+
+    logger.info(f"Starting controller with backend connection, {len(device_ports)} candlestick(s)")
     
-    # Send initial status
-    await backend_client.connect()
-    if backend_client.connected:
-        logger.info(f"Sending initial status: program={current_program}, random={random_mode}, speed={current_speed.value}, direction={current_direction}, color={current_color}")
-        await backend_client.send_status(
-            program=current_program,
-            random=random_mode,
-            speed=current_speed.value,
-            direction=current_direction,
-            color=current_color
-        )
-        logger.info("Initial status sent")
+    workers = workers or {}
+    caches = caches or {}
+    for candlestick_id, port in device_ports.items():
+        devices.append(CandlestickDevice(
+            candlestick_id, {**serial_options, 'port': port}, inactivity_timeout, async_serial,
+            workers.get(candlestick_id), caches.get(candlestick_id)
+        ))
     
-    # Start background task to monitor program changes
-    monitor_task = asyncio.create_task(monitor_program_changes())
+    # SIGUSR2 starts a profile locally, e.g. `pkill -USR2 -f main_websocket.py`
+    def profile_all():
+        profile_id = f"signal-{int(time.time())}"
+        for device in devices:
+            device.start_profile(profile_id)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, profile_all)
     
-    # Start background task to monitor inactivity and reset to defaults
-    inactivity_task = asyncio.create_task(monitor_inactivity(inactivity_timeout))
+    gateway = GatewayClient(backend_url, gateway_id) if gateway_id else None
     
-    # Run the client (this will keep reconnecting if connection is lost)
     try:
-        await backend_client.run()
+        await asyncio.gather(*(device.run(backend_url, gateway) for device in devices))
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt received")
     finally:
-        monitor_task.cancel()
-        inactivity_task.cancel()
-        try:
-            await monitor_task
-        except asyncio.CancelledError:
-            pass
-        try:
-            await inactivity_task
-        except asyncio.CancelledError:
-            pass
-        
-        await backend_client.disconnect()
-        if candle_process and candle_process.is_alive():
-            candle_process.terminate()
-            candle_process.join()
+        for device in devices:
+            device.stop_process()
+
+
+def resolve_devices(args, candlestick_id: str, serial_port: str):
+    """
+    Candlesticks to drive: configured with --device / CANDLESTICK_DEVICES, discovered with
+    --discover / DISCOVER_DEVICES, or a single candlestick from --candlestick-id and --serial-port.
+    """
+    specs = args.device or [spec for spec in os.getenv('CANDLESTICK_DEVICES', '').split(',') if spec.strip()]
+    if specs:
+        return parse_device_specs(spec.strip() for spec in specs)
+    if args.discover or os.getenv('DISCOVER_DEVICES', '').lower() in ('1', 'true', 'yes'):
+        discovered = discover_devices(prefix=candlestick_id)
+        if not discovered:
+            logger.warning("No serial devices discovered, falling back to a single candlestick")
+        else:
+            return discovered
+    return {candlestick_id: serial_port}
 
 
 def main():
@@ -346,14 +142,45 @@ def main():
     backend_url = args.backend_url or os.getenv('BACKEND_URL', 'ws://localhost:8000')
     candlestick_id = args.candlestick_id or os.getenv('CANDLESTICK_ID', 'candlestick_001')
     inactivity_timeout = args.inactivity_timeout or int(os.getenv('INACTIVITY_TIMEOUT', str(INACTIVITY_TIMEOUT_SECONDS)))
+    serial_options = {}
+    serial_options['coalesce'] = args.coalesce_frames or os.getenv('COALESCE_FRAMES', '').lower() in ('1', 'true', 'yes')
+    serial_port = args.serial_port or os.getenv('SERIAL_PORT', rgb_serial.DEFAULT_SERIAL_PORT)
+    serial_options['protocol'] = args.serial_protocol or os.getenv('SERIAL_PROTOCOL', 'legacy')
+    serial_baud = args.serial_baud or os.getenv('SERIAL_BAUD')
+    if serial_baud:
+        serial_options['baud'] = int(serial_baud)
+    program_cache_mb = args.program_cache_mb if args.program_cache_mb is not None else os.getenv('PROGRAM_CACHE_MB')
+    if program_cache_mb is not None:
+        serial_options['program_cache_bytes'] = int(float(program_cache_mb) * 1024 * 1024)
+    led_layout = args.leds or os.getenv('LED_LAYOUT')
+    if led_layout:
+        # Fail early on a bad spec instead of in the animation process
+        serial_options['layout'] = str(rgb_serial.parse_layout(led_layout))
+    
+    device_ports = resolve_devices(args, candlestick_id, serial_port)
+    gateway_id = args.gateway or os.getenv('GATEWAY_ID')
+    async_serial = args.async_serial or os.getenv('ASYNC_SERIAL', '').lower() in ('1', 'true', 'yes')
+    state_cache_path = args.state_cache or os.getenv('STATE_CACHE', DEFAULT_CACHE_PATH)
     
     logger.info(f"Backend URL: {backend_url}")
-    logger.info(f"Candlestick ID: {candlestick_id}")
+    logger.info(f"Candlesticks: {device_ports}")
+    if gateway_id:
+        logger.info(f"Multiplexing over one connection as gateway: {gateway_id}")
+    if async_serial:
+        logger.info("Running patterns on the event loop (async serial)")
     logger.info(f"Inactivity timeout: {inactivity_timeout}s")
+    logger.info(f"Serial options: {serial_options}")
+    logger.info(f"State cache: {state_cache_path}")
+    
+    cache = open_state_cache(state_cache_path)
+    caches = {candlestick_id: cache.candlestick(candlestick_id) for candlestick_id in device_ports}
+    # Light up the candlesticks first, the rest is imported while the workers start
+    workers = {} if async_serial else start_workers(device_ports, serial_options, caches)
     
     # Run the async application
+    import asyncio
     try:
-        asyncio.run(run_with_backend(backend_url, candlestick_id, inactivity_timeout))
+        asyncio.run(run_with_backend(backend_url, device_ports, serial_options, inactivity_timeout, gateway_id, async_serial, workers, caches))
     except KeyboardInterrupt:
         logger.info("Application terminated by user")
     except Exception as e:
@@ -390,13 +217,67 @@ def parse_args():
     )
     parser.add_argument(
         '--candlestick-id',
-        help="Unique identifier for this candlestick (default: candlestick_001 or CANDLESTICK_ID env var)"
+        help="Unique identifier for this candlestick, or the ID prefix with --discover (default: candlestick_001 or CANDLESTICK_ID env var)"
+    )
+    parser.add_argument(
+        '--device',
+        action='append',
+        metavar='ID=PORT',
+        help="Drive a candlestick on a serial port, may be repeated (default: a single candlestick, or CANDLESTICK_DEVICES env var as a comma separated list)"
+    )
+    parser.add_argument(
+        '--gateway',
+        metavar='GATEWAY_ID',
+        help="Share one backend connection between all candlesticks, identified by this ID (default: one connection per candlestick, or GATEWAY_ID env var)"
+    )
+    parser.add_argument(
+        '--discover',
+        action='store_true',
+        help="Drive every USB serial device (/dev/ttyUSB*, /dev/ttyACM*) as a candlestick (default: off or DISCOVER_DEVICES env var)"
     )
     parser.add_argument(
         '--inactivity-timeout',
         type=int,
         help=f"Seconds of inactivity before resetting to defaults (default: {INACTIVITY_TIMEOUT_SECONDS} or INACTIVITY_TIMEOUT env var)"
     )
+    parser.add_argument(
+        '--serial-port',
+        help=f"Serial port of the candlestick (default: {rgb_serial.DEFAULT_SERIAL_PORT} or SERIAL_PORT env var)"
+    )
+    parser.add_argument(
+        '--serial-protocol',
+        choices=['legacy', 'v2'],
+        help="Serial protocol: 'legacy' for RGB_led_NeoPixel, 'v2' for RGB_led_NeoPixel_v2 (default: legacy or SERIAL_PROTOCOL env var)"
+    )
+    parser.add_argument(
+        '--serial-baud',
+        type=int,
+        help="Serial baud rate, up to 1000000 (default: 57600 for legacy, 1000000 for v2, or SERIAL_BAUD env var)"
+    )
+    parser.add_argument(
+        '--leds',
+        help="LED layout, comma separated strips of count[:geometry], e.g. 60:linear or 7,7 (default: 7:candlestick or LED_LAYOUT env var)"
+    )
+    parser.add_argument(
+        '--program-cache-mb',
+        type=float,
+        help="Memory limit of the cache of compiled patterns in MB, 0 to disable (default: 4 or PROGRAM_CACHE_MB env var)"
+    )
+    parser.add_argument(
+        '--async-serial',
+        action='store_true',
+        help="Run patterns as asyncio tasks in the controller process with a serial writer thread, instead of one process per program (default: off or ASYNC_SERIAL env var)"
+    )
+    parser.add_argument(
+        '--state-cache',
+        metavar='PATH',
+        help=f"SQLite file caching the state and offline schedule of the candlesticks, ':memory:' to keep nothing across restarts (default: {DEFAULT_CACHE_PATH} or STATE_CACHE env var)"
+    )
+    parser.add_argument(
+        '--coalesce-frames',
+        action='store_true',
+        help="Send at most one frame per frame period, merging LED updates within it (default: off or COALESCE_FRAMES env var)"
+    )
     return parser.parse_args()
 
 
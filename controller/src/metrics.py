@@ -0,0 +1,99 @@
+"""
+Controller metrics, pushed to the backend periodically over the WebSocket connection.
+"""
+
+import os
+import time
+
+
+def _read_proc(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _uptime():
+    uptime = _read_proc("/proc/uptime")
+    return float(uptime.split()[0]) if uptime else None
+
+
+def boot_time():
+    """Wall clock time the system booted, None where /proc isn't available"""
+    uptime = _uptime()
+    return time.time() - uptime if uptime is not None else None
+
+
+def process_start_time(pid="self"):
+    """Wall clock time a process started (to the clock tick), None where /proc isn't available"""
+    stat = _read_proc(f"/proc/{pid}/stat")
+    uptime = _uptime()
+    if stat is None or uptime is None:
+        return None
+    # Fields after the command name (which may contain spaces), starttime is field 22
+    fields = stat.rsplit(")", 1)[1].split()
+    started_after_boot = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    return time.time() - (uptime - started_after_boot)
+
+
+class ControllerMetrics:
+    """Counters for the controller process. Frame counters live in the shared FrameStats."""
+
+    __slots__ = ('frame_stats', 'process_restarts', 'commands_dropped', 'offline_seconds', 'started', 'booted', '_last_frames', '_last_report')
+
+    def __init__(self, frame_stats):
+        self.frame_stats = frame_stats
+        self.process_restarts = 0
+        self.commands_dropped = 0
+        # Time spent without a backend connection, counted when it comes back
+        self.offline_seconds = 0.0
+        # Controller process start, or now where /proc isn't available
+        self.started = process_start_time() or time.time()
+        self.booted = boot_time()
+        self._last_frames = 0
+        self._last_report = time.monotonic()
+
+    def startup(self):
+        """Seconds from controller process start (and system boot) to the first frame, empty before it"""
+        first_frame = self.frame_stats.first_frame_time
+        if not first_frame:
+            return {}
+        result = {"first_frame_seconds": round(first_frame - self.started, 3)}
+        if self.booted is not None:
+            result["boot_first_frame_seconds"] = round(first_frame - self.booted, 3)
+        return result
+
+    def report(self, reconnects=0):
+        """
+        Build a metrics report. Rates and write latencies cover the time since the previous report.
+
+        Args:
+            reconnects: Number of reconnects to the backend, tracked by the BackendClient
+        """
+        now = time.monotonic()
+        frames = self.frame_stats.frames
+        elapsed = now - self._last_report
+        frames_per_second = (frames - self._last_frames) / elapsed if elapsed > 0 else 0.0
+        self._last_frames = frames
+        self._last_report = now
+
+        write_avg, write_max = self.frame_stats.take_write_stats()
+        lateness = self.frame_stats.frame_lateness.summary() or {}
+        report = {
+            "frames_per_second": round(frames_per_second, 2),
+            "frames_total": frames,
+            "frames_skipped_total": self.frame_stats.skipped,
+            "program_cache_hits_total": self.frame_stats.program_cache_hits,
+            "program_cache_misses_total": self.frame_stats.program_cache_misses,
+            "program_cache_bytes": self.frame_stats.program_cache_bytes,
+            "serial_write_seconds_avg": write_avg,
+            "serial_write_seconds_max": write_max,
+            "frame_lateness_p99_ms": lateness.get("p99"),
+            "process_restarts_total": self.process_restarts,
+            "commands_dropped_total": self.commands_dropped,
+            "reconnects_total": reconnects,
+            "offline_seconds_total": round(self.offline_seconds, 1),
+        }
+        report.update(self.startup())
+        return report
@@ -0,0 +1,321 @@
+"""
+Schedules received from the backend: commands to apply at given backend times
+(see the backend's shows.py). Each schedule runs as an asyncio task that sleeps
+until the next entry is due on the local clock.
+
+The offline schedule applies commands at times of day (local time) while the
+backend is unreachable, see OfflineSchedule. The inactivity reset returns a
+candlestick to its default state, which may change by time of day, after a period
+without commands, see InactivityReset.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from clock_sync import ClockSync
+
+# Entries later than this are still applied, but logged
+LATE_WARNING_SECONDS = 0.05
+# Entries that restart the animation are applied this much ahead of time, with a start_at
+# for the first frame, so the process start-up doesn't delay the animation
+PREPARE_SECONDS = 0.3
+# Commands that restart the animation process
+RESTART_FIELDS = ('program', 'direction', 'color')
+# Longest sleep of the offline schedule before checking the wall clock again, it may be
+# set (e.g. by NTP) while waiting
+OFFLINE_MAX_SLEEP_SECONDS = 600
+
+
+class ScheduleRunner:
+    """
+    Runs the schedules of one candlestick.
+
+    Args:
+        apply: Coroutine function called with the command of each entry when it is due
+        clock: Estimate of the backend clock
+        logger: Logger of the candlestick
+    """
+
+    def __init__(self, apply: Callable[[dict], Awaitable[None]], clock: ClockSync, logger: logging.Logger):
+        self.apply = apply
+        self.clock = clock
+        self.logger = logger
+        # Running schedules: show_id -> task
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def handle_schedule(self, message: dict):
+        """Handle a schedule message from the backend, replacing an earlier schedule of the same show"""
+        if message.get('server_time') is not None:
+            self.clock.observe(message['server_time'])
+        show_id = message['show_id']
+        self.cancel(show_id)
+        entries = sorted(message.get('entries', []), key=lambda entry: entry['at'])
+        self.logger.info(f"Received schedule for show {show_id}: {len(entries)} entries, clock offset {self.clock.offset * 1000:.1f}ms")
+        self.tasks[show_id] = asyncio.create_task(self._run(show_id, entries))
+
+    def handle_cancel(self, message: dict):
+        """Handle a cancel_schedule message from the backend"""
+        self.cancel(message['show_id'])
+
+    def cancel(self, show_id: str = None):
+        """Cancel the schedule of a show, or all schedules"""
+        show_ids = [show_id] if show_id is not None else list(self.tasks)
+        for cancelled_id in show_ids:
+            task = self.tasks.pop(cancelled_id, None)
+            if task is not None and not task.done():
+                task.cancel()
+                self.logger.info(f"Cancelled schedule of show {cancelled_id}")
+
+    async def _run(self, show_id: str, entries: List[dict]):
+        try:
+            for entry in entries:
+                command = {key: value for key, value in entry.items() if key != 'at'}
+                lead = 0.0
+                if any(field in command for field in RESTART_FIELDS):
+                    command['start_at'] = entry['at']
+                    lead = PREPARE_SECONDS
+                # Re-read the offset for every entry, it improves as samples come in
+                delay = self.clock.to_local(entry['at']) - time.time()
+                if delay > lead:
+                    await asyncio.sleep(delay - lead)
+                elif -delay > LATE_WARNING_SECONDS:
+                    self.logger.warning(f"Show {show_id} entry {entry['at']:.3f} applied {-delay * 1000:.0f}ms late")
+                await self.apply(command)
+            self.logger.info(f"Show {show_id} finished")
+        finally:
+            if self.tasks.get(show_id) is asyncio.current_task():
+                del self.tasks[show_id]
+
+
+def parse_time_of_day(value: str) -> Tuple[int, int]:
+    """Parse a time of day of the form HH:MM into (hour, minute)"""
+    hour, separator, minute = value.partition(':')
+    if not separator or not (0 <= int(hour) < 24 and 0 <= int(minute) < 60):
+        raise ValueError(f"Invalid time of day '{value}', expected HH:MM")
+    return int(hour), int(minute)
+
+
+class OfflineSchedule:
+    """
+    Commands applied at times of day (controller local time) while the backend is unreachable.
+    Runs as a task that sleeps until the next entry, every entry repeats daily.
+
+    Args:
+        apply: Coroutine function called with the command of each entry when it is due
+        logger: Logger of the candlestick
+        entries: Commands with a `time` of day (HH:MM)
+    """
+
+    def __init__(self, apply: Callable[[dict], Awaitable[None]], logger: logging.Logger, entries: List[dict] = ()):
+        self.apply = apply
+        self.logger = logger
+        self.entries: List[Tuple[Tuple[int, int], dict]] = []
+        self.task: Optional[asyncio.Task] = None
+        self.set_entries(entries)
+
+    def set_entries(self, entries: List[dict]):
+        """Replace the entries, a running schedule continues with the new ones"""
+        parsed = []
+        for entry in entries:
+            try:
+                parsed.append((parse_time_of_day(entry['time']), {key: value for key, value in entry.items() if key != 'time'}))
+            except (KeyError, ValueError) as e:
+                self.logger.warning(f"Ignoring offline schedule entry {entry}: {e!r}")
+        self.entries = sorted(parsed, key=lambda item: item[0])
+        if self.task is not None:
+            self.stop()
+            self.start()
+
+    def start(self):
+        """Start applying the entries as they become due"""
+        if self.entries and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+
+    def next_entry(self, now: datetime) -> Tuple[datetime, dict]:
+        """The entry due next after now and when it is due"""
+        due = []
+        for (hour, minute), command in self.entries:
+            at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if at <= now:
+                at += timedelta(days=1)
+            due.append((at, command))
+        return min(due, key=lambda item: item[0])
+
+    async def _run(self):
+        at, command = self.next_entry(datetime.now())
+        while True:
+            delay = (at - datetime.now()).total_seconds()
+            if delay > 0:
+                await asyncio.sleep(min(delay, OFFLINE_MAX_SLEEP_SECONDS))
+                # Check the wall clock again, it may have been set while sleeping
+                continue
+            self.logger.info(f"Applying offline schedule entry of {at:%H:%M}: {command}")
+            try:
+                await self.apply(dict(command))
+            except Exception as e:
+                self.logger.error(f"Offline schedule entry failed: {e}")
+            at, command = self.next_entry(datetime.now())
+
+
+def next_time_of_day(times: List[Tuple[int, int]], now: datetime) -> datetime:
+    """The next of the times of day (hour, minute) after now"""
+    due = []
+    for hour, minute in times:
+        at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if at <= now:
+            at += timedelta(days=1)
+        due.append(at)
+    return min(due)
+
+
+class InactivityReset:
+    """
+    Resets a candlestick to its default state after timeout seconds without commands.
+
+    The policy from the backend sets the timeout and the default state, or default states
+    by time of day: each schedule entry is the default from its time on (controller local
+    time, repeated daily), and an idle candlestick switches to it at that time. Left out
+    fields use the controller's settings.
+
+    Runs on a single loop timer instead of polling. While commands come in it fires at most
+    once per timeout: it isn't moved by each command, but re-armed for the rest of the timeout
+    when it fires early. Once idle it fires only at the next schedule entry, or never without
+    a schedule. There are no resets while stopped (the backend is unreachable) or holding
+    (a desired state stands), until the next command.
+
+    Args:
+        apply: Coroutine function called with the default state (command fields) to converge to
+        logger: Logger of the candlestick
+        timeout: Seconds without commands before the reset, 0 never resets
+        defaults: Default state (command fields)
+        policy: Policy from the backend, e.g. the cached one
+    """
+
+    def __init__(self, apply: Callable[[dict], Awaitable[None]], logger: logging.Logger, timeout: float, defaults: dict, policy: Optional[dict] = None):
+        self.apply = apply
+        self.logger = logger
+        self.default_timeout = timeout
+        self.default_state = defaults
+        self.timeout = timeout
+        self.defaults = defaults
+        self.entries: List[Tuple[Tuple[int, int], dict]] = []
+        # time.monotonic() of the last command, None when idle (reset, or nothing received since the start)
+        self.last_activity: Optional[float] = None
+        self.running = False
+        self.holding = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # Wall clock time of the schedule entry the timer waits for while idle
+        self.entry_due: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+        self.set_policy(policy)
+
+    def set_policy(self, policy: Optional[dict]):
+        """Use a policy from the backend (timeout, defaults, schedule), the controller's settings for None"""
+        policy = policy or {}
+        self.timeout = policy['timeout'] if policy.get('timeout') is not None else self.default_timeout
+        self.defaults = policy.get('defaults') or self.default_state
+        parsed = []
+        for entry in policy.get('schedule', []):
+            try:
+                parsed.append((parse_time_of_day(entry['time']), {key: value for key, value in entry.items() if key != 'time'}))
+            except (KeyError, ValueError) as e:
+                self.logger.warning(f"Ignoring reset schedule entry {entry}: {e!r}")
+        self.entries = sorted(parsed, key=lambda item: item[0])
+        self._arm()
+
+    def defaults_at(self, now: datetime) -> dict:
+        """The default state at a time: of the latest schedule entry (of the day before, before the first one)"""
+        if not self.entries:
+            return dict(self.defaults)
+        current = self.entries[-1][1]
+        for time_of_day, state in self.entries:
+            if time_of_day <= (now.hour, now.minute):
+                current = state
+        return dict(current)
+
+    def activity(self):
+        """A command was applied: reset timeout seconds from now"""
+        idle = self.last_activity is None
+        self.last_activity = time.monotonic()
+        self.holding = False
+        if idle or self.timer is None:
+            self._arm()
+
+    def hold(self):
+        """A desired state was applied: no resets until the next command"""
+        self.holding = True
+        self.last_activity = None
+        self._arm()
+
+    def start(self):
+        """The backend is reachable: resets count from now, commands before are long gone"""
+        self.running = True
+        if self.last_activity is not None:
+            self.last_activity = time.monotonic()
+        self._arm()
+
+    def stop(self):
+        """The backend is unreachable: keep the state"""
+        self.running = False
+        self._arm()
+
+    def _arm(self):
+        """Set the timer for the next reset, if any"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        self.entry_due = None
+        if not self.running or self.holding:
+            return
+        loop = asyncio.get_running_loop()
+        if self.last_activity is not None:
+            if self.timeout > 0:
+                self.timer = loop.call_later(self.last_activity + self.timeout - time.monotonic(), self._fire)
+        elif self.entries:
+            now = datetime.now()
+            self.entry_due = next_time_of_day([time_of_day for time_of_day, _ in self.entries], now)
+            # Check the wall clock again after at most OFFLINE_MAX_SLEEP_SECONDS, it may be set while waiting
+            delay = min((self.entry_due - now).total_seconds(), OFFLINE_MAX_SLEEP_SECONDS)
+            self.timer = loop.call_later(delay, self._fire)
+
+    def _fire(self):
+        self.timer = None
+        if not self.running or self.holding:
+            # A timer that fired after stop() or hold()
+            return
+        if self.last_activity is not None:
+            if time.monotonic() < self.last_activity + self.timeout:
+                # Commands came in since the timer was set
+                self._arm()
+                return
+            reason = f"Inactivity timeout reached ({self.timeout}s)"
+        else:
+            now = datetime.now()
+            if self.entry_due is None or now < self.entry_due:
+                self._arm()
+                return
+            reason = f"Reset schedule entry of {self.entry_due:%H:%M} due"
+        self.last_activity = None
+        state = self.defaults_at(datetime.now())
+        self.logger.info(f"{reason}, resetting to {state}")
+        self.task = asyncio.create_task(self._reset(state))
+        self._arm()
+
+    async def _reset(self, state: dict):
+        try:
+            await self.apply(state)
+        except Exception as e:
+            self.logger.error(f"Inactivity reset failed: {e}")
+
+    def close(self):
+        self.stop()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Controller startup benchmark, without hardware or backend.
+
+1. Import time of main_websocket, measured with `python -X importtime`.
+2. Time from process start to the first frame written, as logged by the controller,
+   over several runs. The serial port doesn't exist, so frames are only logged.
+
+Run on the target (e.g. a Pi) from controller/src: `python3 startup_benchmark.py [runs]`
+"""
+
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules listed by cumulative import time
+TOP_IMPORTS = 10
+# How long a run may take to write its first frame
+RUN_TIMEOUT_SECONDS = 30
+FIRST_FRAME = re.compile(r"First frame ([\d.]+)s after process start")
+
+
+def import_times():
+    """Cumulative import time (microseconds) of every module imported by main_websocket"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main_websocket"],
+        capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def first_frame_seconds():
+    """Start a controller and return the first frame time it logs, None if it doesn't"""
+    process = subprocess.Popen(
+        [sys.executable, "main_websocket.py", "--backend-url", "ws://127.0.0.1:9",
+         "--serial-port", "/nonexistent/candlestick", "--candlestick-id", "startup_benchmark"],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    deadline = time.monotonic() + RUN_TIMEOUT_SECONDS
+    try:
+        for line in process.stdout:
+            match = FIRST_FRAME.search(line)
+            if match:
+                return float(match.group(1))
+            if time.monotonic() > deadline:
+                return None
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait()
+    return None
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    times = import_times()
+    print(f"Import of main_websocket: {times.get('main_websocket', 0) / 1000:.1f} ms")
+    slowest = sorted((item for item in times.items() if item[0] != "main_websocket"), key=lambda item: item[1], reverse=True)
+    for name, microseconds in slowest[:TOP_IMPORTS]:
+        print(f"  {name:<40} {microseconds / 1000:7.1f} ms")
+
+    results = [seconds for seconds in (first_frame_seconds() for _ in range(runs)) if seconds is not None]
+    if not results:
+        print("\nNo first frame logged")
+        return 1
+    print(f"\nProcess start to first frame over {len(results)} runs: "
+          f"median {statistics.median(results) * 1000:.0f} ms, max {max(results) * 1000:.0f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Local cache of each candlestick's state, offline schedule and reset policy, kept in SQLite so the
+controller keeps running without the backend, also across restarts.
+
+The cached state is what the controller reports to the backend (program, random,
+speed, direction, color). Every change gets a new revision and each field remembers
+the revision it last changed at, so after a reconnect only the fields changed since
+the backend's last known revision are sent (a resync, see CandlestickDevice.resync).
+The epoch identifies the cache: revisions of different epochs can't be compared.
+"""
+
+import json
+import os
+import sqlite3
+from typing import Any, Dict, List, Optional
+
+from device_config import DEFAULT_PROGRAM, DEFAULT_DIRECTION, html_color_to_rgb
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "rgb-candlestick", "state.sqlite3")
+# Fields of the reported state
+STATE_FIELDS = ("program", "random", "speed", "direction", "color")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS candlesticks (
+    candlestick_id TEXT PRIMARY KEY,
+    epoch TEXT NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 0,
+    synced_revision INTEGER,
+    offline_schedule TEXT,
+    reset_policy TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    candlestick_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT,
+    revision INTEGER NOT NULL,
+    PRIMARY KEY (candlestick_id, field)
+);
+"""
+# Columns added to the candlesticks table of existing caches
+ADDED_COLUMNS = (("reset_policy", "TEXT"),)
+
+
+class StateCache:
+    """
+    SQLite cache shared by the candlesticks of the controller.
+
+    Args:
+        path: Database file, created with its directory if needed. ':memory:' keeps nothing across restarts.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        # Writes are small and frequent (every pattern in random mode), don't sync each one to the SD card
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(candlesticks)")}
+        for column, column_type in ADDED_COLUMNS:
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE candlesticks ADD COLUMN {column} {column_type}")
+
+    def candlestick(self, candlestick_id: str) -> "CandlestickCache":
+        """Cache of one candlestick, created empty with a new epoch if needed"""
+        return CandlestickCache(self.db, candlestick_id)
+
+    def close(self):
+        self.db.close()
+
+
+class CandlestickCache:
+    """Cached state of one candlestick. Reads come from memory, changes are written through."""
+
+    def __init__(self, db: sqlite3.Connection, candlestick_id: str):
+        self.db = db
+        self.candlestick_id = candlestick_id
+        row = db.execute(
+            "SELECT epoch, revision, synced_revision, offline_schedule, reset_policy FROM candlesticks WHERE candlestick_id = ?",
+            (candlestick_id,)
+        ).fetchone()
+        if row is None:
+            row = (os.urandom(8).hex(), 0, None, None, None)
+            with db:
+                db.execute("INSERT INTO candlesticks (candlestick_id, epoch) VALUES (?, ?)", (candlestick_id, row[0]))
+        self.epoch, self.revision, self.synced_revision, offline_schedule, reset_policy = row
+        self.offline_schedule: List[Dict[str, Any]] = json.loads(offline_schedule) if offline_schedule else []
+        self.reset_policy: Optional[Dict[str, Any]] = json.loads(reset_policy) if reset_policy else None
+        self.state: Dict[str, Any] = {
+            field: json.loads(value)
+            for field, value in db.execute("SELECT field, value FROM state WHERE candlestick_id = ?", (candlestick_id,))
+        }
+
+    def update(self, **fields) -> int:
+        """Record the state, only the fields that changed are written. Returns the revision."""
+        changed = {
+            field: value for field, value in fields.items()
+            if field in STATE_FIELDS and (field not in self.state or self.state[field] != value)
+        }
+        if changed:
+            self.revision += 1
+            self.state.update(changed)
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO state (candlestick_id, field, value, revision) VALUES (?, ?, ?, ?)",
+                    [(self.candlestick_id, field, json.dumps(value), self.revision) for field, value in changed.items()]
+                )
+                self.db.execute(
+                    "UPDATE candlesticks SET revision = ? WHERE candlestick_id = ?", (self.revision, self.candlestick_id)
+                )
+        return self.revision
+
+    def changes_since(self, revision: Optional[int]) -> Dict[str, Any]:
+        """Fields changed after a revision of this epoch, the whole state for None"""
+        if revision is None:
+            return dict(self.state)
+        return {
+            field: json.loads(value)
+            for field, value in self.db.execute(
+                "SELECT field, value FROM state WHERE candlestick_id = ? AND revision > ?", (self.candlestick_id, revision)
+            )
+        }
+
+    def mark_synced(self, revision: int):
+        """Remember the latest revision sent to the backend"""
+        if revision == self.synced_revision:
+            return
+        self.synced_revision = revision
+        with self.db:
+            self.db.execute(
+                "UPDATE candlesticks SET synced_revision = ? WHERE candlestick_id = ?", (revision, self.candlestick_id)
+            )
+
+    def set_offline_schedule(self, entries: List[Dict[str, Any]]):
+        """Store the commands to apply at times of day while the backend is unreachable"""
+        self.offline_schedule = entries
+        with self.db:
+            self.db.execute(
+                "UPDATE candlesticks SET offline_schedule = ? WHERE candlestick_id = ?",
+                (json.dumps(entries), self.candlestick_id)
+            )
+
+    def set_reset_policy(self, policy: Dict[str, Any]):
+        """Store what the candlestick resets to after inactivity"""
+        self.reset_policy = policy
+        with self.db:
+            self.db.execute(
+                "UPDATE candlesticks SET reset_policy = ? WHERE candlestick_id = ?",
+                (json.dumps(policy), self.candlestick_id)
+            )
+
+
+def resume_animation(state: Dict[str, Any]):
+    """
+    Animation showing a cached state.
+
+    Returns:
+        (program, direction, rgb_color): a static color when rgb_color isn't None
+    """
+    program = state.get("program")
+    if not program:
+        return DEFAULT_PROGRAM, DEFAULT_DIRECTION, None
+    if state.get("random"):
+        return "random", None, None
+    if program == "stop":
+        return None, None, [0, 0, 0]
+    if program == "static_color" and state.get("color"):
+        return None, None, html_color_to_rgb(state["color"])
+    return program, state.get("direction"), None
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Test of the inactivity reset timer (schedule.InactivityReset), with a fake clock.
+time.monotonic() and datetime.now() of the schedule module are patched, and the timer is
+fired by calling its callback once the fake clock has reached the time it was set for.
+
+Run from controller/src: `python3 test_inactivity_reset.py`
+"""
+
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import schedule
+from schedule import InactivityReset
+
+TIMEOUT = 60
+DEFAULTS = {'program': 'random', 'speed': 10}
+SCHEDULE = [
+    {'time': '08:00', 'program': 'random', 'speed': 10},
+    {'time': '22:00', 'program': 'stop', 'speed': 10},
+]
+
+
+class FakeClock:
+    """Monotonic and wall clock time, advanced together"""
+
+    def __init__(self, now: datetime):
+        self.monotonic = 1000.0
+        self.now = now
+
+    def advance(self, seconds: float):
+        self.monotonic += seconds
+        self.now += timedelta(seconds=seconds)
+
+
+@contextmanager
+def fake_clock(now: datetime):
+    clock = FakeClock(now)
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return clock.now
+
+    original_time, original_datetime = schedule.time, schedule.datetime
+    schedule.time = SimpleNamespace(monotonic=lambda: clock.monotonic)
+    schedule.datetime = FakeDatetime
+    try:
+        yield clock
+    finally:
+        schedule.time, schedule.datetime = original_time, original_datetime
+
+
+def check(condition: bool, description: str):
+    print(f"  {'✓' if condition else '❌'} {description}")
+    if not condition:
+        raise AssertionError(description)
+
+
+def new_reset(policy: dict = None):
+    """An InactivityReset recording the states it resets to"""
+    applied = []
+
+    async def apply(state: dict):
+        applied.append(state)
+
+    return InactivityReset(apply, logging.getLogger("test"), TIMEOUT, DEFAULTS, policy), applied
+
+
+async def fire(reset: InactivityReset):
+    """Fire the armed timer, as the loop would, and let the reset run"""
+    timer = reset.timer
+    check(timer is not None, "Timer armed")
+    timer.cancel()
+    reset._fire()
+    await asyncio.sleep(0)
+
+
+def test_fires_once_after_timeout():
+    async def run():
+        with fake_clock(datetime(2026, 1, 1, 12, 0)) as clock:
+            reset, applied = new_reset()
+            reset.start()
+            check(reset.timer is None, "No timer while idle without a schedule")
+            reset.activity()
+            timer = reset.timer
+            for _ in range(5):
+                clock.advance(10)
+                reset.activity()
+            check(reset.timer is timer, "Commands don't re-arm the timer")
+            clock.advance(TIMEOUT)
+            await fire(reset)
+            check(applied == [DEFAULTS], "Reset once after the timeout")
+            check(reset.timer is None, "Idle without a schedule: no timer")
+            reset.close()
+
+    print("\nReset after the timeout")
+    asyncio.run(run())
+
+
+def test_rearmed_when_fired_early():
+    async def run():
+        with fake_clock(datetime(2026, 1, 1, 12, 0)) as clock:
+            reset, applied = new_reset()
+            reset.start()
+            reset.activity()
+            clock.advance(30)
+            reset.activity()
+            # The timer set for the first command's timeout
+            clock.advance(TIMEOUT - 30)
+            await fire(reset)
+            check(applied == [], "No reset before the timeout of the last command")
+            loop = asyncio.get_running_loop()
+            check(abs(reset.timer.when() - loop.time() - 30) < 1, "Re-armed for the rest of the timeout")
+            clock.advance(30)
+            await fire(reset)
+            check(applied == [DEFAULTS], "Reset at the timeout of the last command")
+            reset.close()
+
+    print("\nEarly timer")
+    asyncio.run(run())
+
+
+def test_hold_and_stop():
+    async def run():
+        with fake_clock(datetime(2026, 1, 1, 12, 0)) as clock:
+            reset, applied = new_reset({'schedule': SCHEDULE})
+            reset.start()
+            reset.activity()
+            reset.hold()
+            check(reset.timer is None, "No timer while a desired state holds")
+            clock.advance(TIMEOUT * 100)
+            reset.activity()
+            check(reset.timer is not None, "A command ends the hold")
+
+            reset.stop()
+            check(reset.timer is None, "No timer while the backend is unreachable")
+            clock.advance(TIMEOUT * 2)
+            reset._fire()
+            await asyncio.sleep(0)
+            check(applied == [], "Nothing applied while stopped")
+            reset.start()
+            check(reset.last_activity == clock.monotonic, "Inactivity counts from the reconnect")
+            reset.close()
+
+    print("\nHold and stop")
+    asyncio.run(run())
+
+
+def test_idle_switches_at_schedule_entry():
+    async def run():
+        with fake_clock(datetime(2026, 1, 1, 12, 0)) as clock:
+            reset, applied = new_reset({'timeout': TIMEOUT, 'schedule': SCHEDULE})
+            reset.start()
+            check(reset.entry_due == datetime(2026, 1, 1, 22, 0), "Idle: waiting for the 22:00 entry")
+            # Fired by the wall clock check before the entry is due
+            clock.advance(3600)
+            await fire(reset)
+            check(applied == [], "Nothing applied before the entry")
+            clock.now = datetime(2026, 1, 1, 22, 0)
+            await fire(reset)
+            check(applied == [{'program': 'stop', 'speed': 10}], "Switched to the 22:00 entry")
+            check(reset.entry_due == datetime(2026, 1, 2, 8, 0), "Waiting for the 08:00 entry of the next day")
+            reset.close()
+
+    print("\nSchedule entries while idle")
+    asyncio.run(run())
+
+
+def test_defaults_at():
+    print("\nDefaults by time of day")
+    reset, _ = new_reset({'schedule': SCHEDULE})
+    check(reset.defaults_at(datetime(2026, 1, 1, 7, 59))['program'] == 'stop', "Before the first entry: the last entry of the day before")
+    check(reset.defaults_at(datetime(2026, 1, 1, 8, 0))['program'] == 'random', "From the first entry on")
+    check(reset.defaults_at(datetime(2026, 1, 1, 23, 0))['program'] == 'stop', "After the last entry")
+    reset.set_policy(None)
+    check(reset.defaults_at(datetime(2026, 1, 1, 7, 0)) == DEFAULTS, "Without a policy: the controller's defaults")
+
+
+def main():
+    print("=" * 60)
+    print("Inactivity reset test")
+    print("=" * 60)
+    test_fires_once_after_timeout()
+    test_rearmed_when_fired_early()
+    test_hold_and_stop()
+    test_idle_switches_at_schedule_entry()
+    test_defaults_at()
+    print("\n✓ Tests completed!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Loopback test for the serial protocols, using a pseudo terminal instead of a candlestick.
+The SerialController writes to the pty and an emulator of the Arduino sketches decodes
+the frames on the other side. Tests framing, checksums, partial frames and throughput
+without requiring actual hardware.
+
+Run from controller/src: `python3 test_serial_protocol.py`
+"""
+
+import os
+import pty
+import threading
+import time
+import tty
+
+from candlestick import SerialController, FrameStats
+from candlestick.protocol import (
+    LEGACY_START, LEGACY_END, FULL_FRAME, PARTIAL_FRAME, decode_packet
+)
+
+NUM_LEDS = 7
+PROTOCOLS = ("legacy", "v2")
+THROUGHPUT_FRAMES = 2000
+
+
+class ArduinoEmulator:
+    """Decodes frames like RGB_led_NeoPixel.ino (legacy) or RGB_led_NeoPixel_v2.ino (v2)"""
+
+    def __init__(self, fd: int, protocol: str):
+        self.fd = fd
+        self.protocol = protocol
+        self.leds = [[0, 0, 0] for _ in range(NUM_LEDS)]
+        self.frames = 0
+        self.errors = 0
+        self._buffer = bytearray()
+        self._receiving = False
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._thread.join(timeout=1)
+
+    def wait_for_frames(self, count: int, timeout: float = 5.0):
+        deadline = time.time() + timeout
+        while self.frames < count and time.time() < deadline:
+            time.sleep(0.001)
+
+    def _run(self):
+        while self._running:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError:
+                return
+            for byte in data:
+                if self.protocol == "legacy":
+                    self._legacy_byte(byte)
+                else:
+                    self._v2_byte(byte)
+
+    def _legacy_byte(self, byte: int):
+        if self._receiving:
+            if byte == LEGACY_END:
+                self._receiving = False
+                self._show(bytes(self._buffer))
+                self._buffer.clear()
+            else:
+                self._buffer.append(byte)
+        elif byte == LEGACY_START:
+            self._receiving = True
+
+    def _v2_byte(self, byte: int):
+        if byte != 0:
+            self._buffer.append(byte)
+            return
+        packet = bytes(self._buffer)
+        self._buffer.clear()
+        if not packet:
+            return
+        try:
+            packet_type, payload = decode_packet(packet)
+        except ValueError:
+            self.errors += 1
+            return
+        if packet_type == FULL_FRAME:
+            self._show(payload)
+        elif packet_type == PARTIAL_FRAME:
+            for i in range(0, len(payload), 4):
+                self.leds[payload[i]] = list(payload[i + 1:i + 4])
+            self.frames += 1
+        else:
+            self.errors += 1
+
+    def _show(self, payload: bytes):
+        if len(payload) != NUM_LEDS * 3:
+            self.errors += 1
+            return
+        self.leds = [list(payload[i:i + 3]) for i in range(0, len(payload), 3)]
+        self.frames += 1
+
+
+def open_loopback(protocol: str, **options):
+    """Create a pty pair, a SerialController on one end and an emulator on the other"""
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    emulator = ArduinoEmulator(master, protocol)
+    controller = SerialController(
+        frame_stats=FrameStats(), port=os.ttyname(slave), protocol=protocol, **options
+    )
+    return controller, emulator, (master, slave)
+
+
+def close_loopback(controller, emulator, fds):
+    controller.ser.close()
+    for fd in fds:
+        os.close(fd)
+    emulator.stop()
+
+
+def check(condition: bool, description: str):
+    print(f"  {'✓' if condition else '❌'} {description}")
+    if not condition:
+        raise AssertionError(description)
+
+
+def check_frames(protocol: str):
+    """Full frames, partial frames and extreme color values"""
+    print(f"\n[{protocol}] Frame round trip")
+    controller, emulator, fds = open_loopback(protocol)
+    try:
+        check(controller.serial_connected, "SerialController opened the pty")
+
+        colors = [[250, 0, 0], [0, 250, 0], [0, 0, 250], [10, 20, 30], [1, 2, 3], [7, 7, 7], [0, 0, 0]]
+        controller.set_full_array([list(color) for color in colors])
+        emulator.wait_for_frames(1)
+        check(emulator.leds == colors, "Full frame decoded")
+
+        controller.set_led(2, [100, 0, 100])
+        emulator.wait_for_frames(2)
+        colors[2] = [100, 0, 100]
+        check(emulator.leds == colors, "Single LED update decoded")
+
+        controller.set_all([255, 254, 0])
+        emulator.wait_for_frames(3)
+        expected = [255, 254, 0] if protocol == "v2" else [253, 253, 0]
+        check(emulator.leds == [expected] * NUM_LEDS, f"Values 254/255 arrive as {expected[:2]}")
+        check(emulator.errors == 0, "No framing or checksum errors")
+    finally:
+        close_loopback(controller, emulator, fds)
+
+
+def test_resync():
+    """A corrupted v2 packet is dropped and the next one is decoded"""
+    print("\n[v2] Corruption and resynchronization")
+    controller, emulator, fds = open_loopback("v2")
+    try:
+        controller.ser.write(b"\x05\x02\x01\xff\x13\x00")  # Bad checksum
+        controller.set_all([40, 50, 60])
+        emulator.wait_for_frames(1)
+        check(emulator.errors == 1, "Corrupted packet rejected")
+        check(emulator.leds == [[40, 50, 60]] * NUM_LEDS, "Following frame decoded")
+    finally:
+        close_loopback(controller, emulator, fds)
+
+
+def measure_throughput(protocol: str, frames: int = THROUGHPUT_FRAMES):
+    """Frames per second through the pty (an upper bound, a real UART is limited by the baud rate)"""
+    print(f"\n[{protocol}] Throughput")
+    controller, emulator, fds = open_loopback(protocol)
+    try:
+        started = time.perf_counter()
+        for i in range(frames):
+            controller.set_all([i % 200, 100, (i * 7) % 200])
+        emulator.wait_for_frames(frames)
+        elapsed = time.perf_counter() - started
+        frame_bytes = len(controller.encode([0] * NUM_LEDS * 3))
+        check(emulator.frames == frames, f"{frames} frames received")
+        print(f"  {frames / elapsed:.0f} frames/s over the pty, {frame_bytes} bytes per full frame")
+        for baud in (57600, 115200, 500000, 1000000):
+            # 10 bits per byte on the wire (start + 8 data + stop)
+            print(f"  at {baud} baud the link allows ~{baud / 10 / frame_bytes:.0f} full frames/s")
+    finally:
+        close_loopback(controller, emulator, fds)
+
+
+def test_frames():
+    for protocol in PROTOCOLS:
+        check_frames(protocol)
+
+
+def test_throughput():
+    for protocol in PROTOCOLS:
+        measure_throughput(protocol)
+
+
+def main():
+    print("=" * 60)
+    print("RGB Candlestick serial protocol loopback test")
+    print("=" * 60)
+    test_frames()
+    test_resync()
+    test_throughput()
+    print("\n✓ Tests completed!")
+
+
+if __name__ == "__main__":
+    main()